@@ -0,0 +1,62 @@
+import csv
+import os
+import threading
+from collections import Counter
+
+# Compact log of (page, origin, mode, threshold, direction) requests, one CSV line each,
+# replayed by warmup.py after a deploy to prefill the caches with the popular selections
+access_log_path = os.environ.get('TTM_ACCESS_LOG', 'data/access_log.csv')
+# Only the most recent lines are considered when ranking entries; they are read from the end
+# of the log, at most max_replay_bytes
+max_replay_lines = 200000
+max_replay_bytes = max_replay_lines * 64
+# At this size the log is rotated to <path>.1, replacing the previous one
+max_log_bytes = int(float(os.environ.get('TTM_ACCESS_LOG_MAX_MB', 20)) * 1024 * 1024)
+
+_lock = threading.Lock()
+
+
+def log_request(page, origin, mode, threshold, direction='from'):
+    line = f"{page},{int(origin)},{mode},{threshold},{direction}\n"
+    try:
+        with _lock:
+            with open(access_log_path, 'a') as f:
+                f.write(line)
+                size = f.tell()
+            if size > max_log_bytes:
+                os.replace(access_log_path, access_log_path + '.1')
+    except OSError as e:
+        print(f"[ERROR] Could not write access log: {e}")
+
+
+# Last lines of a file, reading at most max_bytes from its end
+def _tail_lines(path, max_bytes):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - max_bytes))
+        data = f.read()
+    lines = data.decode('utf-8', errors='replace').splitlines()
+    # The first line is partial unless the whole file was read
+    return lines[1:] if size > max_bytes else lines
+
+
+# Most frequent entries as [((page, origin, mode, threshold, direction), count), ...]
+def top_entries(n):
+    with _lock:
+        lines = _tail_lines(access_log_path, max_replay_bytes)
+        if len(lines) < max_replay_lines:
+            # Shortly after a rotation the recent lines are partly in the previous file
+            lines = _tail_lines(access_log_path + '.1', max_replay_bytes) + lines
+    lines = lines[-max_replay_lines:]
+    counts = Counter()
+    for row in csv.reader(lines):
+        if len(row) != 5:
+            continue
+        page, origin, mode, threshold, direction = row
+        try:
+            counts[(page, int(origin), mode, int(float(threshold)), direction)] += 1
+        except ValueError:
+            continue
+    return counts.most_common(n)
@@ -1,5 +1,14 @@
-from dash import Dash
+import os
+import diskcache
+from dash import Dash, DiskcacheManager
 import dash_bootstrap_components as dbc
 
+# Slow work (address lookups, download files, batch OD queries) runs in background callbacks:
+# each job is a separate process and its progress and result go through this local disk
+# cache, so the server's request threads stay free for the interactive callbacks
+background_cache_path = os.environ.get('TTM_BACKGROUND_CACHE', 'data/background_cache')
+background_callback_manager = DiskcacheManager(diskcache.Cache(background_cache_path))
+
 # Create the Dash app instance
-app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True)
+app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True,
+           background_callback_manager=background_callback_manager)
@@ -0,0 +1,267 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import subprocess
+import time
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+
+# Benchmark suite for the hot paths of the pages and for full callback round trips through
+# Dash's /_dash-update-component endpoint. Run it from a folder whose data/ holds the real
+# matrix or, in a scratch copy of the checkout, one written by synthetic_data.py:
+#
+#   python synthetic_data.py --out data --force --origins 500
+#   python benchmark.py --origins 10 --repeat 3
+#   python benchmark.py --compare benchmarks/bench_20240101_120000.json
+#
+# Results go to benchmarks/bench_<timestamp>.json so runs can be compared over time. By
+# default the origin row and result caches are cleared before every call, so the numbers are
+# for cold selections; --warm keeps them.
+results_folder = 'benchmarks'
+compare_modes = ('walk_avg', 'bike_avg', 'pt_r_avg')
+
+matrix_outputs = '..scatterplot-map.figure...floating-box-content.children...slider-value.children...' \
+                 'matrix-selection.data..'
+address_outputs = '..scatterplot-map.clickData...address-error.children..'
+export_outputs = 'matrix-downloads.children'
+compare_outputs = '..map-compare.figure...meeting-origins.data...meeting-result.children..'
+ab_outputs = '..toast-map.figure...query-result.children...ab-state.data..'
+
+
+# Request body for /_dash-update-component. output is Dash's '..id.prop...id.prop..' spec;
+# inputs and state are lists of (id, property, value)
+def callback_payload(output, inputs, state=(), changed=None):
+    outputs = []
+    for spec in output.strip('.').split('...'):
+        component_id, prop = spec.rsplit('.', 1)
+        outputs.append({'id': component_id, 'property': prop})
+    return {
+        'output': output,
+        'outputs': outputs if len(outputs) > 1 else outputs[0],
+        'inputs': [{'id': i, 'property': p, 'value': v} for i, p, v in inputs],
+        'state': [{'id': i, 'property': p, 'value': v} for i, p, v in state],
+        'changedPropIds': changed or [f"{inputs[0][0]}.{inputs[0][1]}"],
+    }
+
+
+# Matrix page: click a cell
+def matrix_payload(cell_id, mode='walk_avg', threshold=30, direction='from', isochrones=False, year=None, k=None):
+    return callback_payload(matrix_outputs, [
+        ('scatterplot-map', 'clickData', {'points': [{'hovertext': str(cell_id)}]}),
+        ('dataset-selector', 'value', mode),
+        ('threshold-slider', 'value', threshold),
+        ('cell-id-search', 'n_clicks', 0),
+        ('direction-selector', 'value', direction),
+        ('isochrone-toggle', 'value', ['on'] if isochrones else []),
+        ('year-selector', 'value', year),
+        ('query-kind', 'value', 'nearest' if k else 'threshold'),
+        ('nearest-k', 'value', k or 50),
+    ], [
+        ('scatterplot-map', 'relayoutData', None),
+        ('cell-id-input', 'value', None),
+    ], ['scatterplot-map.clickData'])
+
+
+# Matrix page: address search (a background callback, see run_background)
+def address_payload(address):
+    return callback_payload(address_outputs, [
+        ('address-search-btn', 'n_clicks', 1),
+        ('address-input', 'n_submit', 0),
+    ], [('address-input', 'value', address)], ['address-search-btn.n_clicks'])
+
+
+# Matrix page: download files for a selection (a background callback, see run_background)
+def export_payload(cell_id, mode='walk_avg', threshold=30, direction='from', isochrones=False, year=None):
+    selection = {'id': int(cell_id), 'mode': mode, 'direction': direction, 'year': year,
+                 'threshold': threshold, 'isochrones': isochrones}
+    return callback_payload(export_outputs, [('matrix-selection', 'data', selection)])
+
+
+# Background callbacks answer the first request with a job; the browser then repeats the
+# request with the job's cacheKey until the result is there. post(payload, params) sends one
+# request and returns (status code, decoded JSON). Returns the final JSON, or None when the
+# callback produced no update.
+def run_background(post, payload, interval=0.05, timeout=120):
+    status, job = post(payload, None)
+    params = {'cacheKey': job['cacheKey'], 'job': job['job']}
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(interval)
+        status, result = post(payload, params)
+        if status == 204:
+            return None
+        if 'response' in result:
+            return result
+    raise TimeoutError(f"Background job {job['job']} did not finish in {timeout} s")
+
+
+# Compare page: click a cell with a set of modes selected
+def compare_payload(cell_id, modes=compare_modes, threshold=30, direction='from',
+                    year=None):
+    return callback_payload(compare_outputs, [
+        ('travel-modes-compare', 'value', list(modes)),
+        ('threshold-slider-compare', 'value', threshold),
+        ('map-compare', 'clickData', {'points': [{'hovertext': str(cell_id)}]}),
+        ('direction-compare', 'value', direction),
+        ('meeting-mode', 'value', []),
+        ('meeting-clear', 'n_clicks', 0),
+        ('difference-mode', 'value', []),
+        ('difference-mode-a', 'value', 'pt_r_avg'),
+        ('difference-mode-b', 'value', 'car_r'),
+        ('difference-metric', 'value', 'difference'),
+        ('year-compare', 'value', year),
+        ('difference-kind', 'value', 'modes'),
+        ('difference-year-a', 'value', year),
+        ('difference-year-b', 'value', year),
+    ], [('meeting-origins', 'data', [])], ['map-compare.clickData'])
+
+
+# A-B page: one map click with the session state returned by the previous click
+def ab_payload(cell_id, state=None, year=None, keep_origin=False):
+    return callback_payload(ab_outputs, [
+        ('toast-map', 'clickData', {'points': [{'hovertext': str(cell_id)}]}),
+    ], [('ab-state', 'data', state), ('toast-map', 'relayoutData', None), ('ab-year', 'value', year),
+        ('ab-keep-origin', 'value', ['on'] if keep_origin else [])])
+
+
+def summarize(samples):
+    samples = np.asarray(samples) * 1000
+    return {
+        'n': len(samples),
+        'mean_ms': round(float(samples.mean()), 2),
+        'median_ms': round(float(np.median(samples)), 2),
+        'p95_ms': round(float(np.percentile(samples, 95)), 2),
+        'min_ms': round(float(samples.min()), 2),
+        'max_ms': round(float(samples.max()), 2),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(origins=10, repeat=3, mode='walk_avg', threshold=30, warm=False, seed=0):
+    # The page modules load their data at import time and print a lot while doing so
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main
+        from app import app
+        from pages import Matrix, compare
+        from result_cache import result_cache
+        import matrix_store
+    client = app.server.test_client()
+
+    conn = matrix_store.store.connection()
+    origin_ids = [row[0] for row in conn.execute("SELECT DISTINCT from_id FROM FULL_CV")]
+    # Prefer origins with a per-destination CSV, so create_gpkg writes a file instead of bailing out
+    with_csv = [i for i in origin_ids
+                if Path(f"{Matrix.csv_folder}/Helsinki_Travel_Time_Matrix_2023_travel_times_to_{i}.csv").exists()]
+    rng = random.Random(seed)
+    origin_ids = rng.sample(with_csv, min(origins, len(with_csv))) + \
+        rng.sample(sorted(set(origin_ids) - set(with_csv)), max(0, min(origins, len(origin_ids)) - len(with_csv)))
+    dataset = {
+        'cells': len(matrix_store.grid_index.ids),
+        'origins': conn.execute("SELECT COUNT(DISTINCT from_id) FROM FULL_CV").fetchone()[0],
+        'rows': conn.execute("SELECT COUNT(*) FROM FULL_CV").fetchone()[0],
+    }
+
+    def reset():
+        if not warm:
+            matrix_store.store.clear()
+            result_cache.backend.clear()
+
+    def post(payload):
+        response = client.post('/_dash-update-component', json=payload)
+        if response.status_code != 200:
+            raise RuntimeError(f"Callback returned {response.status_code}")
+        return response.get_json()
+
+    def post_background(payload, params):
+        response = client.post('/_dash-update-component', json=payload, query_string=params)
+        if response.status_code not in (200, 204):
+            raise RuntimeError(f"Callback returned {response.status_code}")
+        return response.status_code, response.get_json(silent=True)
+
+    related = {cell_id: Matrix.query_db(mode, threshold, cell_id) for cell_id in origin_ids}
+    ab_pairs = list(zip(origin_ids, origin_ids[1:] + origin_ids[:1]))
+    cases = {
+        'query_db': lambda cell_id: Matrix.query_db(mode, threshold, cell_id),
+        'query_db_to': lambda cell_id: Matrix.query_db(mode, threshold, cell_id, 'to'),
+        'nearest_destinations': lambda cell_id: Matrix.nearest_destinations(mode, 50, cell_id),
+        'reachable_bits': lambda cell_id: compare.reachable_bits(mode, threshold, cell_id),
+        'mode_overlap': lambda cell_id: compare.mode_overlap(
+            {m: compare.reachable_bits(m, threshold, cell_id) for m in compare_modes}),
+        'calculate_population': lambda cell_id: Matrix.calculate_population(related[cell_id]),
+        'create_map': lambda cell_id: Matrix.create_map(related[cell_id], cell_id),
+        'create_gpkg': lambda cell_id: Matrix.create_gpkg(cell_id, related[cell_id], mode, threshold),
+        'callback_matrix': lambda cell_id: post(matrix_payload(cell_id, mode, threshold)),
+        'callback_matrix_isochrones': lambda cell_id: post(matrix_payload(cell_id, mode, threshold, isochrones=True)),
+        'callback_matrix_nearest': lambda cell_id: post(matrix_payload(cell_id, mode, threshold, k=50)),
+        'callback_export': lambda cell_id: run_background(post_background, export_payload(cell_id, mode, threshold)),
+        'callback_compare': lambda cell_id: post(compare_payload(cell_id, threshold=threshold)),
+        'callback_ab_pair': lambda cell_id: post(ab_payload(
+            dict(ab_pairs)[cell_id],
+            post(ab_payload(cell_id))['response']['ab-state']['data'])),
+    }
+
+    results = {}
+    for name, case in cases.items():
+        samples = []
+        for _ in range(repeat):
+            for cell_id in origin_ids:
+                reset()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    start_time = time.perf_counter()
+                    case(cell_id)
+                    samples.append(time.perf_counter() - start_time)
+        results[name] = summarize(samples)
+        print(f"{name:28s} median {results[name]['median_ms']:9.2f} ms   p95 {results[name]['p95_ms']:9.2f} ms")
+
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {'origins': len(origin_ids), 'repeat': repeat, 'mode': mode,
+                     'threshold': threshold, 'warm': warm},
+        'dataset': dataset,
+        'results': results,
+    }
+
+
+# Print the median change of every case against an earlier run
+def compare_runs(previous, current):
+    print(f"{'case':28s} {'before':>10s} {'after':>10s} {'change':>8s}")
+    for name, stats in current['results'].items():
+        before = previous['results'].get(name)
+        if before is None:
+            continue
+        change = (stats['median_ms'] - before['median_ms']) / before['median_ms'] * 100 if before['median_ms'] else 0
+        print(f"{name:28s} {before['median_ms']:10.2f} {stats['median_ms']:10.2f} {change:+7.1f}%")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the travel time matrix app.')
+    parser.add_argument('--origins', type=int, default=10, help='number of origins to sample')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions per origin')
+    parser.add_argument('--mode', default='walk_avg')
+    parser.add_argument('--threshold', type=int, default=30)
+    parser.add_argument('--warm', action='store_true', help='keep caches between calls')
+    parser.add_argument('--compare', help='earlier result JSON to compare against')
+    parser.add_argument('--out', default=results_folder, help='folder for the result JSON')
+    args = parser.parse_args()
+
+    result = run(args.origins, args.repeat, args.mode, args.threshold, args.warm)
+    Path(args.out).mkdir(parents=True, exist_ok=True)
+    out_file = Path(args.out) / f"bench_{datetime.now():%Y%m%d_%H%M%S}.json"
+    out_file.write_text(json.dumps(result, indent=2))
+    print(f"Results written to {out_file}")
+    if args.compare:
+        compare_runs(json.loads(Path(args.compare).read_text()), result)
@@ -0,0 +1,55 @@
+import numpy as np
+import grid_index
+
+# Sets of grid cells (e.g. the cells a mode reaches within the threshold) as packed bitsets
+# over grid positions: bit i is cell grid_index.ids[i]. A set over the whole grid is 1.6 kB,
+# and intersections, unions and differences are bytewise operations (a & b, a | b, a & ~b),
+# so overlaps between several modes cost a few machine words per 64 cells instead of id list
+# comparisons. Complements are only used after an &, which keeps the padding bits 0.
+n_cells = len(grid_index.ids)
+
+# Number of set bits in every byte value
+_popcount = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+# Bitset of the positions where mask is True
+def from_mask(mask):
+    return np.packbits(mask)
+
+
+# Bitset of the cells whose value in a grid-ordered vector is within threshold (NaN is not)
+def within(vector, threshold):
+    return np.packbits(vector <= threshold)
+
+
+def empty():
+    return np.zeros((n_cells + 7) // 8, dtype=np.uint8)
+
+
+def union(bitsets):
+    return np.bitwise_or.reduce(list(bitsets), axis=0) if bitsets else empty()
+
+
+def intersection(bitsets):
+    return np.bitwise_and.reduce(list(bitsets), axis=0) if bitsets else empty()
+
+
+def to_mask(bits):
+    return np.unpackbits(bits, count=n_cells).astype(bool)
+
+
+def positions(bits):
+    return np.flatnonzero(np.unpackbits(bits, count=n_cells))
+
+
+def cell_ids(bits):
+    return grid_index.ids[positions(bits)]
+
+
+def count(bits):
+    return int(_popcount[bits].sum(dtype=np.int64))
+
+
+# Sum of a grid-ordered weight vector (e.g. population) over the set
+def total(bits, weights):
+    return float(weights[to_mask(bits)].sum())
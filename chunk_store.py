@@ -0,0 +1,229 @@
+import argparse
+import os
+import random
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+import numpy as np
+import grid_index
+import matrix_store
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, chunks fall back to zlib
+    zstandard = None
+
+# Compressed, chunked copy of the origin rows of FULL_CV for low-memory deployments. Times are
+# quantized to whole minutes in uint8 (or uint16) with the largest value as the unreachable
+# sentinel, walk_d to units of walk_unit metres in uint16. Origins are grouped into blocks of
+# block_size consecutive grid positions; each block is one compressed chunk (zstd when the
+# zstandard package is installed, zlib otherwise) in a small SQLite file. Reads decompress a
+# whole block into an LRU of quantized blocks, so neighbouring origins are served from memory.
+#
+# With uint8, times above 254 minutes are stored as 254; thresholds on the pages stop at 120.
+# Catchment (destination) rows are still read from FULL_CV / FULL_CV_T, and so are the single
+# pairs of the A-B page (MatrixStore.exact_origin_row), which shows exact values.
+#
+#   python chunk_store.py build --codec zstd --level 3 --block-size 16 --dtype uint8
+#   python chunk_store.py bench --origins 50
+#   TTM_MATRIX_CHUNKS=data/matrix_chunks.db python main.py
+chunks_path = os.environ.get('TTM_MATRIX_CHUNKS', 'data/matrix_chunks.db')
+# A decoded block takes block_size * n_cells * (2 + 14 * dtype size) bytes: about 3.5 MB for
+# 16 origins of uint8 on the full grid
+cache_blocks = int(os.environ.get('TTM_CHUNK_CACHE_BLOCKS', 16))
+
+walk_sentinel = np.iinfo(np.uint16).max
+
+
+def _codec(codec, level):
+    if codec == 'zstd' and zstandard is None:
+        print("[DEBUG] zstandard is not installed, using zlib")
+        codec = 'zlib'
+    if codec == 'zstd':
+        return codec, zstandard.ZstdCompressor(level=level).compress, zstandard.ZstdDecompressor().decompress
+    if codec == 'zlib':
+        return codec, lambda data: zlib.compress(data, level), zlib.decompress
+    return 'none', bytes, bytes
+
+
+# Quantize a (block, len(columns), n_cells) float array to (walk_d uint16, modes dtype) bytes
+def encode_block(rows, dtype, walk_unit):
+    walk = rows[:, 0]
+    walk = np.where(np.isnan(walk), walk_sentinel,
+                    np.clip(np.rint(walk / walk_unit), 0, walk_sentinel - 1)).astype(np.uint16)
+    sentinel = np.iinfo(dtype).max
+    times = rows[:, 1:]
+    times = np.where(np.isnan(times), sentinel, np.clip(np.rint(times), 0, sentinel - 1)).astype(dtype)
+    return walk.tobytes() + times.tobytes()
+
+
+def decode_block(data, n_origins, n_cells, dtype):
+    walk_bytes = n_origins * n_cells * 2
+    walk = np.frombuffer(data[:walk_bytes], dtype=np.uint16).reshape(n_origins, n_cells)
+    times = np.frombuffer(data[walk_bytes:], dtype=dtype).reshape(n_origins, len(matrix_store.modes), n_cells)
+    return walk, times
+
+
+class ChunkStore:
+    def __init__(self, path=chunks_path, cache_size=cache_blocks):
+        self.path = path
+        self.cache_size = cache_size
+        self._local = threading.local()
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+        meta = dict(self.connection().execute("SELECT key, value FROM meta"))
+        self.block_size = int(meta['block_size'])
+        self.walk_unit = float(meta['walk_unit'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.codec, _, self._decompress = _codec(meta['codec'], int(meta['level']))
+        if int(meta['n_cells']) != len(grid_index.ids):
+            raise ValueError(f"{path} was built for {meta['n_cells']} cells, the grid has {len(grid_index.ids)}")
+        self.hits = 0
+        self.misses = 0
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        # Background callback processes are forked from the server and open their own
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    # Quantized (walk_d, times) arrays of one block, LRU cached
+    def _block(self, block):
+        with self._lock:
+            cached = self._blocks.get(block)
+            if cached is not None:
+                self._blocks.move_to_end(block)
+                self.hits += 1
+                return cached
+            self.misses += 1
+        record = self.connection().execute("SELECT n_origins, data FROM chunks WHERE block = ?", (block,)).fetchone()
+        if record is None:
+            return None
+        cached = decode_block(self._decompress(record[1]), record[0], len(grid_index.ids), self.dtype)
+        with self._lock:
+            self._blocks[block] = cached
+            while len(self._blocks) > self.cache_size:
+                self._blocks.popitem(last=False)
+        return cached
+
+    # All columns for one origin as a (len(columns), n_cells) float32 array, NaN for unreachable,
+    # in the same form as MatrixStore.origin_row
+    def origin_row(self, from_id):
+        row = np.full((len(matrix_store.columns), len(grid_index.ids)), np.nan, dtype=np.float32)
+        position = grid_index.position_of.get(int(from_id))
+        block = None if position is None else self._block(position // self.block_size)
+        if block is None:
+            return row
+        walk, times = block
+        i = position % self.block_size
+        row[0] = walk[i] * self.walk_unit
+        row[0, walk[i] == walk_sentinel] = np.nan
+        row[1:] = times[i]
+        row[1:][times[i] == np.iinfo(self.dtype).max] = np.nan
+        return row
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+
+
+# Build the chunk file from FULL_CV
+def build(path=chunks_path, source=matrix_store.db_path, block_size=16, codec='zstd', level=3,
+          dtype='uint8', walk_unit=50):
+    start_time = time.time()
+    codec, compress, _ = _codec(codec, level)
+    dtype = np.dtype(dtype)
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("CREATE TABLE chunks (block INTEGER PRIMARY KEY, n_origins INTEGER, data BLOB)")
+    conn.executemany("INSERT INTO meta VALUES (?, ?)", [
+        ('block_size', block_size), ('codec', codec), ('level', level), ('dtype', dtype.name),
+        ('walk_unit', walk_unit), ('n_cells', len(grid_index.ids)),
+    ])
+
+    source_store = matrix_store.MatrixStore(source, cache_size=block_size)
+    raw_bytes = stored_bytes = 0
+    n_blocks = (len(grid_index.ids) + block_size - 1) // block_size
+    for block in range(n_blocks):
+        ids = grid_index.ids[block * block_size:(block + 1) * block_size]
+        rows = source_store.origin_rows(ids)
+        data = encode_block(rows, dtype, walk_unit)
+        chunk = compress(data)
+        conn.execute("INSERT INTO chunks VALUES (?, ?, ?)", (block, len(ids), chunk))
+        raw_bytes += rows.nbytes
+        stored_bytes += len(chunk)
+        source_store.clear()
+        if (block + 1) % 20 == 0:
+            conn.commit()
+            print(f"[DEBUG] Built {block + 1}/{n_blocks} blocks")
+    conn.commit()
+    conn.close()
+    print(f"[DEBUG] Built {path} ({codec} level {level}, {dtype.name}, {block_size} origins per block): "
+          f"{stored_bytes / 1024 / 1024:.1f} MB, {raw_bytes / max(stored_bytes, 1):.1f}x smaller than float32 rows, "
+          f"{time.time() - start_time:.2f} seconds")
+
+
+# Origin row latency of the SQLite path and of the chunk store, cold (no cached rows or
+# blocks) and for neighbouring origins of an already decompressed block
+def benchmark(path=chunks_path, source=matrix_store.db_path, origins=50, seed=0):
+    sqlite_store = matrix_store.MatrixStore(source, cache_size=1)
+    chunk_store = ChunkStore(path)
+    from_ids = [row[0] for row in sqlite_store.connection().execute("SELECT DISTINCT from_id FROM FULL_CV")]
+    from_ids = random.Random(seed).sample(from_ids, min(origins, len(from_ids)))
+
+    # prepare runs before each timed read: clear the caches for cold reads, or read the origin
+    # once so its block is cached
+    def timed(read, prepare):
+        samples = []
+        for from_id in from_ids:
+            prepare(from_id)
+            start_time = time.perf_counter()
+            read(from_id)
+            samples.append((time.perf_counter() - start_time) * 1000)
+        return samples
+
+    results = {
+        'sqlite': timed(sqlite_store.origin_row, lambda from_id: sqlite_store.clear()),
+        'chunks (cold block)': timed(chunk_store.origin_row, lambda from_id: chunk_store.clear()),
+        'chunks (cached block)': timed(chunk_store.origin_row, chunk_store.origin_row),
+    }
+    # Quantization error of the travel times against the SQLite values, apart from times
+    # above the largest stored value
+    largest = np.iinfo(chunk_store.dtype).max - 1
+    errors = []
+    for from_id in from_ids:
+        exact = sqlite_store.origin_row(from_id)[1:]
+        difference = np.abs(chunk_store.origin_row(from_id)[1:] - exact)[exact < largest]
+        errors.append(np.nanmax(difference, initial=0))
+
+    print(f"SQLite {os.path.getsize(source) / 1024 / 1024:.1f} MB, chunks {os.path.getsize(path) / 1024 / 1024:.1f} MB "
+          f"({chunk_store.codec}, {chunk_store.dtype.name}, block {chunk_store.block_size})")
+    for name, samples in results.items():
+        print(f"{name:22s} median {np.median(samples):8.2f} ms   p95 {np.percentile(samples, 95):8.2f} ms")
+    print(f"Largest travel time difference below {largest} min: {max(errors):.1f} min")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or benchmark the compressed chunk store.')
+    parser.add_argument('command', choices=['build', 'bench'])
+    parser.add_argument('--path', default=chunks_path)
+    parser.add_argument('--source', default=matrix_store.db_path)
+    parser.add_argument('--block-size', type=int, default=16, help='origins per chunk')
+    parser.add_argument('--codec', default='zstd', choices=['zstd', 'zlib', 'none'])
+    parser.add_argument('--level', type=int, default=3, help='compression level')
+    parser.add_argument('--dtype', default='uint8', choices=['uint8', 'uint16'], help='travel time type')
+    parser.add_argument('--walk-unit', type=float, default=50, help='walk_d unit in metres')
+    parser.add_argument('--origins', type=int, default=50, help='origins to sample for bench')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build(args.path, args.source, args.block_size, args.codec, args.level, args.dtype, args.walk_unit)
+    else:
+        benchmark(args.path, args.source, args.origins)
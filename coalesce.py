@@ -0,0 +1,119 @@
+import hashlib
+import os
+import threading
+
+# Server-side coalescing of Dash callback requests. Dragging a slider or clicking quickly
+# sends a stream of requests for the same output, and only the latest one matters:
+#
+# - Every (tab, output) has a generation counter, bumped by each request. The tab is a random
+#   id per page load that the browser adds to every callback request (see main.py), so two
+#   tabs of one browser do not cancel each other. Requests for the same key run one at a
+#   time; a waiting request is woken and dropped as soon as a newer one arrives, and a
+#   result that is already outdated when it is ready is discarded. Both are answered with
+#   204, which Dash treats as "no update"; the newer request brings the result. So at most
+#   one request per key waits at a time.
+# - Identical requests (same body) in flight at the same time, typically different users
+#   clicking the same popular cell, share one computation (single-flight): followers wait
+#   for the leader and get a copy of its response.
+#
+# Waits are short so slow queries cannot park the server's request threads: after max_wait a
+# waiting request runs anyway, and after flight_wait a follower computes the result itself.
+# main.py wires this into the request hooks for /_dash-update-component. TTM_COALESCE=0 turns
+# it off.
+enabled = os.environ.get('TTM_COALESCE', '1') != '0'
+# Longest wait for a turn, in seconds
+max_wait = float(os.environ.get('TTM_COALESCE_WAIT', 5))
+# Longest wait for the result of an identical request, in seconds
+flight_wait = float(os.environ.get('TTM_COALESCE_FLIGHT_WAIT', 2))
+
+
+class _Slot:
+    def __init__(self):
+        self.busy = False
+        self.generation = 0
+        self.users = 0
+
+
+class _Flight:
+    def __init__(self, digest):
+        self.digest = digest
+        self.done = threading.Event()
+        self.response = None  # (body, status, mimetype) once the leader has finished
+
+
+class Coalescer:
+    def __init__(self, max_wait=max_wait, flight_wait=flight_wait):
+        self.max_wait = max_wait
+        self.flight_wait = flight_wait
+        self._lock = threading.Lock()
+        self._turns = threading.Condition(self._lock)
+        self._slots = {}    # (tab, output) -> _Slot
+        self._flights = {}  # request digest -> _Flight
+        self.counts = {'dropped': 0, 'discarded': 0, 'shared': 0}
+
+    # Register a request for (tab, output) and wait for its turn, or until a newer request
+    # supersedes it. Returns its generation and whether it got the slot (False when it is
+    # stale or after a timeout).
+    def enter(self, key):
+        with self._turns:
+            slot = self._slots.setdefault(key, _Slot())
+            slot.generation += 1
+            slot.users += 1
+            generation = slot.generation
+            # Wake an older request still waiting for this key, so it is dropped now
+            self._turns.notify_all()
+            self._turns.wait_for(lambda: not slot.busy or slot.generation != generation, self.max_wait)
+            if slot.busy or slot.generation != generation:
+                return generation, False
+            slot.busy = True
+            return generation, True
+
+    def is_stale(self, key, generation):
+        with self._lock:
+            slot = self._slots.get(key)
+            return slot is not None and slot.generation != generation
+
+    def leave(self, key, acquired):
+        with self._turns:
+            slot = self._slots[key]
+            slot.users -= 1
+            if not slot.users:
+                del self._slots[key]
+            if acquired:
+                slot.busy = False
+                self._turns.notify_all()
+
+    # Join the flight of an identical request. Returns (flight, True) for the leader, which
+    # must call land() when done, or (flight, False) for a follower, which can wait().
+    def join(self, body):
+        digest = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            flight = self._flights.get(digest)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[digest] = _Flight(digest)
+            return flight, True
+
+    # Response of the flight's leader, or None if it failed or took longer than flight_wait
+    def wait(self, flight):
+        flight.done.wait(self.flight_wait)
+        return flight.response
+
+    def land(self, flight, response=None):
+        with self._lock:
+            if self._flights.get(flight.digest) is flight:
+                del self._flights[flight.digest]
+        flight.response = response
+        flight.done.set()
+
+    # Count a dropped, discarded or shared request
+    def count(self, kind):
+        with self._lock:
+            self.counts[kind] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts, active_keys=len(self._slots), in_flight=len(self._flights))
+
+
+coalescer = Coalescer()
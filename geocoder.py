@@ -0,0 +1,287 @@
+import csv
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+
+# Local address gazetteer (street + house number -> coordinate) used by the address search.
+# Expected columns: street, number, lat, lon (an optional 'city' column is used in labels).
+address_csv = 'data/addresses.csv'
+# Persistent cache for the optional Nominatim fallback. Addresses Nominatim did not find are
+# asked again after negative_ttl seconds, as its data keeps growing.
+geocode_cache_db = 'data/geocode_cache.db'
+negative_ttl = float(os.environ.get('TTM_GEOCODE_NEGATIVE_TTL', 24 * 3600))
+
+try:
+    from geopy.geocoders import Nominatim
+except ImportError:  # geopy is only needed for the online fallback
+    Nominatim = None
+
+
+# Normalise a street name or query for indexing: casefold, strip accents except the
+# Finnish/Swedish letters, drop punctuation and collapse whitespace
+def normalize(text):
+    text = unicodedata.normalize('NFC', str(text)).casefold()
+    keep = []
+    for ch in text:
+        if ch.isalnum() or ch in 'äöå':
+            keep.append(ch)
+        else:
+            keep.append(' ')
+    return ' '.join(''.join(keep).split())
+
+
+# Normalise a house number ("5 A", "5a", "5-7") to a compact key
+def normalize_number(number):
+    return ''.join(str(number).casefold().split())
+
+
+# Leading numeric part of a house number ("12b" -> 12), or None
+def _number_value(number):
+    digits = ''
+    for ch in number:
+        if not ch.isdigit():
+            break
+        digits += ch
+    return int(digits) if digits else None
+
+
+# Split a normalised query into (street, house number); the number is the first token
+# starting with a digit, a trailing letter token ("5 a") is folded into it and anything
+# after it (postcode, city) is ignored
+def parse_query(query):
+    tokens = normalize(query).split()
+    for i, token in enumerate(tokens):
+        if token[0].isdigit():
+            number = token
+            if i + 1 < len(tokens) and len(tokens[i + 1]) == 1 and tokens[i + 1].isalpha():
+                number += tokens[i + 1]
+            return ' '.join(tokens[:i]), number
+    return ' '.join(tokens), None
+
+
+class _TrieNode:
+    __slots__ = ('children', 'street')
+
+    def __init__(self):
+        self.children = {}
+        self.street = None
+
+
+# In-memory gazetteer with a character trie over street names (autocomplete and fuzzy
+# matching) and a per-street table of house numbers
+class Gazetteer:
+    def __init__(self):
+        self.root = _TrieNode()
+        self.streets = {}  # normalised street -> {number: (lat, lon)}
+        self.labels = {}   # normalised street -> display name
+        self.sorted_streets = []
+
+    @classmethod
+    def load(cls, path):
+        gazetteer = cls()
+        if not os.path.exists(path):
+            print(f"[DEBUG] Address gazetteer not found: {path}")
+            return gazetteer
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                try:
+                    lat, lon = float(row['lat']), float(row['lon'])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                label = row['street'].strip()
+                if row.get('city'):
+                    label = f"{label}, {row['city'].strip()}"
+                gazetteer.add(row['street'], row.get('number', ''), lat, lon, label)
+        gazetteer.sorted_streets = sorted(gazetteer.streets)
+        return gazetteer
+
+    def add(self, street, number, lat, lon, label=None):
+        key = normalize(street)
+        if not key:
+            return
+        if key not in self.streets:
+            self.streets[key] = {}
+            self.labels[key] = label or street
+            node = self.root
+            for ch in key:
+                node = node.children.setdefault(ch, _TrieNode())
+            node.street = key
+        self.streets[key][normalize_number(number)] = (lat, lon)
+
+    def __len__(self):
+        return sum(len(numbers) for numbers in self.streets.values())
+
+    # Streets starting with the given normalised prefix, in alphabetical order
+    def complete_street(self, prefix, limit=10):
+        start = bisect_left(self.sorted_streets, prefix)
+        matches = []
+        for street in self.sorted_streets[start:]:
+            if not street.startswith(prefix) or len(matches) >= limit:
+                break
+            matches.append(street)
+        return matches
+
+    # Streets within max_distance edits of the query (Levenshtein walk over the trie),
+    # best match first
+    def fuzzy_street(self, street, max_distance=2, limit=5):
+        results = []
+        first_row = list(range(len(street) + 1))
+
+        def walk(node, ch, previous_row):
+            row = [previous_row[0] + 1]
+            for col in range(1, len(street) + 1):
+                cost = 0 if street[col - 1] == ch else 1
+                row.append(min(row[col - 1] + 1, previous_row[col] + 1, previous_row[col - 1] + cost))
+            if node.street is not None and row[-1] <= max_distance:
+                results.append((row[-1], node.street))
+            if min(row) <= max_distance:
+                for next_ch, child in node.children.items():
+                    walk(child, next_ch, row)
+
+        for ch, child in self.root.children.items():
+            walk(child, ch, first_row)
+        results.sort()
+        return [name for _, name in results[:limit]]
+
+    # Coordinate for a house number on a street: exact match, then the same numeric
+    # part without the letter, then the nearest numbered address on the street
+    def locate(self, street, number):
+        numbers = self.streets[street]
+        if number is not None:
+            if number in numbers:
+                return numbers[number], number
+            value = _number_value(number)
+            if value is not None:
+                candidates = [(abs(_number_value(n) - value), n) for n in numbers if _number_value(n) is not None]
+                if candidates:
+                    nearest = min(candidates)[1]
+                    return numbers[nearest], nearest
+        # No number given: use the mean position of the street's addresses
+        coords = list(numbers.values())
+        lat = sum(c[0] for c in coords) / len(coords)
+        lon = sum(c[1] for c in coords) / len(coords)
+        return (lat, lon), None
+
+    # True if the query's street is a prefix of more than one street, so it has to be picked
+    # from the suggestions
+    def ambiguous(self, query):
+        street, _ = parse_query(query)
+        return bool(street) and street not in self.streets and len(self.complete_street(street, limit=2)) > 1
+
+    # Resolve a free text query to (lat, lon, label) or None. A street prefix is only
+    # completed when a single street starts with it.
+    def geocode(self, query):
+        street, number = parse_query(query)
+        if not street:
+            return None
+        if street not in self.streets:
+            completions = self.complete_street(street, limit=2)
+            if len(completions) > 1:
+                return None
+            # Tolerate a trailing city name ("mannerheimintie 5 helsinki" is handled by
+            # parse_query, "mannerheimintie helsinki" is not)
+            candidates = completions or self.fuzzy_street(street, limit=1)
+            if not candidates:
+                head = street.rsplit(' ', 1)[0]
+                candidates = [head] if head in self.streets else []
+            if not candidates:
+                return None
+            street = candidates[0]
+        (lat, lon), matched = self.locate(street, number)
+        label = self.labels[street] if matched is None else f"{self.labels[street].split(',')[0]} {matched}"
+        return lat, lon, label
+
+    # Autocomplete suggestions for the address input
+    def suggest(self, query, limit=10):
+        street, number = parse_query(query)
+        if not street:
+            return []
+        streets = self.complete_street(street, limit) or self.fuzzy_street(street, limit=limit)
+        suggestions = []
+        for key in streets:
+            name = self.labels[key].split(',')[0]
+            if number is None:
+                suggestions.append(name)
+                continue
+            numbers = sorted((n for n in self.streets[key] if n.startswith(number)),
+                             key=lambda n: (_number_value(n) or 0, n))
+            suggestions.extend(f"{name} {n}" for n in numbers[:limit - len(suggestions)])
+            if len(suggestions) >= limit:
+                break
+        return suggestions[:limit]
+
+
+# Geocoder combining the local gazetteer with an optional, cached Nominatim fallback
+class Geocoder:
+    def __init__(self, gazetteer, cache_path=geocode_cache_db, use_nominatim=True):
+        self.gazetteer = gazetteer
+        self.cache_path = cache_path
+        self.nominatim = None
+        if use_nominatim and Nominatim is not None:
+            self.nominatim = Nominatim(user_agent="Helsinki_TTM_App")
+        self._lock = threading.Lock()
+        self._pid = None
+        self._cache = self._connection()
+        self._cache.execute(
+            "CREATE TABLE IF NOT EXISTS geocode_cache "
+            "(query TEXT PRIMARY KEY, lat REAL, lon REAL, label TEXT, created REAL)"
+        )
+        self._cache.commit()
+
+    # The cache connection, reopened in background callback processes forked from the server
+    def _connection(self):
+        if self._pid != os.getpid():
+            self._cache = sqlite3.connect(self.cache_path, check_same_thread=False)
+            self._pid = os.getpid()
+        return self._cache
+
+    def _cached(self, key):
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT lat, lon, label, created FROM geocode_cache WHERE query = ?", (key,)
+            ).fetchone()
+        if row is None or (row[0] is None and time.time() - (row[3] or 0) > negative_ttl):
+            return None
+        return row[:3]
+
+    def _store(self, key, result):
+        lat, lon, label = result if result else (None, None, None)
+        with self._lock:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO geocode_cache VALUES (?, ?, ?, ?, ?)",
+                (key, lat, lon, label, time.time())
+            )
+            self._connection().commit()
+
+    # Returns (lat, lon, label) or None. Raises the Nominatim error if the fallback is
+    # needed and fails, so the caller can show it to the user.
+    def geocode(self, query):
+        result = self.gazetteer.geocode(query)
+        if result is not None:
+            return result
+        # An ambiguous street prefix is left to the suggestions instead of Nominatim
+        if self.nominatim is None or self.gazetteer.ambiguous(query):
+            return None
+
+        key = normalize(query)
+        row = self._cached(key)
+        if row is not None:
+            # Negative results are cached too (lat is NULL), until negative_ttl has passed
+            return None if row[0] is None else tuple(row)
+
+        location = self.nominatim.geocode(query)
+        result = (location.latitude, location.longitude, location.address) if location else None
+        self._store(key, result)
+        return result
+
+    def suggest(self, query, limit=10):
+        return self.gazetteer.suggest(query, limit)
+
+
+print("[DEBUG] Loading address gazetteer...")
+_start_time = time.time()
+geocoder = Geocoder(Gazetteer.load(address_csv))
+print(f"[DEBUG] Loaded {len(geocoder.gazetteer)} addresses: {time.time() - _start_time:.2f} seconds")
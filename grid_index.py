@@ -0,0 +1,122 @@
+import time
+import numpy as np
+import geopandas as gpd
+from pyproj import Transformer
+from shapely import STRtree, points
+
+# Shared point -> grid cell resolver for all pages. The travel time matrix grid is a regular
+# 250 m lattice in EPSG:3067, so a point is mapped to its cell with integer arithmetic; cells
+# that are not full lattice squares (clipped at the edge of the study area) are resolved with
+# an STRtree over the polygons instead.
+gridfile = 'data/Helsinki_Travel_Time_Matrix_2023_grid.gpkg'
+cell_size = 250
+
+print("[DEBUG] Building grid index...")
+_start_time = time.time()
+_grid = gpd.read_file(gridfile)
+if _grid.crs is None or _grid.crs != 'EPSG:3067':
+    _grid = _grid.to_crs('EPSG:3067')
+_grid = _grid[_grid.is_valid].reset_index(drop=True)
+
+# Cell ids in grid order; position i in every per-origin vector refers to ids[i]
+ids = _grid['id'].to_numpy()
+position_of = {int(cell_id): i for i, cell_id in enumerate(ids)}
+_id_order = np.argsort(ids)
+_sorted_ids = ids[_id_order]
+
+_bounds = _grid.geometry.bounds
+_cell_centroids = _grid.geometry.centroid
+# Lattice origin snapped to the 250 m grid, so clipped edge cells do not shift it
+x0 = np.floor(_bounds['minx'].min() / cell_size) * cell_size
+y0 = np.floor(_bounds['miny'].min() / cell_size) * cell_size
+# Lattice column and row of every cell, in grid order
+cell_cols = np.floor((_cell_centroids.x.to_numpy() - x0) / cell_size).astype(int)
+cell_rows = np.floor((_cell_centroids.y.to_numpy() - y0) / cell_size).astype(int)
+_full_square = (
+    np.isclose(_bounds['maxx'] - _bounds['minx'], cell_size)
+    & np.isclose(_bounds['maxy'] - _bounds['miny'], cell_size)
+    & np.isclose(_grid.geometry.area, cell_size * cell_size)
+)
+
+# lattice[row, col] -> grid position, -1 where there is no full cell
+lattice = np.full((cell_rows.max() + 1, cell_cols.max() + 1), -1, dtype=np.int32)
+lattice[cell_rows[_full_square], cell_cols[_full_square]] = np.flatnonzero(_full_square)
+
+_tree = STRtree(_grid.geometry.values)
+_to_grid = Transformer.from_crs('EPSG:4326', 'EPSG:3067', always_xy=True)
+_to_wgs84 = Transformer.from_crs('EPSG:3067', 'EPSG:4326', always_xy=True)
+
+# Cell centroids in WGS84, in grid order
+centroid_lon, centroid_lat = _to_wgs84.transform(_cell_centroids.x.to_numpy(), _cell_centroids.y.to_numpy())
+print(f"[DEBUG] Built grid index ({len(ids)} cells, {int((~_full_square).sum())} edge cells): "
+      f"{time.time() - _start_time:.2f} seconds")
+
+
+# Grid positions for an array of cell ids, -1 for ids that are not in the grid
+def positions_of(cell_ids):
+    cell_ids = np.asarray(cell_ids, dtype=_sorted_ids.dtype)
+    found = np.searchsorted(_sorted_ids, cell_ids).clip(0, len(_sorted_ids) - 1)
+    return np.where(_sorted_ids[found] == cell_ids, _id_order[found], -1)
+
+
+# Grid positions for arrays of EPSG:3067 coordinates, -1 where no cell contains the point
+def positions_at_xy(xs, ys):
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    cols = np.floor((xs - x0) / cell_size).astype(int)
+    rows = np.floor((ys - y0) / cell_size).astype(int)
+    inside = (rows >= 0) & (rows < lattice.shape[0]) & (cols >= 0) & (cols < lattice.shape[1])
+    result = np.full(xs.shape, -1, dtype=np.int64)
+    result[inside] = lattice[rows[inside], cols[inside]]
+
+    # Edge cells and points outside the lattice go through the STRtree
+    missing = np.flatnonzero(result < 0)
+    if len(missing):
+        point_idx, cell_idx = _tree.query(points(xs[missing], ys[missing]), predicate='intersects')
+        # A point on a shared edge intersects two cells; keep the first hit
+        point_idx, first = np.unique(point_idx, return_index=True)
+        result[missing[point_idx]] = cell_idx[first]
+    return result
+
+
+# Grid positions for arrays of WGS84 coordinates
+def positions_at(lons, lats):
+    xs, ys = _to_grid.transform(np.asarray(lons, dtype=float), np.asarray(lats, dtype=float))
+    return positions_at_xy(xs, ys)
+
+
+# Cell id containing a WGS84 point, or None
+def cell_at(lon, lat):
+    position = positions_at([lon], [lat])[0]
+    return int(ids[position]) if position >= 0 else None
+
+
+# WGS84 centroid of a cell as a mapbox center dict, or None for unknown ids
+def cell_center(cell_id):
+    position = position_of.get(int(cell_id))
+    if position is None:
+        return None
+    return {'lat': float(centroid_lat[position]), 'lon': float(centroid_lon[position])}
+
+
+# Cell id for a map click. The cell marker traces carry their cell ids as customdata, so a click
+# on any of them selects that cell; clicks on overlays (borders, isochrone outlines) carry none
+# and are ignored rather than resolved to whatever cell lies under the line. Falls back to an id
+# in the hovertext, as in simulated clicks (address search).
+def clicked_cell_id(click_data):
+    if not click_data or not click_data.get('points'):
+        return None
+    point = click_data['points'][0]
+    cell_id = point.get('customdata', point.get('hovertext'))
+    if isinstance(cell_id, list):
+        cell_id = cell_id[0] if cell_id else None
+    try:
+        cell_id = int(cell_id)
+    except (TypeError, ValueError):
+        return None
+    return cell_id if cell_id in position_of else None
+
+
+# Transform EPSG:3067 coordinates to WGS84 (lon, lat)
+def to_wgs84(xs, ys):
+    return _to_wgs84.transform(xs, ys)
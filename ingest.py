@@ -0,0 +1,173 @@
+import argparse
+import hashlib
+import io
+import os
+import re
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# Builds data/full_csvs.db (FULL_CV) from the per-destination CSVs of the travel time
+# matrix. Files are read and parsed in a process pool; the main process writes them with bulk
+# inserts. A checksum per file is kept in the ingested_files table, so a re-run only
+# re-ingests files that changed (and drops the rows of files that were removed).
+#
+#   python ingest.py                      # incremental
+#   python ingest.py --force --workers 8  # re-ingest everything
+#   python ingest.py --transpose          # also rebuild FULL_CV_T afterwards
+csv_folder = 'data/Helsinki_Travel_Time_Matrix_2023'
+db_path = 'data/full_csvs.db'
+file_pattern = re.compile(r'_travel_times_to_(\d+)\.csv$')
+
+columns = ['walk_d', 'walk_avg', 'walk_slo', 'bike_avg', 'bike_fst', 'bike_slo',
+           'pt_r_avg', 'pt_r_slo', 'pt_m_avg', 'pt_m_slo', 'pt_n_avg', 'pt_n_slo',
+           'car_r', 'car_m', 'car_n']
+# Files written per transaction; checksums are committed together with their rows
+batch_files = 50
+# Parsed files waiting for the writer, per worker; bounds memory when SQLite falls behind
+files_in_flight_per_worker = 2
+
+
+def create_tables(conn):
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS FULL_CV (from_id INTEGER, to_id INTEGER, "
+        f"{', '.join(c + ' REAL' for c in columns)})"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS ingested_files "
+        "(file TEXT PRIMARY KEY, to_id INTEGER, checksum TEXT, rows INTEGER, ingested_at REAL)"
+    )
+
+
+# Worker: checksum one file and parse it unless the checksum is unchanged. Returns
+# (file name, to_id, checksum, rows as a float array or None when unchanged).
+def read_file(path, known_checksum):
+    data = Path(path).read_bytes()
+    checksum = hashlib.sha1(data).hexdigest()
+    to_id = int(file_pattern.search(path).group(1))
+    if checksum == known_checksum:
+        return os.path.basename(path), to_id, checksum, None
+    frame = pd.read_csv(io.BytesIO(data))
+    frame['to_id'] = to_id
+    # Columns missing from a file are stored as NULL (NaN binds as NULL in SQLite)
+    rows = frame.reindex(columns=['from_id', 'to_id'] + columns).to_numpy(dtype=np.float64)
+    return os.path.basename(path), to_id, checksum, rows
+
+
+def ingest(folder=csv_folder, path=db_path, workers=None, force=False):
+    start_time = time.time()
+    files = sorted(str(f) for f in Path(folder).glob('*_travel_times_to_*.csv') if file_pattern.search(f.name))
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous=OFF")
+    new_table = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'FULL_CV'"
+    ).fetchone() is None
+    if force and not new_table:
+        # Everything is re-ingested: start from an empty table instead of deleting every file's rows
+        conn.execute("DROP TABLE FULL_CV")
+        conn.execute("DROP TABLE IF EXISTS ingested_files")
+        conn.commit()
+        new_table = True
+    create_tables(conn)
+    known = {} if force else dict(conn.execute("SELECT file, checksum FROM ingested_files"))
+
+    # Rows of files that no longer exist
+    present = {os.path.basename(f) for f in files}
+    ingested_files = dict(conn.execute("SELECT file, to_id FROM ingested_files"))
+    removed = {name: to_id for name, to_id in ingested_files.items() if name not in present}
+    if removed:
+        _delete_destinations(conn, list(removed.values()))
+        conn.executemany("DELETE FROM ingested_files WHERE file = ?", [(name,) for name in removed])
+        conn.commit()
+        print(f"[DEBUG] Removed {len(removed)} files that are no longer in {folder}")
+
+    # A fresh table is loaded without the index, which is built once at the end
+    if new_table:
+        conn.execute("DROP INDEX IF EXISTS idx_from")
+
+    insert = f"INSERT INTO FULL_CV VALUES ({', '.join('?' * (len(columns) + 2))})"
+    ingested = unchanged = rows_written = 0
+    batch = []
+
+    def write(batch):
+        # Only files ingested before have rows to replace
+        _delete_destinations(conn, [to_id for name, to_id, _, _ in batch if name in ingested_files])
+        for name, to_id, checksum, rows in batch:
+            conn.executemany(insert, rows.tolist())
+            conn.execute("INSERT OR REPLACE INTO ingested_files VALUES (?, ?, ?, ?, ?)",
+                         (name, to_id, checksum, len(rows), time.time()))
+        conn.commit()
+
+    def parsed_files(executor):
+        # At most a few files per worker are parsed ahead of the writer
+        pending = deque()
+        for f in files:
+            pending.append(executor.submit(read_file, f, known.get(os.path.basename(f))))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    max_in_flight = (workers or os.cpu_count() or 1) * files_in_flight_per_worker
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for name, to_id, checksum, rows in parsed_files(executor):
+            if rows is None:
+                unchanged += 1
+                continue
+            batch.append((name, to_id, checksum, rows))
+            ingested += 1
+            rows_written += len(rows)
+            if len(batch) >= batch_files:
+                write(batch)
+                batch = []
+                elapsed = time.time() - start_time
+                print(f"[DEBUG] Ingested {ingested} files, {rows_written} rows ({rows_written / elapsed:.0f} rows/s)")
+    if batch:
+        write(batch)
+
+    if new_table or not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_from'").fetchone():
+        print("[DEBUG] Building index idx_from...")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_from on FULL_CV(from_id, to_id)")
+        conn.commit()
+    has_transposed = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'FULL_CV_T'").fetchone() is not None
+    conn.close()
+
+    elapsed = time.time() - start_time
+    print(f"[DEBUG] Ingested {ingested} files ({unchanged} unchanged), {rows_written} rows in "
+          f"{elapsed:.2f} seconds: {rows_written / elapsed if elapsed else 0:.0f} rows/s")
+    if ingested and has_transposed:
+        print("[DEBUG] FULL_CV_T is out of date, rebuild it with --transpose")
+    return {'files': ingested, 'unchanged': unchanged, 'rows': rows_written, 'seconds': round(elapsed, 2)}
+
+
+# Delete the rows of the given destinations, a few hundred per statement. Without an index
+# on to_id every statement would scan all of FULL_CV, so one is created on first use (only
+# incremental runs delete; fresh and --force loads do not).
+def _delete_destinations(conn, to_ids, chunk=500):
+    if not to_ids:
+        return
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_to on FULL_CV(to_id)")
+    for i in range(0, len(to_ids), chunk):
+        ids = to_ids[i:i + chunk]
+        conn.execute(f"DELETE FROM FULL_CV WHERE to_id IN ({', '.join('?' * len(ids))})", ids)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest the travel time CSVs into full_csvs.db.')
+    parser.add_argument('--csv-folder', default=csv_folder)
+    parser.add_argument('--db', default=db_path)
+    parser.add_argument('--workers', type=int, default=None, help='parser processes (default: CPU count)')
+    parser.add_argument('--force', action='store_true', help='re-ingest files even if unchanged')
+    parser.add_argument('--transpose', action='store_true', help='rebuild FULL_CV_T after ingesting')
+    args = parser.parse_args()
+
+    ingest(args.csv_folder, args.db, args.workers, args.force)
+    if args.transpose:
+        # matrix_store loads the grid index on import, so only import it when needed
+        import matrix_store
+        matrix_store.build_transposed(args.db)
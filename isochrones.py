@@ -0,0 +1,101 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from shapely import MultiLineString, MultiPolygon, Polygon, ops, transform
+import grid_index
+import matrix_store
+
+# Isochrone polygons built on the regular 250 m lattice: the reachable cells are rasterised
+# into a boolean grid, the edges between reachable and unreachable cells are extracted with
+# array comparisons and polygonized into outlines. Polygons are cached per
+# (cell, mode, direction, threshold band, year).
+cache_size = 256
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+# Default nested bands for a threshold: every 15 minutes up to and including the threshold
+def isochrone_bands(threshold):
+    return list(range(15, int(threshold), 15)) + [int(threshold)]
+
+
+# Outline of the True cells of a lattice mask as a (Multi)Polygon in EPSG:3067
+def polygonize_mask(mask):
+    padded = np.pad(mask, 1)
+    # Vertical edges between horizontally adjacent cells that differ, and horizontal edges
+    # between vertically adjacent ones; padded index i maps to lattice line i - 1
+    rows, cols = np.nonzero(padded[:, 1:] != padded[:, :-1])
+    xs = grid_index.x0 + cols * grid_index.cell_size
+    ys = grid_index.y0 + (rows - 1) * grid_index.cell_size
+    vertical = np.stack([np.stack([xs, ys], 1), np.stack([xs, ys + grid_index.cell_size], 1)], 1)
+    rows, cols = np.nonzero(padded[1:, :] != padded[:-1, :])
+    xs = grid_index.x0 + (cols - 1) * grid_index.cell_size
+    ys = grid_index.y0 + rows * grid_index.cell_size
+    horizontal = np.stack([np.stack([xs, ys], 1), np.stack([xs + grid_index.cell_size, ys], 1)], 1)
+
+    segments = np.concatenate([vertical, horizontal])
+    if len(segments) == 0:
+        return MultiPolygon()
+
+    # polygonize returns every face, including the holes; keep the faces over reachable cells
+    faces = []
+    for face in ops.polygonize(MultiLineString(list(segments))):
+        point = face.representative_point()
+        col = int((point.x - grid_index.x0) // grid_index.cell_size)
+        row = int((point.y - grid_index.y0) // grid_index.cell_size)
+        if 0 <= row < mask.shape[0] and 0 <= col < mask.shape[1] and mask[row, col]:
+            faces.append(face.simplify(0))
+    return MultiPolygon(faces)
+
+
+# Isochrones for a cell and mode as a list of (threshold, MultiPolygon in WGS84), one per
+# band, nested (each band contains the smaller ones). The travel time vector is binned once
+# and each missing band is polygonized from the cumulative mask.
+def isochrones(cell_id, column, bands, direction='from', vector=None, year=None):
+    bands = sorted(int(band) for band in bands)
+    keys = [(int(cell_id), column, direction, band, year) for band in bands]
+    with _lock:
+        cached = {key: _cache[key] for key in keys if key in _cache}
+        for key in cached:
+            _cache.move_to_end(key)
+    missing = [key for key in keys if key not in cached]
+
+    if missing:
+        if vector is None:
+            vector = matrix_store.store.vector(cell_id, column, direction, year)
+        reachable = ~np.isnan(vector)
+        # Band index of every cell: 0 for the first band, len(bands) for beyond the last
+        band_index = np.full(len(vector), len(bands))
+        band_index[reachable] = np.searchsorted(bands, vector[reachable], side='left')
+
+        for key in missing:
+            k = bands.index(key[3])
+            mask = np.zeros(grid_index.lattice.shape, dtype=bool)
+            inside = band_index <= k
+            mask[grid_index.cell_rows[inside], grid_index.cell_cols[inside]] = True
+            polygon = transform(polygonize_mask(mask), lambda coords: np.column_stack(
+                grid_index.to_wgs84(coords[:, 0], coords[:, 1])))
+            cached[key] = polygon
+            with _lock:
+                _cache[key] = polygon
+                while len(_cache) > cache_size:
+                    _cache.popitem(last=False)
+
+    return [(key[3], cached[key]) for key in keys]
+
+
+# Lon/lat lists of a polygon's rings for plotting, exteriors and holes separately, with rings
+# separated by None
+def polygon_coords(geometry):
+    exteriors = ([], [])
+    holes = ([], [])
+    polygons = geometry.geoms if isinstance(geometry, MultiPolygon) else [geometry]
+    for polygon in polygons:
+        if not isinstance(polygon, Polygon) or polygon.is_empty:
+            continue
+        for target, rings in ((exteriors, [polygon.exterior]), (holes, polygon.interiors)):
+            for ring in rings:
+                lons, lats = ring.xy
+                target[0].extend(list(lons) + [None])
+                target[1].extend(list(lats) + [None])
+    return exteriors, holes
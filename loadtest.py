@@ -0,0 +1,236 @@
+import argparse
+import csv
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+import numpy as np
+import requests
+from benchmark import matrix_payload, address_payload, compare_payload, ab_payload, run_background
+
+# Load generator for the app: simulated users click through the three pages by posting to
+# Dash's /_dash-update-component endpoint, like the browser does. Every action is timed
+# and reported per callback with throughput and latency percentiles.
+#
+#   python synthetic_data.py --out data --origins 500
+#   python loadtest.py --start --users 1,5,10,20 --duration 30
+#   python loadtest.py --url http://myserver:8050 --users 10
+#
+# --start launches main.py from the current folder (with its data/) and stops it afterwards.
+# With a comma separated list of user counts the steps run one after another, which shows
+# where p95 latency passes --target-p95 (1 s by default).
+default_url = 'http://127.0.0.1:8050'
+db_path = 'data/full_csvs.db'
+modes = ['walk_avg', 'walk_slo', 'bike_avg', 'bike_fst', 'bike_slo',
+         'pt_r_avg', 'pt_r_slo', 'pt_m_avg', 'pt_m_slo', 'pt_n_avg', 'pt_n_slo',
+         'car_r', 'car_m', 'car_n']
+
+
+# Origin ids present in the matrix, so the simulated clicks hit real rows
+def load_origins(db_path=db_path):
+    conn = sqlite3.connect(db_path)
+    origins = [row[0] for row in conn.execute("SELECT DISTINCT from_id FROM FULL_CV")]
+    conn.close()
+    return origins
+
+
+# Addresses for the search action, taken from the geocoder's gazetteer
+def load_addresses(path='data/addresses.csv', limit=500):
+    if not os.path.exists(path):
+        return []
+    with open(path, newline='', encoding='utf-8') as f:
+        return [f"{row['street']} {row.get('number', '')}".strip() for _, row in zip(range(limit), csv.DictReader(f))]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, ok):
+        with self._lock:
+            self.samples[name].append(seconds)
+            if not ok:
+                self.errors[name] += 1
+
+    def report(self, elapsed):
+        report = {}
+        for name in sorted(self.samples):
+            samples = np.asarray(self.samples[name]) * 1000
+            report[name] = {
+                'requests': len(samples),
+                'errors': self.errors[name],
+                'per_second': round(len(samples) / elapsed, 2),
+                'p50_ms': round(float(np.percentile(samples, 50)), 1),
+                'p95_ms': round(float(np.percentile(samples, 95)), 1),
+                'p99_ms': round(float(np.percentile(samples, 99)), 1),
+            }
+        return report
+
+
+# One simulated user: picks a page and runs a short, randomised session on it until the
+# deadline, pausing for think time between actions
+class User:
+    def __init__(self, url, origins, addresses, recorder, think, seed):
+        self.url = url
+        self.origins = origins
+        self.addresses = addresses
+        self.recorder = recorder
+        self.think = think
+        self.rng = random.Random(seed)
+        self.http = requests.Session()
+        # Sent like the browser's per-tab id, so the server coalesces this user's requests
+        self.tab = f"loadtest-{seed}"
+
+    def post(self, name, payload):
+        start_time = time.perf_counter()
+        try:
+            response = self.http.post(f"{self.url}/_dash-update-component", json=dict(payload, tab=self.tab),
+                                      timeout=60)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            response, ok = None, False
+        self.recorder.record(name, time.perf_counter() - start_time, ok)
+        return response.json() if ok else None
+
+    # A background callback, timed from the first request until its result is fetched
+    def post_background(self, name, payload):
+        def post(payload, params):
+            response = self.http.post(f"{self.url}/_dash-update-component", json=payload, params=params, timeout=60)
+            response.raise_for_status()
+            return response.status_code, response.json() if response.content else None
+
+        start_time = time.perf_counter()
+        try:
+            result, ok = run_background(post, payload), True
+        except (requests.RequestException, TimeoutError):
+            result, ok = None, False
+        self.recorder.record(name, time.perf_counter() - start_time, ok)
+        return result
+
+    def pause(self):
+        if self.think > 0:
+            time.sleep(self.rng.expovariate(1 / self.think))
+
+    def run(self, deadline):
+        sessions = [self.matrix_session, self.compare_session, self.ab_session]
+        while time.time() < deadline:
+            self.rng.choice(sessions)(deadline)
+
+    # Click an origin, drag the slider, switch mode, sometimes search an address
+    def matrix_session(self, deadline):
+        cell_id = self.rng.choice(self.origins)
+        mode = self.rng.choice(modes)
+        threshold = self.rng.choice(range(10, 61, 5))
+        self.post('matrix:click_origin', matrix_payload(cell_id, mode, threshold))
+        for _ in range(self.rng.randint(1, 4)):
+            if time.time() >= deadline:
+                return
+            self.pause()
+            threshold = min(120, max(5, threshold + self.rng.choice((-10, -5, 5, 10))))
+            self.post('matrix:drag_slider', matrix_payload(cell_id, mode, threshold))
+        self.pause()
+        self.post('matrix:switch_mode', matrix_payload(cell_id, self.rng.choice(modes), threshold))
+        if self.addresses and self.rng.random() < 0.3:
+            self.pause()
+            self.post_background('matrix:search_address', address_payload(self.rng.choice(self.addresses)))
+
+    # Click an origin with a few modes, then change the mode selection
+    def compare_session(self, deadline):
+        cell_id = self.rng.choice(self.origins)
+        threshold = self.rng.choice(range(10, 61, 5))
+        self.post('compare:click_origin', compare_payload(cell_id, self.rng.sample(modes, 3), threshold))
+        self.pause()
+        self.post('compare:switch_modes', compare_payload(cell_id, self.rng.sample(modes, 3), threshold))
+
+    # Click A-B pairs with the session state returned by the previous click
+    def ab_session(self, deadline):
+        state = None
+        for _ in range(self.rng.randint(1, 3)):
+            if time.time() >= deadline:
+                return
+            for name in ('ab:click_a', 'ab:click_b'):
+                result = self.post(name, ab_payload(self.rng.choice(self.origins), state))
+                if result is not None:
+                    state = result['response']['ab-state']['data']
+                self.pause()
+
+
+def run_step(url, users, duration, origins, addresses, think, seed=0):
+    recorder = Recorder()
+    deadline = time.time() + duration
+    threads = [
+        threading.Thread(target=User(url, origins, addresses, recorder, think, seed + i).run, args=(deadline,))
+        for i in range(users)
+    ]
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder.report(time.time() - start_time)
+
+
+def print_report(users, report):
+    total = sum(stats['requests'] for stats in report.values())
+    print(f"\n{users} users, {total} requests")
+    print(f"{'callback':26s} {'req':>6s} {'err':>5s} {'req/s':>7s} {'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s}")
+    for name, stats in report.items():
+        print(f"{name:26s} {stats['requests']:6d} {stats['errors']:5d} {stats['per_second']:7.2f} "
+              f"{stats['p50_ms']:8.1f} {stats['p95_ms']:8.1f} {stats['p99_ms']:8.1f}")
+
+
+# Start main.py from the current folder and wait until it answers
+def start_server(url, timeout=300):
+    env = dict(os.environ, TTM_WARMUP_TOP_N='0')
+    server = subprocess.Popen([sys.executable, str(Path(__file__).parent / 'main.py')], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("The app exited during startup")
+        try:
+            requests.get(url, timeout=1)
+            return server
+        except requests.RequestException:
+            time.sleep(1)
+    server.terminate()
+    raise RuntimeError("The app did not start in time")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the travel time matrix app.')
+    parser.add_argument('--url', default=default_url)
+    parser.add_argument('--start', action='store_true', help='start main.py locally for the test')
+    parser.add_argument('--users', default='10', help='concurrent users, or a comma separated list of steps')
+    parser.add_argument('--duration', type=float, default=30, help='seconds per step')
+    parser.add_argument('--think', type=float, default=0.5, help='mean think time between actions in seconds')
+    parser.add_argument('--target-p95', type=float, default=1000, help='p95 latency target in ms')
+    parser.add_argument('--out', help='write the per-step reports to this JSON file')
+    args = parser.parse_args()
+
+    origins = load_origins()
+    addresses = load_addresses()
+    server = start_server(args.url) if args.start else None
+    steps = {}
+    try:
+        for users in [int(u) for u in args.users.split(',')]:
+            report = run_step(args.url, users, args.duration, origins, addresses, args.think)
+            steps[users] = report
+            print_report(users, report)
+            worst = max((stats['p95_ms'] for stats in report.values()), default=0)
+            if worst > args.target_p95:
+                print(f"p95 latency {worst:.0f} ms is above the {args.target_p95:.0f} ms target at {users} users")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    if args.out:
+        Path(args.out).write_text(json.dumps(steps, indent=2))
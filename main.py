@@ -2,11 +2,25 @@ from dash import dcc, html
 from dash.dependencies import Input, Output
 from app import app  # Import the Dash instance from app.py
 import dash_bootstrap_components as dbc
-from flask import send_from_directory
+from flask import send_from_directory, jsonify, request, g, Response
+from result_cache import result_cache
+from metrics import metrics
+import coalesce
+from coalesce import coalescer
+import memory_profile
+import os
+import functools
+import json
+import hmac
+import matrix_store
+import time
+from warmup import warm_up, warmup_top_n
+import threading
 # Import the independent app layouts
 from pages.Matrix import scatterplot_layout, download_folder, csv_folder
 from pages.AB_Mapper import toast_map_layout
 from pages.compare import compare_layout  # Import the new compare page layout
+from pages.zones import zones_layout
 
 app.index_string = """
 <!DOCTYPE html>
@@ -51,6 +65,178 @@ def serve_file(filename):
 
 
 
+# Hit rates of the callback result cache
+@app.server.route('/stats/cache')
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+
+# Time Dash callback requests per output, so slow callbacks show up in /metrics
+@app.server.before_request
+def start_callback_timer():
+    if request.path == '/_dash-update-component':
+        g.callback_start = time.perf_counter()
+
+
+@app.server.after_request
+def record_callback_time(response):
+    if 'callback_start' in g:
+        payload = request.get_json(silent=True) or {}
+        output = payload.get('output', 'unknown')
+        metrics.observe('ttm_callback_seconds', time.perf_counter() - g.callback_start, output=output)
+        metrics.increment('ttm_callback_total', output=output, status=response.status_code)
+    return response
+
+
+# Requests per page instance and output are coalesced, and identical concurrent requests share
+# one computation (see coalesce.py). Each page load picks a random tab id that the renderer adds
+# to every callback request; background callbacks, which poll with the same output, are left
+# alone.
+app.renderer = """
+var ttmTab = (window.crypto && crypto.randomUUID) ? crypto.randomUUID()
+    : Date.now().toString(36) + Math.random().toString(36).slice(2);
+var renderer = new DashRenderer({
+    request_pre: function(payload) { payload.tab = ttmTab; }
+});
+"""
+
+
+@app.server.before_request
+def coalesce_callback():
+    if not coalesce.enabled or request.path != '/_dash-update-component' or request.args.get('cacheKey'):
+        return None
+    payload = request.get_json(silent=True) or {}
+    output = payload.get('output')
+    callback = app.callback_map.get(output)
+    if callback is None or callback.get('long'):
+        return None
+
+    tab_id = payload.pop('tab', None)
+    if tab_id:
+        key = (str(tab_id), output)
+        generation, acquired = coalescer.enter(key)
+        g.coalesce_slot = (key, generation, acquired)
+        if coalescer.is_stale(key, generation):
+            # A newer request for this output arrived while this one was waiting
+            coalescer.count('dropped')
+            metrics.increment('ttm_coalesced_total', output=output, kind='dropped')
+            return Response(status=204)
+
+    # Identical requests from different tabs share the result
+    flight, leader = coalescer.join(json.dumps(payload, sort_keys=True).encode())
+    if leader:
+        g.coalesce_flight = flight
+        return None
+    shared = coalescer.wait(flight)
+    if shared is None:
+        # The leader failed or is too slow: compute it here
+        return None
+    coalescer.count('shared')
+    metrics.increment('ttm_coalesced_total', output=output, kind='shared')
+    body, status, mimetype = shared
+    return Response(body, status=status, mimetype=mimetype)
+
+
+@app.server.after_request
+def finish_coalesced_callback(response):
+    flight = g.pop('coalesce_flight', None)
+    if flight is not None:
+        coalescer.land(flight, (response.get_data(), response.status_code, response.mimetype)
+                       if response.status_code == 200 else None)
+    slot = g.get('coalesce_slot')
+    if slot is not None and response.status_code == 200 and coalescer.is_stale(slot[0], slot[1]):
+        # Outdated by the time it finished: don't send the result
+        coalescer.count('discarded')
+        metrics.increment('ttm_coalesced_total', output=slot[0][1], kind='discarded')
+        response = Response(status=204)
+    return response
+
+
+@app.server.teardown_request
+def release_coalesce_slot(exc):
+    flight = g.pop('coalesce_flight', None)
+    if flight is not None:
+        coalescer.land(flight)
+    slot = g.pop('coalesce_slot', None)
+    if slot is not None:
+        coalescer.leave(slot[0], slot[2])
+
+
+# Counters of the request coalescing
+@app.server.route('/stats/coalesce')
+def coalesce_stats():
+    return jsonify(coalescer.stats())
+
+
+# Latency histograms and counters in Prometheus text format
+@app.server.route('/metrics')
+def prometheus_metrics():
+    cache_stats = result_cache.stats()
+    gauges = {
+        'ttm_result_cache_entries': {(): cache_stats['entries']},
+        'ttm_result_cache_bytes': {(): cache_stats['bytes']},
+        'ttm_result_cache_hits': {(('page', page),): s['hits'] for page, s in cache_stats['pages'].items()},
+        'ttm_result_cache_misses': {(('page', page),): s['misses'] for page, s in cache_stats['pages'].items()},
+        'ttm_origin_row_cache_hits': {(): matrix_store.store.hits},
+        'ttm_origin_row_cache_misses': {(): matrix_store.store.misses},
+    }
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+# Admin routes need the X-Admin-Token header to match TTM_ADMIN_TOKEN. Without a token set
+# they are disabled: behind the nginx proxy every request comes from 127.0.0.1, so the
+# address cannot tell the server itself from the outside.
+admin_token = os.environ.get('TTM_ADMIN_TOKEN')
+
+
+def admin_only(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not admin_token or not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), admin_token):
+            return "Forbidden", 403
+        return func(*args, **kwargs)
+    return wrapper
+
+
+# Memory held by each loaded dataset and cache, and process RSS
+@app.server.route('/admin/memory')
+@admin_only
+def memory_stats():
+    return jsonify(memory_profile.memory_report())
+
+
+# Start tracemalloc and take a baseline snapshot; GET /admin/memory/diff shows the growth since
+# and stops tracing
+@app.server.route('/admin/memory/snapshot', methods=['POST'])
+@admin_only
+def memory_snapshot():
+    memory_profile.take_baseline()
+    return jsonify({'tracing': True})
+
+
+@app.server.route('/admin/memory/diff')
+@admin_only
+def memory_diff():
+    diff = memory_profile.baseline_diff(int(request.args.get('top', 25)))
+    if diff is None:
+        return "No baseline snapshot, POST /admin/memory/snapshot first.", 400
+    return jsonify(diff)
+
+
+# Run one Dash callback (the request body is a /_dash-update-component payload) with
+# tracemalloc snapshots around it and return the allocation diff
+@app.server.route('/admin/memory/callback', methods=['POST'])
+@admin_only
+def memory_callback():
+    payload = request.get_json(silent=True)
+    if not payload:
+        return "Expected a /_dash-update-component JSON payload.", 400
+    client = app.server.test_client()
+    response, diff, peak = memory_profile.profile_call(
+        lambda: client.post('/_dash-update-component', json=payload),
+        int(request.args.get('top', 25))
+    )
+    return jsonify({'status': response.status_code, 'peak_mb': round(peak / 1024 / 1024, 2), 'allocations': diff})
 
 
 # Define the main layout with URL-based navigation
@@ -70,6 +256,8 @@ def display_page(pathname):
         return toast_map_layout
     elif pathname == '/compare':
         return compare_layout  # Add the new page
+    elif pathname == '/zones':
+        return zones_layout
     else:
         # Return the custom home page layout
         return html.Div([
@@ -113,7 +301,13 @@ def display_page(pathname):
                         width=4
                     ),
                 ],
-                style={"marginBottom": "40px"}
+                style={"marginBottom": "20px"}
+            ),
+
+            # Precomputed travel times between municipalities and areas
+            html.Div(
+                html.A("Go to Zonal OD Matrix (travel times between municipalities and areas)", href="/zones"),
+                style={"textAlign": "center", "marginBottom": "40px"}
             ),
 
             # Static text box
@@ -157,4 +351,7 @@ def display_page(pathname):
 
 # Run the app
 if __name__ == '__main__':
+    # Prefill the caches from the access log while the server starts listening
+    if warmup_top_n > 0:
+        threading.Thread(target=warm_up, daemon=True).start()
     app.run_server(host="0.0.0.0", port=8050)
@@ -0,0 +1,366 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+import numpy as np
+import grid_index
+
+# Shared read access to the travel time matrix (FULL_CV) for all pages. Origin rows are
+# returned as dense float32 arrays aligned with grid_index.ids, with NaN for unreachable or
+# missing pairs, so callers can work on whole vectors instead of id lists.
+db_path = 'data/full_csvs.db'
+
+modes = ['walk_avg', 'walk_slo', 'bike_avg', 'bike_fst', 'bike_slo',
+         'pt_r_avg', 'pt_r_slo', 'pt_m_avg', 'pt_m_slo', 'pt_n_avg', 'pt_n_slo',
+         'car_r', 'car_m', 'car_n']
+columns = ['walk_d'] + modes
+column_index = {column: i for i, column in enumerate(columns)}
+
+# Year of the matrix in FULL_CV. Other years are stored in FULL_CV_DELTA as zlib-compressed
+# int32 deltas against it, one blob per (year, direction, cell) holding all columns in grid
+# order: delta = value - base (base NaN counted as 0), and unreachable_delta where the pair
+# has no route that year. Most pairs change little between years, so the blobs are a
+# fraction of a full copy, and year-over-year differences are read from the deltas directly.
+# All years share the grid in grid_index.
+base_year = int(os.environ.get('TTM_BASE_YEAR', 2023))
+unreachable_delta = np.iinfo(np.int32).min
+
+
+# Replace the matrix's negative "no route" markers and NULLs with NaN
+def _clean(values):
+    values = np.asarray(values, dtype=np.float32)
+    values[values < 0] = np.nan
+    return values
+
+
+# Row of another year from the base row and its delta; all NaN without a delta
+def _apply_delta(row, delta):
+    if delta is None:
+        return np.full((len(columns), len(grid_index.ids)), np.nan, dtype=np.float32)
+    row = np.nan_to_num(row) + delta.astype(np.float32)
+    row[delta == unreachable_delta] = np.nan
+    return row
+
+
+class MatrixStore:
+    def __init__(self, path, cache_size=64):
+        self.path = path
+        self.cache_size = cache_size
+        self._local = threading.local()
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+        self._has_transposed = None
+        self._years = None
+        # Optional chunk_store.ChunkStore serving origin rows instead of FULL_CV
+        self.chunks = None
+        self.hits = 0
+        self.misses = 0
+
+    # One connection per thread, reused across callbacks
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        # Background callback processes are forked from the server and open their own
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    # All columns for one origin as a (len(columns), n_cells) array over destinations
+    def origin_row(self, from_id, year=None):
+        return self._row('from', from_id, year)
+
+    # All columns for one destination as a (len(columns), n_cells) array over origins. Read
+    # from the destination-major copy FULL_CV_T when it exists (see build_transposed), which
+    # makes catchment queries as cheap as reachability queries.
+    def destination_row(self, to_id, year=None):
+        return self._row('to', to_id, year)
+
+    # Available years, base year first
+    def years(self):
+        if self._years is None:
+            conn = self.connection()
+            years = []
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'FULL_CV_DELTA'").fetchone():
+                years = [row[0] for row in conn.execute("SELECT DISTINCT year FROM FULL_CV_DELTA ORDER BY year")]
+            self._years = [base_year] + [year for year in years if year != base_year]
+        return self._years
+
+    def has_transposed(self):
+        if self._has_transposed is None:
+            self._has_transposed = self.connection().execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'FULL_CV_T'"
+            ).fetchone() is not None
+            if not self._has_transposed:
+                print("[DEBUG] FULL_CV_T not found, catchment queries scan FULL_CV by to_id. "
+                      "Run 'python matrix_store.py transpose' to build it.")
+        return self._has_transposed
+
+    # Drop all cached rows and chunk blocks (benchmarks use this to time cold lookups)
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+        if self.chunks is not None:
+            self.chunks.clear()
+
+    # LRU cached row lookup in either direction. Origin rows from the chunk store are not kept
+    # here: its LRU holds the quantized blocks, and decoding a row from them is cheap, so
+    # caching the float32 rows too would undo its memory savings.
+    def _row(self, direction, cell_id, year=None):
+        if year is not None and int(year) != base_year:
+            return self._year_row(direction, cell_id, int(year))
+        if direction == 'from' and self.chunks is not None:
+            return self.chunks.origin_row(int(cell_id))
+        key = (direction, int(cell_id))
+        with self._lock:
+            row = self._rows.get(key)
+            if row is not None:
+                self._rows.move_to_end(key)
+                self.hits += 1
+                return row
+            self.misses += 1
+
+        row = self._fetch(direction, key[1])
+
+        with self._lock:
+            self._rows[key] = row
+            while len(self._rows) > self.cache_size:
+                self._rows.popitem(last=False)
+        return row
+
+    def _fetch(self, direction, cell_id):
+        if direction == 'from':
+            query = f"SELECT to_id, {', '.join(columns)} FROM FULL_CV WHERE from_id = ?"
+        elif self.has_transposed():
+            query = f"SELECT from_id, {', '.join(columns)} FROM FULL_CV_T WHERE to_id = ?"
+        else:
+            query = f"SELECT from_id, {', '.join(columns)} FROM FULL_CV WHERE to_id = ?"
+        return self._scatter(self.connection().execute(query, (cell_id,)).fetchall())
+
+    # Row for a year other than the base year: base row plus the stored delta
+    def _year_row(self, direction, cell_id, year):
+        key = (direction, int(cell_id), year)
+        with self._lock:
+            row = self._rows.get(key)
+            if row is not None:
+                self._rows.move_to_end(key)
+                self.hits += 1
+                return row
+            self.misses += 1
+
+        delta = self.delta(direction, cell_id, year)
+        row = _apply_delta(self._row(direction, cell_id) if delta is not None else None, delta)
+
+        with self._lock:
+            self._rows[key] = row
+            while len(self._rows) > self.cache_size:
+                self._rows.popitem(last=False)
+        return row
+
+    # Origin row read from FULL_CV even when the chunk store is enabled, for single-pair lookups
+    # that show exact values (chunk rows are quantized: times saturate at the dtype's maximum and
+    # walk_d is rounded). Not cached.
+    def exact_origin_row(self, from_id, year=None):
+        row = self._fetch('from', int(from_id))
+        if year is None or int(year) == base_year:
+            return row
+        delta = self.delta('from', from_id, int(year))
+        return _apply_delta(row if delta is not None else None, delta)
+
+    # Decoded (len(columns), n_cells) int32 delta of a cell for a year, None if not stored
+    def delta(self, direction, cell_id, year):
+        record = self.connection().execute(
+            "SELECT delta FROM FULL_CV_DELTA WHERE year = ? AND direction = ? AND cell_id = ?",
+            (int(year), direction, int(cell_id))
+        ).fetchone() if year in self.years() else None
+        if record is None:
+            return None
+        return np.frombuffer(zlib.decompress(record[0]), dtype=np.int32).reshape(len(columns), -1)
+
+    # Year-over-year change of one column for a cell: values of year_b minus year_a, NaN where
+    # either year has no route, and the masks of the cells without a route in year_a and in
+    # year_b. Read from the deltas, so only the base row is needed (for its unreachable
+    # pairs) when one of the years is the base year.
+    def year_change(self, cell_id, column, year_a, year_b, direction='from'):
+        i = column_index[column]
+        parts = []
+        for year in (int(year_a), int(year_b)):
+            if year == base_year:
+                base = self._row(direction, cell_id)[i]
+                parts.append((np.zeros(len(base), dtype=np.float32), np.isnan(base)))
+                continue
+            delta = self.delta(direction, cell_id, year)
+            if delta is None:
+                n = len(grid_index.ids)
+                parts.append((np.zeros(n, dtype=np.float32), np.ones(n, dtype=bool)))
+            else:
+                parts.append((delta[i].astype(np.float32), delta[i] == unreachable_delta))
+        (a, missing_a), (b, missing_b) = parts
+        change = b - a
+        change[missing_a | missing_b] = np.nan
+        return change, missing_a, missing_b
+
+    # Rows for several origins stacked as a (n_origins, len(columns), n_cells) array. Origins
+    # that are not cached are fetched together with one IN query.
+    def origin_rows(self, from_ids, year=None):
+        from_ids = [int(i) for i in from_ids]
+        if (year is not None and int(year) != base_year) or self.chunks is not None:
+            return np.stack([self.origin_row(i, year) for i in from_ids])
+        with self._lock:
+            missing = [i for i in dict.fromkeys(from_ids) if ('from', i) not in self._rows]
+        if missing:
+            records = self.connection().execute(
+                f"SELECT from_id, to_id, {', '.join(columns)} FROM FULL_CV "
+                f"WHERE from_id IN ({', '.join('?' * len(missing))}) ORDER BY from_id",
+                missing
+            ).fetchall()
+            by_origin = {i: [] for i in missing}
+            for record in records:
+                by_origin[record[0]].append(record[1:])
+            with self._lock:
+                for from_id, origin_records in by_origin.items():
+                    self._rows[('from', from_id)] = self._scatter(origin_records)
+                    self.misses += 1
+                # Keep every requested row even if that briefly exceeds the cache size
+                while len(self._rows) > max(self.cache_size, len(from_ids)):
+                    self._rows.popitem(last=False)
+        return np.stack([self.origin_row(i) for i in from_ids])
+
+    # Place (cell_id, values...) records at their grid positions
+    def _scatter(self, records):
+        row = np.full((len(columns), len(grid_index.ids)), np.nan, dtype=np.float32)
+        if not records:
+            return row
+        data = np.array(records, dtype=np.float64)
+        positions = grid_index.positions_of(data[:, 0].astype(np.int64))
+        known = positions >= 0
+        row[:, positions[known]] = _clean(data[known, 1:]).T
+        return row
+
+    # One column of an origin row
+    def origin_vector(self, from_id, column, year=None):
+        return self.origin_row(from_id, year)[column_index[column]]
+
+    # One column of a destination row
+    def destination_vector(self, to_id, column, year=None):
+        return self.destination_row(to_id, year)[column_index[column]]
+
+    # Travel time vector for a cell in either direction: 'from' gives times from the cell to
+    # every destination, 'to' gives times from every origin to the cell
+    def vector(self, cell_id, column, direction='from', year=None):
+        if direction == 'to':
+            return self.destination_vector(cell_id, column, year)
+        return self.origin_vector(cell_id, column, year)
+
+    # Many-to-many lookup: all columns for each (from_id, to_id) pair as a
+    # (n_pairs, len(columns)) array, NaN where the pair is not in the matrix. The pairs are
+    # loaded into a temporary table and answered with a single join, so the cost does not
+    # depend on how the pairs are spread over origins.
+    def pairs(self, from_ids, to_ids):
+        from_ids = np.asarray(from_ids, dtype=np.int64)
+        to_ids = np.asarray(to_ids, dtype=np.int64)
+        result = np.full((len(from_ids), len(columns)), np.nan, dtype=np.float32)
+        if len(from_ids) == 0:
+            return result
+
+        conn = self.connection()
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS od_pairs (idx INTEGER, from_id INTEGER, to_id INTEGER)")
+        conn.execute("DELETE FROM od_pairs")
+        conn.executemany(
+            "INSERT INTO od_pairs VALUES (?, ?, ?)",
+            zip(range(len(from_ids)), from_ids.tolist(), to_ids.tolist())
+        )
+        records = conn.execute(
+            f"SELECT p.idx, {', '.join('m.' + c for c in columns)} FROM od_pairs p "
+            "JOIN FULL_CV m ON m.from_id = p.from_id AND m.to_id = p.to_id"
+        ).fetchall()
+        conn.execute("DELETE FROM od_pairs")
+        conn.commit()
+
+        if records:
+            data = np.array(records, dtype=np.float64)
+            result[data[:, 0].astype(np.int64)] = _clean(data[:, 1:])
+        return result
+
+
+# Build the destination-major copy of the matrix. FULL_CV_T is clustered on (to_id, from_id)
+# (WITHOUT ROWID), so all rows for one destination are stored together, the same way
+# FULL_CV's from_id lookups read one origin.
+def build_transposed(path=db_path):
+    print("[DEBUG] Building destination-major table FULL_CV_T...")
+    start_time = time.time()
+    conn = sqlite3.connect(path)
+    conn.execute("DROP TABLE IF EXISTS FULL_CV_T")
+    conn.execute(
+        "CREATE TABLE FULL_CV_T (to_id INTEGER, from_id INTEGER, "
+        f"{', '.join(c + ' REAL' for c in columns)}, PRIMARY KEY (to_id, from_id)) WITHOUT ROWID"
+    )
+    conn.execute(
+        f"INSERT INTO FULL_CV_T SELECT to_id, from_id, {', '.join(columns)} FROM FULL_CV ORDER BY to_id, from_id"
+    )
+    conn.commit()
+    rows = conn.execute("SELECT COUNT(*) FROM FULL_CV_T").fetchone()[0]
+    conn.close()
+    print(f"[DEBUG] Built FULL_CV_T with {rows} rows: {time.time() - start_time:.2f} seconds")
+
+
+# Add another year of the matrix as deltas against the base year. source_path is a database
+# with that year's FULL_CV (e.g. built with 'python ingest.py --db data/full_csvs_2018.db
+# --csv-folder ...'). Destination deltas are also written when the base database has
+# FULL_CV_T, so catchment queries work for the new year; the source then needs FULL_CV_T too,
+# or those rows are read with scans of its FULL_CV.
+def add_year(year, source_path, path=db_path, level=6):
+    print(f"[DEBUG] Adding year {year} from {source_path}...")
+    start_time = time.time()
+    base = MatrixStore(path, cache_size=1)
+    source = MatrixStore(source_path, cache_size=1)
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS FULL_CV_DELTA (year INTEGER, direction TEXT, cell_id INTEGER, "
+        "delta BLOB, PRIMARY KEY (year, direction, cell_id)) WITHOUT ROWID"
+    )
+    conn.execute("DELETE FROM FULL_CV_DELTA WHERE year = ?", (int(year),))
+
+    directions = ['from', 'to'] if base.has_transposed() else ['from']
+    raw_bytes = stored_bytes = 0
+    for direction in directions:
+        for n, cell_id in enumerate(grid_index.ids.tolist(), 1):
+            values = source._row(direction, cell_id)
+            if np.isnan(values).all():
+                continue
+            delta = np.rint(values - np.nan_to_num(base._row(direction, cell_id)))
+            delta = np.where(np.isnan(values), unreachable_delta, delta).astype(np.int32)
+            blob = zlib.compress(delta.tobytes(), level)
+            conn.execute("INSERT INTO FULL_CV_DELTA VALUES (?, ?, ?, ?)", (int(year), direction, cell_id, blob))
+            raw_bytes += delta.nbytes
+            stored_bytes += len(blob)
+            if n % 1000 == 0:
+                conn.commit()
+                print(f"[DEBUG] {direction}: {n}/{len(grid_index.ids)} cells")
+    conn.commit()
+    conn.close()
+    print(f"[DEBUG] Added year {year}: {stored_bytes / 1024 / 1024:.1f} MB of deltas "
+          f"({raw_bytes / max(stored_bytes, 1):.1f}x smaller than int32 rows): {time.time() - start_time:.2f} seconds")
+
+
+store = MatrixStore(db_path)
+
+# Serve origin rows from the compressed chunk file when TTM_MATRIX_CHUNKS is set (see
+# chunk_store.py); FULL_CV is still used for catchments and single pairs
+if os.environ.get('TTM_MATRIX_CHUNKS'):
+    import chunk_store
+    store.chunks = chunk_store.ChunkStore(os.environ['TTM_MATRIX_CHUNKS'])
+    print(f"[DEBUG] Reading origin rows from {store.chunks.path} ({store.chunks.codec})")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'transpose':
+        build_transposed(sys.argv[2] if len(sys.argv) > 2 else db_path)
+    elif len(sys.argv) > 3 and sys.argv[1] == 'add-year':
+        add_year(int(sys.argv[2]), sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else db_path)
+    else:
+        print("Usage: python matrix_store.py transpose [db_path]\n"
+              "       python matrix_store.py add-year YEAR SOURCE_DB [db_path]")
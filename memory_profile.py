@@ -0,0 +1,219 @@
+import linecache
+import os
+import sys
+import tracemalloc
+import types
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+# Memory accounting for the admin endpoints in main.py: approximate deep sizes of the
+# datasets the modules keep at module level and of the in-process caches, process RSS, and
+# tracemalloc snapshot diffs (also around a single callback) to find allocation-heavy paths.
+# Sizes are estimates: numpy and pandas report their buffers exactly, shapely geometries are
+# counted from their coordinates, and plain Python containers are walked recursively.
+
+# Modules whose module-level data is reported
+dataset_modules = ['pages.Matrix', 'pages.compare', 'pages.AB_Mapper', 'grid_index', 'geocoder',
+                   'matrix_store', 'isochrones']
+# Module-level values smaller than this are left out of the dataset report
+min_report_bytes = 64 * 1024
+# Approximate size of one GEOS geometry apart from its coordinates
+geometry_overhead = 100
+
+# Module-level values that count as datasets; anything else (the app, layouts, stores) is not
+# walked
+_data_types = (pd.DataFrame, pd.Series, pd.Index, np.ndarray, dict, list, tuple)
+_skip_types = (types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType, type)
+_baseline = None
+
+
+# Approximate deep size of an object graph in bytes. Objects reachable several times are
+# counted once.
+def deep_size(obj, seen=None):
+    seen = set() if seen is None else seen
+    total = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _skip_types):
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, (gpd.GeoDataFrame, gpd.GeoSeries)):
+            total += _geo_size(obj)
+        elif isinstance(obj, pd.DataFrame):
+            total += int(obj.memory_usage(deep=True, index=True).sum())
+        elif isinstance(obj, (pd.Series, pd.Index)):
+            total += int(obj.memory_usage(deep=True))
+        elif isinstance(obj, np.ndarray):
+            total += obj.nbytes
+            if obj.dtype == object:
+                stack.extend(obj.ravel().tolist())
+        elif isinstance(obj, shapely.Geometry):
+            total += geometry_overhead + 16 * shapely.get_num_coordinates(obj)
+        else:
+            total += sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                stack.extend(obj.keys())
+                stack.extend(obj.values())
+            elif isinstance(obj, (list, tuple, set, frozenset)):
+                stack.extend(obj)
+            elif hasattr(obj, '__dict__'):
+                stack.append(vars(obj))
+            elif hasattr(obj, '__slots__'):
+                stack.extend(getattr(obj, name) for name in obj.__slots__ if hasattr(obj, name))
+    return total
+
+
+# Size of a GeoDataFrame or GeoSeries: attribute columns from pandas, geometries from their
+# coordinate counts
+def _geo_size(data):
+    geometries = data.geometry.values if isinstance(data, gpd.GeoDataFrame) else data.values
+    size = len(geometries) * geometry_overhead + 16 * int(shapely.get_num_coordinates(np.asarray(geometries)).sum())
+    if isinstance(data, gpd.GeoDataFrame):
+        attributes = data.drop(columns=data.geometry.name)
+        size += int(pd.DataFrame(attributes).memory_usage(deep=True, index=True).sum())
+    return size
+
+
+# Current and peak resident set size in bytes (current is only available on Linux)
+def rss():
+    current = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    current = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = None
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+        peak = peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        pass
+    return current, peak
+
+
+# The in-process caches, as {name: object}. These reach into the owners' private state on
+# purpose; they are only read here.
+def _caches():
+    caches = {}
+    if 'matrix_store' in sys.modules:
+        caches['matrix_store.rows'] = sys.modules['matrix_store'].store._rows
+        if sys.modules['matrix_store'].store.chunks is not None:
+            caches['chunk_store.blocks'] = sys.modules['matrix_store'].store.chunks._blocks
+    if 'result_cache' in sys.modules:
+        backend = sys.modules['result_cache'].result_cache.backend
+        caches['result_cache'] = getattr(backend, '_entries', None)
+    if 'isochrones' in sys.modules:
+        caches['isochrones'] = sys.modules['isochrones']._cache
+    if 'pages.AB_Mapper' in sys.modules:
+        caches['ab_prefetch'] = sys.modules['pages.AB_Mapper']._prefetched
+    if 'session_store' in sys.modules:
+        caches['session_store'] = sys.modules['session_store'].sessions._sessions
+    if 'geocoder' in sys.modules:
+        caches['geocoder.gazetteer'] = sys.modules['geocoder'].geocoder.gazetteer
+    return caches
+
+
+def _mb(size):
+    return None if size is None else round(size / 1024 / 1024, 2)
+
+
+# Memory held by each loaded dataset and cache, in MB
+def memory_report():
+    caches = _caches()
+    cache_ids = {id(cache) for cache in caches.values()}
+
+    cache_sizes = {}
+    for name, cache in caches.items():
+        if cache is None:
+            # Disk backed result cache: report the file instead
+            path = sys.modules['result_cache'].cache_path
+            cache_sizes[name + ' (disk)'] = _mb(os.path.getsize(path)) if os.path.exists(path) else 0
+        else:
+            cache_sizes[name] = _mb(deep_size(cache))
+
+    datasets = {}
+    for module_name in dataset_modules:
+        module = sys.modules.get(module_name)
+        if module is None:
+            continue
+        for name, value in vars(module).items():
+            if id(value) in cache_ids or not isinstance(value, _data_types):
+                continue
+            size = deep_size(value)
+            if size >= min_report_bytes:
+                datasets[f"{module_name}.{name}"] = _mb(size)
+
+    current, peak = rss()
+    traced, traced_peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (None, None)
+    return {
+        'rss_mb': _mb(current),
+        'peak_rss_mb': _mb(peak),
+        'datasets_mb': dict(sorted(datasets.items(), key=lambda item: -item[1])),
+        'caches_mb': cache_sizes,
+        'tracemalloc': {'tracing': tracemalloc.is_tracing(), 'traced_mb': _mb(traced), 'peak_mb': _mb(traced_peak)},
+    }
+
+
+# Start tracing (if needed) and keep a snapshot to diff against later
+def take_baseline(frames=10):
+    global _baseline
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    _baseline = _snapshot()
+
+
+# Allocations since the baseline, largest growth first. Tracing stops with the diff, so the
+# process does not pay for it afterwards; take a new baseline to measure again.
+def baseline_diff(top=25):
+    global _baseline
+    if _baseline is None:
+        return None
+    diff = _diff(_baseline, _snapshot(), top)
+    _baseline = None
+    tracemalloc.stop()
+    return diff
+
+
+# Run func with tracemalloc snapshots around it. Returns (result, allocation diff, peak
+# traced bytes during the call).
+def profile_call(func, top=25, frames=10):
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(frames)
+    tracemalloc.reset_peak()
+    before = _snapshot()
+    try:
+        result = func()
+        after = _snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started:
+            tracemalloc.stop()
+    return result, _diff(before, after, top), peak
+
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, linecache.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+    ])
+
+
+def _diff(before, after, top):
+    return [
+        {
+            'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            'size_kb_diff': round(stat.size_diff / 1024, 1),
+            'count_diff': stat.count_diff,
+            'size_kb': round(stat.size / 1024, 1),
+        }
+        for stat in after.compare_to(before, 'lineno')[:top]
+    ]
@@ -0,0 +1,131 @@
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# In-process latency histograms and counters for the hot paths (query, population, figure
+# build, GPKG write, geocode, ...) of every page, exposed in Prometheus text format on
+# /metrics. Set TTM_DEBUG_TIMING=1 to also print every span, like the old debug_timing helper.
+debug_timing = os.environ.get('TTM_DEBUG_TIMING', '0') == '1'
+
+# Histogram bucket upper bounds in seconds
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    # Time a block as ttm_span_seconds{page, span}; failures are counted in ttm_span_errors_total
+    @contextmanager
+    def span(self, span, page='app'):
+        start_time = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.increment('ttm_span_errors_total', page=page, span=span)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start_time
+            self.observe('ttm_span_seconds', elapsed, page=page, span=span)
+            if debug_timing:
+                print(f"[DEBUG] {page} {span}: {elapsed:.3f} seconds")
+
+    # Decorator form of span
+    def timed(self, span, page='app'):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(span, page):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # Prometheus text exposition format. gauges maps extra gauge names to {labels: value}
+    # for values that are owned elsewhere (cache sizes, hit counts).
+    def render(self, gauges=None):
+        with self._lock:
+            histograms = {key: (list(h.counts), h.sum, h.count) for key, h in self._histograms.items()}
+            counters = dict(self._counters)
+
+        lines = []
+        for name in sorted({key[0] for key in histograms}):
+            lines += self._header(name, 'histogram')
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+                lines.append(f"{name}_count{_labels(labels)} {count}")
+        for name in sorted({key[0] for key in counters}):
+            lines += self._header(name, 'counter')
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+        for name, values in sorted((gauges or {}).items()):
+            lines += self._header(name, 'gauge')
+            for labels, value in values.items():
+                lines.append(f"{name}{_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, name, kind):
+        header = [f"# TYPE {name} {kind}"]
+        if name in self._help:
+            header.insert(0, f"# HELP {name} {self._help[name]}")
+        return header
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+metrics = Metrics()
+metrics.describe('ttm_span_seconds', 'Duration of instrumented steps by page and span.')
+metrics.describe('ttm_span_errors_total', 'Instrumented steps that raised an exception.')
+metrics.describe('ttm_callback_seconds', 'Dash callback request duration by output.')
+metrics.describe('ttm_callback_total', 'Dash callback requests by output and status code.')
+span = metrics.span
+timed = metrics.timed
@@ -1,11 +1,25 @@
 import geopandas as gpd
-import sqlite3
+import pandas as pd
+import numpy as np
+import base64
+import io
+import os
+import threading
+from collections import OrderedDict
+import time
 import plotly.graph_objects as go
 from dash import dcc, html, Input, Output, State
 import dash_bootstrap_components as dbc
 from app import app  # Make sure you import the app instance from app.py
 import dash
 from dash import dash_table  # Ensure the DataTable module is explicitly imported
+from flask import Response, jsonify, request
+import grid_index
+import matrix_store
+from grid_index import clicked_cell_id
+from session_store import new_session_id, sessions
+from result_cache import result_cache
+from metrics import timed
 
 # Path to data files
 db_path = 'data/full_csvs.db'
@@ -27,9 +41,6 @@ center_lon = grid_gdf.geometry.centroid.x.mean()
 latitudes = grid_gdf.geometry.centroid.y
 longitudes = grid_gdf.geometry.centroid.x
 
-# Global variable to store the current queried pair (reset after third click)
-current_queries = []
-
 # add muncipality borders
 borders_gdf = gpd.read_file(borders)
 
@@ -41,6 +52,7 @@ if borders_gdf.crs is None or borders_gdf.crs != 'EPSG:4326':
     borders_gdf = borders_gdf.to_crs(epsg=4326)
 
 # Create the base map figure with an option to highlight selected and queried grid cells
+@timed('figure', page='ab')
 def create_map(selected_ids=[], queried_ids=[], zoom=9.5):
     fig = go.Figure()
 
@@ -53,6 +65,7 @@ def create_map(selected_ids=[], queried_ids=[], zoom=9.5):
             marker=dict(size=13, color='blue', opacity=0.1),
             hoverinfo='text',
             hovertext=grid_gdf['id'].astype(str),
+            customdata=grid_gdf['id'],
             name='All Grid Cells'
         )
     )
@@ -67,7 +80,8 @@ def create_map(selected_ids=[], queried_ids=[], zoom=9.5):
                 mode='markers',
                 marker=dict(size=20, color='red', opacity=0.8),
                 hoverinfo='text',
-                hovertext=selected_gdf['id'].astype(str)
+                hovertext=selected_gdf['id'].astype(str),
+                customdata=selected_gdf['id']
             )
         )
 
@@ -82,6 +96,7 @@ def create_map(selected_ids=[], queried_ids=[], zoom=9.5):
                 marker=dict(size=20, color='orange', opacity=0.8),
                 hoverinfo='text',
                 hovertext=queried_gdf['id'].astype(str),
+                customdata=queried_gdf['id'],
                 name='Queried Pairs'
             )
         )
@@ -135,7 +150,37 @@ toast_map_layout = html.Div([
             id="query-result",
             children="Click on two grid cells to query the database.",
             style={'width': '100%', 'height': 'auto'}
-        )
+        ),
+        dcc.Store(id='ab-state', storage_type='session'),
+        html.Br(),
+        html.Div("Year"),
+        dcc.Dropdown(
+            id='ab-year',
+            options=[{'label': str(year), 'value': year} for year in matrix_store.store.years()],
+            value=matrix_store.base_year,
+            clearable=False
+        ),
+        dcc.Checklist(
+            id='ab-keep-origin',
+            options=[{'label': ' Keep the origin: further clicks add destinations', 'value': 'on'}],
+            value=[]
+        ),
+
+        # Batch lookup for many OD pairs at once
+        html.Hr(),
+        html.H5("Batch OD Query"),
+        html.P("Upload a CSV with from_id,to_id columns (or from_lon,from_lat,to_lon,to_lat) "
+               "to get all travel modes for every pair."),
+        dcc.Upload(
+            id='od-upload',
+            children=html.Div(["Drag and drop or ", html.A("select a CSV file")]),
+            style={'width': '100%', 'height': '60px', 'lineHeight': '60px', 'borderWidth': '1px',
+                   'borderStyle': 'dashed', 'borderRadius': '5px', 'textAlign': 'center'}
+        ),
+        html.Progress(id='od-progress', value='0', max='1', style={'display': 'none'}),
+        html.Button('Cancel', id='od-cancel-btn', n_clicks=0, disabled=True),
+        html.Div(id='od-upload-result', style={'marginTop': '10px'}),
+        dcc.Download(id='od-download')
     ], style={
         'width': '300px',
         'backgroundColor': 'rgba(255, 255, 255, 0.9)',
@@ -159,36 +204,68 @@ toast_map_layout = html.Div([
     ], style={'display': 'inline-block', 'width': 'calc(100% - 300px)', 'height': '100vh'})
 ], style={'display': 'flex', 'flexDirection': 'row', 'height': '100vh'})
 
-# Define the query_db function
-def query_db(from_id, to_id):
+# Define the query_db function (memoized per pair and year)
+@result_cache.memoize('ab')
+@timed('query', page='ab')
+def query_db(from_id, to_id, year=None):
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-
-        # Query the database for the travel time details including walk_d
-        query = """
-            SELECT walk_d, walk_avg, walk_slo, bike_avg, bike_fst, bike_slo, 
-                   pt_r_avg, pt_r_slo, pt_m_avg, pt_m_slo, 
-                   pt_n_avg, pt_n_slo, car_r, car_m, car_n
-            FROM FULL_CV 
-            WHERE from_id = ? AND to_id = ?
-        """
-        cursor.execute(query, (from_id, to_id))
-        result = cursor.fetchone()
-
-        conn.close()
+        if year is not None and year != matrix_store.base_year:
+            # Other years come from the store's year deltas
+            result = row_values(pair_origin_row(from_id, year), to_id)
+        else:
+            # Reuse the store's per-thread connection instead of opening one per query
+            cursor = matrix_store.store.connection().cursor()
+
+            # Query the database for the travel time details including walk_d
+            query = """
+                SELECT walk_d, walk_avg, walk_slo, bike_avg, bike_fst, bike_slo, 
+                       pt_r_avg, pt_r_slo, pt_m_avg, pt_m_slo, 
+                       pt_n_avg, pt_n_slo, car_r, car_m, car_n
+                FROM FULL_CV 
+                WHERE from_id = ? AND to_id = ?
+            """
+            cursor.execute(query, (from_id, to_id))
+            result = cursor.fetchone()
+        return format_result(result)
+    except Exception as e:
+        return None
+
 
+# Origin row for pair lookups. The result table shows exact values, so with the chunk store
+# enabled (quantized rows, see chunk_store.py) the row is still read from FULL_CV.
+def pair_origin_row(from_id, year=None):
+    if matrix_store.store.chunks is not None:
+        return matrix_store.store.exact_origin_row(from_id, year)
+    return matrix_store.store.origin_row(from_id, year)
+
+
+# Values of one destination in an origin row, in the column order of the query above: NaN
+# (no route) as -1, None if the pair is not in the matrix
+def row_values(row, to_id):
+    position = grid_index.position_of.get(int(to_id))
+    if position is None:
+        return None
+    values = row[:, position]
+    if np.isnan(values).all():
+        return None
+    return [-1 if np.isnan(value) else float(value) for value in values]
+
+
+# Format time values for hours and minutes if > 60
+def format_time(minutes):
+    if minutes > 60:
+        hours = minutes // 60
+        mins = minutes % 60
+        return f"{int(hours)} h {int(mins)} m"
+    return f"{int(minutes)} m"
+
+
+# (distance, travel time table rows) for the values of one pair, None if there are none
+def format_result(result):
+    try:
         if not result:
             return None
 
-        # Format time values for hours and minutes if > 60
-        def format_time(minutes):
-            if minutes > 60:
-                hours = minutes // 60
-                mins = minutes % 60
-                return f"{int(hours)} h {int(mins)} m"
-            return f"{int(minutes)} m"
-
         # Extract distance separately
         distance = f"{result[0] / 1000:.1f} km"
 
@@ -215,16 +292,100 @@ def query_db(from_id, to_id):
         return None
 
 
+# Speculative prefetch: the first click of a pair starts reading the origin's full row (all
+# columns to every destination) in a background thread, so the second click, and further
+# destinations from the same origin, are answered from memory. The rows (0.8 MB each) are kept
+# in a small LRU shared by all sessions, so memory does not grow with the number of users.
+prefetch_wait = 5  # seconds the second click waits for a prefetch that is still running
+prefetch_rows = int(os.environ.get('TTM_PREFETCH_ROWS', 16))
+_prefetched = OrderedDict()  # (origin, year) -> row, least recently used first
+_prefetches = {}  # (origin, year) -> threading.Event of a running prefetch
+_prefetch_lock = threading.Lock()
+
+
+def prefetch_origin(from_id, year):
+    key = (int(from_id), year)
+    with _prefetch_lock:
+        if key in _prefetched or key in _prefetches:
+            return
+        done = _prefetches[key] = threading.Event()
+
+    def run():
+        try:
+            row = pair_origin_row(from_id, year)
+            with _prefetch_lock:
+                _prefetched[key] = row
+                while len(_prefetched) > prefetch_rows:
+                    _prefetched.popitem(last=False)
+        finally:
+            with _prefetch_lock:
+                del _prefetches[key]
+            done.set()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+# The prefetched row for the origin, waiting for a running prefetch; None if there is none (the
+# caller then queries the pair)
+def prefetched_row(from_id, year):
+    key = (int(from_id), year)
+    with _prefetch_lock:
+        running = _prefetches.get(key)
+    if running is not None:
+        running.wait(prefetch_wait)
+    with _prefetch_lock:
+        row = _prefetched.get(key)
+        if row is not None:
+            _prefetched.move_to_end(key)
+        return row
+
+
+# Destinations from one origin side by side, for the keep-origin mode
+summary_columns = [('walk_avg', 'Walk'), ('bike_avg', 'Bike'), ('pt_r_avg', 'PT (rush)'), ('car_r', 'Car (rush)')]
+
+
+def destination_summary(from_id, destinations, row):
+    records = []
+    for to_id in destinations:
+        values = row_values(row, to_id)
+        record = {'Destination': to_id, 'Distance': f"{values[0] / 1000:.1f} km" if values else "-"}
+        for column, name in summary_columns:
+            record[name] = format_time(values[matrix_store.column_index[column]]) if values else "-"
+        records.append(record)
+    return html.Div([
+        html.Br(),
+        html.B(f"Destinations from {from_id}:"),
+        dash_table.DataTable(
+            data=records,
+            columns=[{"name": name, "id": name} for name in ['Destination', 'Distance'] + [n for _, n in summary_columns]],
+            style_table={'overflowX': 'auto', 'minWidth': '100%'},
+            style_cell={'textAlign': 'left', 'padding': '5px'},
+            style_header={'backgroundColor': 'rgb(230, 230, 230)', 'fontWeight': 'bold'}
+        )
+    ])
+
+
 # Callback for updating the map and selecting cells
+# Per-session state lives in the 'ab-state' client store ({'session', 'clicks', 'queried',
+# 'destinations'}), so concurrent users do not share clicks and any worker process can answer
+# the callback
 @app.callback(
     [Output('toast-map', 'figure'),
-     Output('query-result', 'children')],
+     Output('query-result', 'children'),
+     Output('ab-state', 'data')],
     [Input('toast-map', 'clickData')],
-    [State('query-result', 'children'),
-     State('toast-map', 'relayoutData')]  # Capture current zoom from the map
+    [State('ab-state', 'data'),
+     State('toast-map', 'relayoutData'),  # Capture current zoom from the map
+     State('ab-year', 'value'),
+     State('ab-keep-origin', 'value')]
 )
-def update_map(click_data, current_output, relayout_data):
-    global current_queries
+def update_map(click_data, state, relayout_data, year, keep_origin):
+    state = dict(state or {})
+    session_id = state.get('session') or new_session_id()
+    previous_clicks = list(state.get('clicks') or [])
+    current_queries = list(state.get('queried') or [])
+    destinations = list(state.get('destinations') or []) if keep_origin else []
+    year = int(year or matrix_store.base_year)
 
     # Default zoom level
     zoom = 9.5
@@ -233,18 +394,14 @@ def update_map(click_data, current_output, relayout_data):
 
     # Handle no clicks
     if click_data is None:
-        return create_map(zoom=zoom), "Click on two grid cells to query the database."
-
-    try:
-        clicked_id = int(click_data['points'][0]['hovertext'])
-    except (KeyError, ValueError):
-        return create_map(zoom=zoom), "Invalid click - no grid cell ID detected."
+        return create_map(zoom=zoom), "Click on two grid cells to query the database.", \
+            {'session': session_id, 'clicks': [], 'queried': []}
 
-    # Get previously clicked IDs from the output
-    if "Clicked IDs" in current_output:
-        previous_clicks = [int(id) for id in current_output.split(": ")[1].split(", ")]
-    else:
-        previous_clicks = []
+    clicked_id = clicked_cell_id(click_data)
+    if clicked_id is None:
+        return create_map(zoom=zoom), "Invalid click - no grid cell ID detected.", \
+            {'session': session_id, 'clicks': previous_clicks, 'queried': current_queries,
+             'destinations': destinations}
 
     # Add the new clicked ID
     previous_clicks.append(clicked_id)
@@ -252,15 +409,23 @@ def update_map(click_data, current_output, relayout_data):
     # Reset if more than two clicks are made
     if len(previous_clicks) > 2:
         current_queries = []
+        destinations = []
         previous_clicks = [clicked_id]
 
-    # If exactly two IDs are clicked, query the database
+    # A new origin: start reading its row while the user picks the destination
+    if len(previous_clicks) == 1:
+        prefetch_origin(clicked_id, year)
+
+    # If exactly two IDs are clicked, answer the pair, from the prefetched row when there is one
     if len(previous_clicks) == 2:
         from_id = previous_clicks[0]
         to_id = previous_clicks[1]
 
-        # Query the database
-        result = query_db(from_id, to_id)
+        row = prefetched_row(from_id, year)
+        if row is not None:
+            result = format_result(row_values(row, to_id))
+        else:
+            result = query_db(from_id, to_id, year)
 
         if result:
             distance, travel_times = result
@@ -293,17 +458,142 @@ def update_map(click_data, current_output, relayout_data):
 
             current_queries = [from_id, to_id]  # Update current queries
 
-        else:
-            result_message = f"No data found for From ID: {from_id}, To ID: {to_id}"
-
-        # Reset clicks
-        previous_clicks = []
+            # Keep a short per-session history of answered pairs on the server
+            history = [(from_id, to_id, distance)] + sessions.get(session_id, 'history', [])
+            sessions.set(session_id, 'history', history[:5])
+            result_message.children.append(query_history(history[1:5]))
 
-        # Return updated map and query results
-        return create_map(queried_ids=current_queries, zoom=zoom), result_message
+        else:
+            result_message = html.Div([f"No data found for From ID: {from_id}, To ID: {to_id}"])
+
+        if keep_origin:
+            # Stay on the origin: the next click is another destination
+            destinations = ([to_id] + [d for d in destinations if d != to_id])[:10]
+            current_queries = [from_id] + destinations
+            if row is not None and len(destinations) > 1:
+                result_message.children.append(destination_summary(from_id, destinations, row))
+            return create_map(queried_ids=current_queries, zoom=zoom), result_message, \
+                {'session': session_id, 'clicks': [from_id], 'queried': current_queries,
+                 'destinations': destinations}
+
+        # Return updated map and query results, with the clicks reset
+        return create_map(queried_ids=current_queries, zoom=zoom), result_message, \
+            {'session': session_id, 'clicks': [], 'queried': current_queries}
 
     # If only one ID is clicked, update the map with selected IDs
     output_message = f"Clicked IDs: {', '.join(map(str, previous_clicks))}"
     new_fig = create_map(selected_ids=previous_clicks, queried_ids=current_queries, zoom=zoom)
-    return new_fig, output_message
+    return new_fig, output_message, {'session': session_id, 'clicks': previous_clicks, 'queried': current_queries}
+
+
+# Previously queried pairs of this session
+def query_history(history):
+    if not history:
+        return html.Div()
+    return html.Div([
+        html.Br(),
+        html.B("Previous queries:"),
+        html.Ul([html.Li(f"{from_id} → {to_id} ({distance})") for from_id, to_id, distance in history])
+    ])
+
+
+
+# Resolve a DataFrame of OD pairs (cell ids or WGS84 coordinates) and look up all travel
+# modes for every pair with one gather from the matrix store
+@timed('batch_query', page='ab')
+def batch_query(pairs_df):
+    start_time = time.time()
+    pairs_df = pairs_df.rename(columns=str.lower)
+    if {'from_id', 'to_id'}.issubset(pairs_df.columns):
+        from_ids = pd.to_numeric(pairs_df['from_id'], errors='coerce').fillna(-1).astype('int64').to_numpy()
+        to_ids = pd.to_numeric(pairs_df['to_id'], errors='coerce').fillna(-1).astype('int64').to_numpy()
+    elif {'from_lon', 'from_lat', 'to_lon', 'to_lat'}.issubset(pairs_df.columns):
+        from_pos = grid_index.positions_at(pairs_df['from_lon'], pairs_df['from_lat'])
+        to_pos = grid_index.positions_at(pairs_df['to_lon'], pairs_df['to_lat'])
+        from_ids = np.where(from_pos >= 0, grid_index.ids[from_pos], -1)
+        to_ids = np.where(to_pos >= 0, grid_index.ids[to_pos], -1)
+    else:
+        raise ValueError("CSV needs from_id,to_id or from_lon,from_lat,to_lon,to_lat columns.")
+
+    values = matrix_store.store.pairs(from_ids, to_ids)
+    result_df = pairs_df.copy()
+    result_df['from_id'] = np.where(from_ids >= 0, from_ids, None)
+    result_df['to_id'] = np.where(to_ids >= 0, to_ids, None)
+    result_df[matrix_store.columns] = values
+
+    elapsed = time.time() - start_time
+    stats = {
+        'pairs': len(result_df),
+        'found': int((~np.isnan(values).all(axis=1)).sum()),
+        'seconds': round(elapsed, 4),
+        'pairs_per_second': round(len(result_df) / elapsed) if elapsed > 0 else None,
+    }
+    print(f"[DEBUG] Batch OD query: {stats}")
+    return result_df, stats
+
+
+# API endpoint for batch OD queries. POST a CSV (as the request body or a 'file' upload);
+# returns CSV by default or JSON with ?format=json
+@app.server.route('/api/od', methods=['POST'])
+def od_batch_endpoint():
+    upload = request.files.get('file')
+    data = upload.read() if upload else request.get_data()
+    try:
+        pairs_df = pd.read_csv(io.BytesIO(data))
+        result_df, stats = batch_query(pairs_df)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+    if request.args.get('format') == 'json':
+        records = result_df.astype(object).where(result_df.notna(), None).to_dict(orient='records')
+        return jsonify({'stats': stats, 'results': records})
+
+    response = Response(result_df.to_csv(index=False), mimetype='text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename=od_results.csv'
+    response.headers['X-Pairs-Per-Second'] = str(stats['pairs_per_second'])
+    return response
+
+
+# Callback for the batch OD upload box. Large uploads run in a background job, looked up
+# od_upload_chunk pairs at a time with a progress bar and a cancel button.
+od_upload_chunk = 20000
 
+
+@app.callback(
+    [Output('od-download', 'data'),
+     Output('od-upload-result', 'children')],
+    [Input('od-upload', 'contents')],
+    [State('od-upload', 'filename')],
+    background=True,
+    running=[(Output('od-cancel-btn', 'disabled'), False, True),
+             (Output('od-progress', 'style'), {'width': '100%'}, {'display': 'none'})],
+    progress=[Output('od-progress', 'value'),
+              Output('od-progress', 'max')],
+    cancel=[Input('od-cancel-btn', 'n_clicks')],
+    prevent_initial_call=True
+)
+def od_upload(set_progress, contents, filename):
+    if not contents:
+        return dash.no_update, ""
+    try:
+        _, encoded = contents.split(',', 1)
+        pairs_df = pd.read_csv(io.BytesIO(base64.b64decode(encoded)))
+        start_time = time.time()
+        parts = []
+        for start in range(0, max(len(pairs_df), 1), od_upload_chunk):
+            set_progress((str(start), str(len(pairs_df))))
+            parts.append(batch_query(pairs_df.iloc[start:start + od_upload_chunk]))
+        result_df = pd.concat([part for part, _ in parts])
+    except Exception as e:
+        return dash.no_update, html.Div(f"Error: {e}", style={'color': 'red'})
+
+    elapsed = time.time() - start_time
+    stats = {
+        'pairs': len(result_df),
+        'found': sum(part_stats['found'] for _, part_stats in parts),
+        'seconds': round(elapsed, 4),
+        'pairs_per_second': round(len(result_df) / elapsed) if elapsed > 0 else None,
+    }
+    message = (f"{stats['found']} of {stats['pairs']} pairs found in {stats['seconds']} s "
+               f"({stats['pairs_per_second']} pairs/s).")
+    return dcc.send_data_frame(result_df.to_csv, f"od_results_{filename or 'pairs.csv'}", index=False), message
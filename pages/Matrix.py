@@ -1,20 +1,22 @@
 import geopandas as gpd
 import pandas as pd
 import plotly.graph_objects as go
-from dash import dcc, html, Input, Output, State
+import dash
+from dash import dcc, html, Input, Output, State, dash_table
 from app import app  # Import the app instance from app.py
+from geocoder import geocoder  # Local gazetteer with cached Nominatim fallback
+import grid_index
+import matrix_store
+from grid_index import cell_at, cell_center, clicked_cell_id
+from isochrones import isochrone_bands, isochrones, polygon_coords
+from result_cache import result_cache
+from access_log import log_request
+from metrics import span, timed
 import sqlite3
 import os
-from geopy.geocoders import Nominatim
-from shapely.geometry import Point
 from datetime import datetime, timedelta
 from pathlib import Path
-import time  # For debugging execution time
-
-# Debugging helper function
-def debug_timing(message, start_time):
-    elapsed_time = time.time() - start_time
-    print(f"[DEBUG] {message}: {elapsed_time:.2f} seconds")
+import numpy as np
 
 # Path to database and other data files
 db_path = 'data/full_csvs.db'
@@ -28,35 +30,26 @@ db_connection = sqlite3.connect(db_path, check_same_thread=False)
 # Ensure the download folder exists
 Path(download_folder).mkdir(parents=True, exist_ok=True)
 
-# Initialize geolocator
-geolocator = Nominatim(user_agent="Helsinki_TTM_App")
-
 # Load the grid geodataframe
 print("[DEBUG] Loading grid geodataframe...")
-start_time = time.time()
-grid_gdf = gpd.read_file(gridfile)
-debug_timing("Loaded grid geodataframe", start_time)
-
-# Ensure the CRS is set to EPSG:3067 and project to WGS84 (EPSG:4326) for mapping
-if grid_gdf.crs is None or grid_gdf.crs != 'EPSG:3067':
-    print("[DEBUG] Reprojecting grid CRS...")
-    start_time = time.time()
-    grid_gdf = grid_gdf.to_crs('EPSG:3067')
-    debug_timing("Reprojected grid CRS to EPSG:3067", start_time)
-
-grid_gdf = grid_gdf[grid_gdf.is_valid]
-print("[DEBUG] Filtering valid geometries...")
-grid_gdf = grid_gdf.to_crs(epsg=4326)
-debug_timing("Reprojected grid CRS to EPSG:4326", start_time)
-
-# Pre-calculate centroid coordinates and the center of the map
-print("[DEBUG] Calculating centroids...")
-start_time = time.time()
-latitudes = grid_gdf.geometry.centroid.y
-longitudes = grid_gdf.geometry.centroid.x
-center_lat = latitudes.mean()
-center_lon = longitudes.mean()
-debug_timing("Calculated centroids and map center", start_time)
+with span('load_grid', page='matrix'):
+    grid_gdf = gpd.read_file(gridfile)
+
+    # Ensure the CRS is set to EPSG:3067 and project to WGS84 (EPSG:4326) for mapping
+    if grid_gdf.crs is None or grid_gdf.crs != 'EPSG:3067':
+        print("[DEBUG] Reprojecting grid CRS...")
+        grid_gdf = grid_gdf.to_crs('EPSG:3067')
+
+    grid_gdf = grid_gdf[grid_gdf.is_valid]
+    print("[DEBUG] Filtering valid geometries...")
+    grid_gdf = grid_gdf.to_crs(epsg=4326)
+
+    # Pre-calculate centroid coordinates and the center of the map
+    print("[DEBUG] Calculating centroids...")
+    latitudes = grid_gdf.geometry.centroid.y
+    longitudes = grid_gdf.geometry.centroid.x
+    center_lat = latitudes.mean()
+    center_lon = longitudes.mean()
 
 # add muncipality borders
 borders_gdf = gpd.read_file(borders)
@@ -89,14 +82,36 @@ column_descriptions = {
 
 # Load population data
 print("[DEBUG] Loading population data...")
-start_time = time.time()
-population_df = pd.read_csv(population_csv)
-debug_timing("Loaded population data", start_time)
-
-# Function to query the database based on column and threshold
-def query_db(column, threshold, clicked_id):
-    print("[DEBUG] Querying database...")
-    start_time = time.time()
+with span('load_population', page='matrix'):
+    population_df = pd.read_csv(population_csv)
+
+    # Population per grid position, for the running totals of the nearest-cells ranking
+    population = np.zeros(len(grid_index.ids))
+    _population_positions = grid_index.positions_of(population_df['id'])
+    np.add.at(population, _population_positions[_population_positions >= 0],
+              population_df['ASUKKAITA'].to_numpy()[_population_positions >= 0])
+
+# Largest k of the k-nearest selection
+max_nearest = 2000
+# Range of the travel time distribution panel, in minutes
+distribution_max = 120
+distribution_views = {
+    'cells': 'Reachable cells',
+    'population': 'Reachable population',
+    'histogram': 'Cells per minute',
+}
+
+# Function to query the database based on column and threshold. direction='to' answers the
+# catchment question (which origins reach the clicked cell) from the destination-major store.
+# Years other than the base year are read from the store's year deltas, and all origin rows
+# from the compressed chunk file when it is enabled.
+@timed('query', page='matrix')
+def query_db(column, threshold, clicked_id, direction='from', year=None):
+    if direction == 'to' or (year is not None and year != matrix_store.base_year) \
+            or matrix_store.store.chunks is not None:
+        vector = matrix_store.store.vector(clicked_id, column, direction, year)
+        return grid_index.ids[vector <= threshold].tolist()
+
     query = f"""
         SELECT to_id FROM FULL_CV 
         WHERE {column} <= ? AND from_id = ?
@@ -106,50 +121,77 @@ def query_db(column, threshold, clicked_id):
     cursor.execute(query, (threshold, clicked_id))
     # Fetch all results and convert them into a list
     related_ids = [row[0] for row in cursor.fetchall()]
-    debug_timing("Queried database", start_time)
-    cursor.execute(f"EXPLAIN QUERY PLAN {query}", (threshold, clicked_id))
-    print(cursor.fetchall())
-
     return related_ids
 
 
+# The k cells nearest to the clicked cell by travel time, as grid positions ranked by time (ties
+# by cell id), and their times. Like query_db, base-year origin rows come straight from the
+# database, which sorts only the origin's rows; otherwise np.argpartition selects them from the
+# time vector in linear time and only those k are sorted. Either way this costs about the same
+# as a threshold query.
+@timed('nearest', page='matrix')
+def nearest_destinations(column, k, clicked_id, direction='from', year=None):
+    if direction == 'from' and (year is None or year == matrix_store.base_year) \
+            and matrix_store.store.chunks is None:
+        query = f"""
+            SELECT to_id, {column} FROM FULL_CV
+            WHERE from_id = ? AND {column} >= 0
+            ORDER BY {column}, to_id LIMIT ?
+        """
+        cursor = db_connection.cursor()
+        cursor.execute(query, (clicked_id, k))
+        rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 2)
+        positions = grid_index.positions_of(rows[:, 0].astype(np.int64))
+        return positions[positions >= 0], rows[positions >= 0, 1]
+
+    vector = matrix_store.store.vector(clicked_id, column, direction, year)
+    times = np.where(np.isnan(vector), np.inf, vector)
+    k = min(k, int(np.isfinite(times).sum()))
+    if k == 0:
+        return np.array([], dtype=np.int64), np.array([])
+    # Every cell tied with the k-th one, so ties at the cut are broken by id like in the query
+    kth_time = times[np.argpartition(times, k - 1)[k - 1]]
+    nearest = np.flatnonzero(times <= kth_time)
+    nearest = nearest[np.lexsort((grid_index.ids[nearest], times[nearest]))][:k]
+    return nearest, times[nearest]
+
+
 # Function to calculate the total population in highlighted cells
+@timed('population', page='matrix')
 def calculate_population(related_ids):
-    print("[DEBUG] Calculating population...")
-    start_time = time.time()
     if population_df.empty:
         print("[DEBUG] Population DataFrame is empty.")
         return 0
     relevant_pop = population_df[population_df['id'].isin(related_ids)]
     total_population = relevant_pop['ASUKKAITA'].sum()
-    debug_timing("Calculated population", start_time)
     return total_population
 
 # Function to create the GeoPackage of highlighted cells
-def create_gpkg(clicked_id, related_ids, dataset_value):
-    print("[DEBUG] Creating GeoPackage...")
-    start_time = time.time()
-
+@timed('gpkg', page='matrix')
+def create_gpkg(clicked_id, related_ids, dataset_value, threshold=None, direction='from', year=None):
     # Filter the grid GeoDataFrame to only include the related IDs
     highlighted_gdf = grid_gdf[grid_gdf['id'].isin(related_ids)]
-    debug_timing("Filtered grid for related IDs", start_time)
 
     if highlighted_gdf.empty:
         print("[ERROR] No matching rows found in grid_gdf for related_ids.")
         return None
 
-    # Read the corresponding travel time CSV
+    # Read the corresponding travel time CSV; the CSVs hold the base year, other years come
+    # from the store
     travel_time_file = f"{csv_folder}/Helsinki_Travel_Time_Matrix_2023_travel_times_to_{clicked_id}.csv"
-    if not os.path.exists(travel_time_file):
+    if year is not None and year != matrix_store.base_year:
+        travel_time_df = pd.DataFrame(matrix_store.store.destination_row(clicked_id, year).T,
+                                      columns=matrix_store.columns)
+        travel_time_df.insert(0, 'from_id', grid_index.ids)
+        travel_time_df.insert(1, 'to_id', clicked_id)
+    elif not os.path.exists(travel_time_file):
         print(f"[ERROR] Travel time file not found: {travel_time_file}")
         return None
-
-    travel_time_df = pd.read_csv(travel_time_file)
-    debug_timing("Loaded travel time data", start_time)
+    else:
+        travel_time_df = pd.read_csv(travel_time_file)
 
     # Merge the travel time data with the GeoDataFrame
     highlighted_gdf = highlighted_gdf.merge(travel_time_df, left_on='id', right_on='from_id')
-    debug_timing("Merged travel time data with GeoDataFrame", start_time)
 
     # Validate geometries
     if not highlighted_gdf.is_valid.all():
@@ -158,6 +200,11 @@ def create_gpkg(clicked_id, related_ids, dataset_value):
 
     # Save the GeoDataFrame to a GeoPackage
     gpkg_filename = f'{download_folder}/highlighted_cells_{clicked_id}.gpkg'
+    if threshold is not None:
+        # One file per selection, so cached results never point at another selection's file
+        gpkg_filename = f'{download_folder}/highlighted_cells_{clicked_id}_{dataset_value}_{threshold}_{direction}.gpkg'
+        if year is not None and year != matrix_store.base_year:
+            gpkg_filename = gpkg_filename.replace('.gpkg', f'_{year}.gpkg')
     try:
         highlighted_gdf.to_file(gpkg_filename, driver="GPKG")
         print("[DEBUG] GeoPackage successfully created.")
@@ -165,7 +212,28 @@ def create_gpkg(clicked_id, related_ids, dataset_value):
         print(f"[ERROR] Error saving GeoPackage: {e}")
         return None
 
-    debug_timing("Created GeoPackage", start_time)
+    return gpkg_filename
+
+
+# Function to create a GeoPackage with the nested isochrone polygons of a cell
+@timed('isochrone_gpkg', page='matrix')
+def create_isochrone_gpkg(clicked_id, isochrone_polygons, dataset_value, direction, year=None):
+    threshold = isochrone_polygons[-1][0]
+    gpkg_filename = f'{download_folder}/isochrones_{clicked_id}_{dataset_value}_{direction}_{threshold}.gpkg'
+    if year is not None and year != matrix_store.base_year:
+        gpkg_filename = gpkg_filename.replace('.gpkg', f'_{year}.gpkg')
+    isochrone_gdf = gpd.GeoDataFrame(
+        {'band_min': [band for band, _ in isochrone_polygons],
+         'mode': dataset_value,
+         'direction': direction},
+        geometry=[polygon for _, polygon in isochrone_polygons],
+        crs='EPSG:4326'
+    )
+    try:
+        isochrone_gdf.to_file(gpkg_filename, driver="GPKG")
+    except Exception as e:
+        print(f"[ERROR] Error saving isochrone GeoPackage: {e}")
+        return None
     return gpkg_filename
 
 
@@ -184,7 +252,8 @@ def delete_old_files(folder, days=7):
 
 
 # Function to create the scatter map
-def create_map(selected_ids=[], activated_id=None, zoom=9.5, center=None):
+@timed('figure', page='matrix')
+def create_map(selected_ids=[], activated_id=None, zoom=9.5, center=None, isochrone_polygons=None):
     fig = go.Figure()
 
     # Base scatter plot for all grid cells
@@ -196,6 +265,7 @@ def create_map(selected_ids=[], activated_id=None, zoom=9.5, center=None):
             marker=dict(size=13, color='blue', opacity=0.1),
             hoverinfo='text',
             hovertext=grid_gdf['id'],
+            customdata=grid_gdf['id'],
             name='All Cells'
         )
     )
@@ -211,6 +281,7 @@ def create_map(selected_ids=[], activated_id=None, zoom=9.5, center=None):
                 marker=dict(size=22, color='red', opacity=0.8),
                 hoverinfo='text',
                 hovertext=highlighted_gdf['id'],
+                customdata=highlighted_gdf['id'],
                 name='Highlighted Cells'
             )
         )
@@ -226,10 +297,39 @@ def create_map(selected_ids=[], activated_id=None, zoom=9.5, center=None):
                 marker=dict(size=22, color='green', opacity=0.8),
                 hoverinfo='text',
                 hovertext=activated_gdf['id'],
+                customdata=activated_gdf['id'],
                 name='Activated Cell'
             )
         )
 
+    # Isochrone outlines, largest band first so the smaller ones are drawn on top
+    for band, polygon in reversed(isochrone_polygons or []):
+        exteriors, holes = polygon_coords(polygon)
+        fig.add_trace(
+            go.Scattermapbox(
+                lon=exteriors[0],
+                lat=exteriors[1],
+                mode='lines',
+                fill='toself',
+                fillcolor='rgba(255, 0, 0, 0.15)',
+                line=dict(width=2, color='darkred'),
+                hoverinfo='text',
+                hovertext=f"Isochrone {band} min",
+                name=f"{band} min"
+            )
+        )
+        if holes[0]:
+            fig.add_trace(
+                go.Scattermapbox(
+                    lon=holes[0],
+                    lat=holes[1],
+                    mode='lines',
+                    line=dict(width=1, color='darkred'),
+                    hoverinfo='none',
+                    name=f"{band} min holes"
+                )
+            )
+
     # Add city borders as a new trace
     for _, row in borders_gdf.iterrows():
         geometry = row.geometry
@@ -278,11 +378,62 @@ def create_map(selected_ids=[], activated_id=None, zoom=9.5, center=None):
 
 
 
+# Travel time distribution of a cell for every mode over 0..distribution_max minutes: cells
+# per whole minute (a time t counts at ceil(t), so the cumulative count at m is the number of
+# cells within m minutes, as in query_db), and cumulative cells and population. One bincount
+# over (mode, minute) for the whole row. Memoized per cell, so the threshold slider and the
+# mode choice only redraw the chart.
+@result_cache.memoize('matrix_distribution')
+@timed('distribution', page='matrix')
+def travel_time_distribution(clicked_id, direction='from', year=None):
+    if direction == 'from':
+        times = matrix_store.store.origin_row(clicked_id, year)[1:]
+    else:
+        times = matrix_store.store.destination_row(clicked_id, year)[1:]
+    bins = distribution_max + 1
+    mode_index, positions = np.nonzero(times <= distribution_max)
+    index = mode_index * bins + np.ceil(times[mode_index, positions]).astype(int)
+    histogram = np.bincount(index, minlength=len(matrix_store.modes) * bins).reshape(-1, bins)
+    people = np.bincount(index, weights=population[positions],
+                         minlength=len(matrix_store.modes) * bins).reshape(-1, bins)
+    return {
+        'modes': list(matrix_store.modes),
+        'histogram': histogram.tolist(),
+        'cells': histogram.cumsum(axis=1).tolist(),
+        'population': np.round(people.cumsum(axis=1)).astype(int).tolist(),
+    }
+
+
+def distribution_figure(distribution=None, modes=(), view='cells', threshold=None):
+    fig = go.Figure()
+    minutes = list(range(distribution_max + 1))
+    for mode in modes if distribution else []:
+        values = distribution[view][distribution['modes'].index(mode)]
+        if view == 'histogram':
+            fig.add_trace(go.Bar(x=minutes, y=values, name=mode, opacity=0.6))
+        else:
+            fig.add_trace(go.Scatter(x=minutes, y=values, mode='lines', line_shape='hv', name=mode))
+    if distribution and threshold is not None:
+        fig.add_vline(x=threshold, line_dash='dash', line_color='grey')
+    fig.update_layout(
+        barmode='overlay',
+        xaxis=dict(title='Minutes', range=[0, distribution_max]),
+        yaxis=dict(title=distribution_views[view]),
+        legend=dict(orientation='h', y=-0.3),
+        margin={"r": 10, "t": 10, "l": 10, "b": 10}
+    )
+    return fig
+
+
 # Define layout for this page with a vertical box on the left and map on the right
 scatterplot_layout = html.Div([
     html.Div(id='floating-box', children=[
         html.H4("Travel Time Matrix"),
         html.P(id='floating-box-content', children="Click on a grid cell to view data."),
+        # Download files are written by a background job after each selection
+        html.Div(id='matrix-downloads'),
+        html.Progress(id='export-progress', value='0', max='1', style={'display': 'none'}),
+        html.Button('Cancel export', id='export-cancel-btn', n_clicks=0, disabled=True),
         dcc.Download(id="download-datafile"),
 
         # Search for cell by ID
@@ -294,13 +445,34 @@ scatterplot_layout = html.Div([
 
         # Address search
         html.H5("Search by Address"),
-        dcc.Input(id='address-input', type='text', placeholder='Enter address', n_submit=0),
+        dcc.Input(id='address-input', type='text', placeholder='Enter address', n_submit=0,
+                  list='address-suggestions', autoComplete='off'),
+        html.Datalist(id='address-suggestions'),
         html.Button('Search Address', id='address-search-btn', n_clicks=0),
+        html.Button('Cancel', id='address-cancel-btn', n_clicks=0, disabled=True),
+        html.Div(id='address-status', style={'marginTop': '5px'}),
         html.Div(id='address-error', style={'color': 'red', 'marginTop': '10px'}),
         html.Br(), html.Br(),
 
         # Dropdown for dataset selection with short descriptions
         html.Hr(),
+        html.H5("Direction"),
+        dcc.RadioItems(
+            id='direction-selector',
+            options=[{'label': ' Reachable from the cell', 'value': 'from'},
+                     {'label': ' Catchment (who can reach the cell)', 'value': 'to'}],
+            value='from',
+            labelStyle={'display': 'block'}
+        ),
+        html.Br(),
+        html.H5("Year"),
+        dcc.Dropdown(
+            id='year-selector',
+            options=[{'label': str(year), 'value': year} for year in matrix_store.store.years()],
+            value=matrix_store.base_year,
+            clearable=False
+        ),
+        html.Br(),
         html.H5("Travel Mode"),
         dcc.Dropdown(
             id='dataset-selector',
@@ -309,6 +481,17 @@ scatterplot_layout = html.Div([
             clearable=False
         ),
         html.Br(),
+        html.H5("Selection"),
+        dcc.RadioItems(
+            id='query-kind',
+            options=[{'label': ' Cells within the threshold', 'value': 'threshold'},
+                     {'label': ' Nearest cells by travel time', 'value': 'nearest'}],
+            value='threshold',
+            labelStyle={'display': 'block'}
+        ),
+        html.Div("Number of nearest cells (k):"),
+        dcc.Input(id='nearest-k', type='number', min=1, max=max_nearest, step=1, value=50, debounce=True),
+        html.Br(), html.Br(),
         # Slider for threshold selection
         html.H5("Threshold (minutes)"),
         dcc.Slider(
@@ -322,6 +505,35 @@ scatterplot_layout = html.Div([
 
         # Div to display the current slider value
         html.Div(id='slider-value', style={'margin-top': '10px', 'font-size': '16px'}),
+        html.Button('Animate 5-120 min', id='animate-btn', n_clicks=0),
+        html.Div(id='animate-status', style={'marginTop': '5px'}),
+        dcc.Interval(id='animate-interval', interval=150, disabled=True),
+        dcc.Store(id='sweep-store'),
+        dcc.Store(id='matrix-selection'),
+        dcc.Checklist(
+            id='isochrone-toggle',
+            options=[{'label': ' Show isochrone polygons (15 min bands)', 'value': 'on'}],
+            value=[]
+        ),
+
+        # Distribution of the clicked cell's travel times for one or more modes
+        html.Hr(),
+        html.H5("Travel Time Distribution"),
+        dcc.Dropdown(
+            id='distribution-modes',
+            options=[{'label': f"{desc}", 'value': col} for col, desc in column_descriptions.items()],
+            value=[],
+            multi=True,
+            placeholder='Selected travel mode'
+        ),
+        dcc.RadioItems(
+            id='distribution-view',
+            options=[{'label': f" {label}", 'value': view} for view, label in distribution_views.items()],
+            value='cells',
+            labelStyle={'display': 'block'}
+        ),
+        dcc.Graph(id='distribution-graph', figure=distribution_figure(), config={'displayModeBar': False},
+                  style={'height': '300px'}),
 
         html.Br(),
         html.Hr(),
@@ -359,91 +571,342 @@ scatterplot_layout = html.Div([
     [Output('scatterplot-map', 'figure'),
      Output('floating-box-content', 'children'),
      Output('slider-value', 'children'),
-     Output('address-error', 'children')],
+     Output('matrix-selection', 'data')],
     [Input('scatterplot-map', 'clickData'),
      Input('dataset-selector', 'value'),
      Input('threshold-slider', 'value'),
      Input('cell-id-search', 'n_clicks'),
-     Input('address-search-btn', 'n_clicks'),
-     Input('address-input', 'n_submit')],
+     Input('direction-selector', 'value'),
+     Input('isochrone-toggle', 'value'),
+     Input('year-selector', 'value'),
+     Input('query-kind', 'value'),
+     Input('nearest-k', 'value')],
     [State('scatterplot-map', 'relayoutData'),
-     State('cell-id-input', 'value'),
-     State('address-input', 'value')]
+     State('cell-id-input', 'value')]
 )
-def update_map(click_data, dataset_value, threshold, n_clicks_id, n_clicks_addr, n_submit, relayout_data, cell_id,
-               address):
+def update_map(click_data, dataset_value, threshold, n_clicks_id, direction, show_isochrones, year, query_kind,
+               k, relayout_data, cell_id):
     zoom = 9.5
     center = None
-    error_msg = ""
 
     if relayout_data:
         zoom = relayout_data.get('mapbox.zoom', 9.5)
         center = relayout_data.get('mapbox.center', None)
 
-    # Handle address search (button click or Enter key press)
-    if (n_clicks_addr > 0 or n_submit > 0) and address:
-        try:
-            location = geolocator.geocode(address)
-            if location:
-                address_point = gpd.GeoSeries([Point(location.longitude, location.latitude)], crs="EPSG:4326")
-                address_point_projected = address_point.to_crs(grid_gdf.crs)
-                containing_grid = grid_gdf[grid_gdf.geometry.contains(address_point_projected.iloc[0])]
-
-                if not containing_grid.empty:
-                    clicked_id = containing_grid.iloc[0]['id']
-                    click_data = {'points': [{'hovertext': clicked_id}]}
-                else:
-                    error_msg = "Address does not fall within any grid cell."
-            else:
-                error_msg = "Address not found. Try a different query."
-        except Exception as e:
-            error_msg = f"Error: {str(e)}"
-
-    # Handle cell ID search or simulated click
+    # Handle cell ID search or click (address searches simulate a click, see search_address)
     if n_clicks_id > 0 and cell_id is not None:
         clicked_id = cell_id
     elif click_data:
-        try:
-            clicked_id = int(click_data['points'][0]['hovertext'])
-        except (KeyError, ValueError):
+        clicked_id = clicked_cell_id(click_data)
+        if clicked_id is None:
             return create_map(zoom=zoom,
-                              center=center), "Invalid click - no grid cell ID detected.", f"Threshold: {threshold} min", error_msg
+                              center=center), "Invalid click - no grid cell ID detected.", f"Threshold: {threshold} min", None
     else:
         return create_map(zoom=zoom,
-                          center=center), "Click on a grid cell or type in the cell id below to map how far you can reach.", f"Threshold: {threshold} min", error_msg
+                          center=center), "Click on a grid cell or type in the cell id below to map how far you can reach.", f"Threshold: {threshold} min", None
+
+    clicked_id = int(clicked_id)
+    year = int(year or matrix_store.base_year)
 
     # Delete old files from the download folder
     delete_old_files(download_folder)
 
-    # Query database for related IDs
-    related_ids = query_db(dataset_value, threshold, clicked_id)
-    center = {'lat': grid_gdf.loc[grid_gdf['id'] == clicked_id].geometry.centroid.y.values[0],
-              'lon': grid_gdf.loc[grid_gdf['id'] == clicked_id].geometry.centroid.x.values[0]}
-    new_fig = create_map(selected_ids=related_ids, activated_id=clicked_id, zoom=zoom, center=center)
+    if query_kind == 'nearest' and k:
+        return nearest_update(clicked_id, dataset_value, int(min(max(k, 1), max_nearest)), direction,
+                              bool(show_isochrones), year, zoom, threshold)
+
+    log_request('matrix', clicked_id, dataset_value, threshold, direction)
+    result_key = (clicked_id, dataset_value, threshold, direction, bool(show_isochrones), year)
+    result = matrix_result(*result_key)
 
-    # Create GeoPackage file
-    gpkg_filepath = create_gpkg(clicked_id, related_ids, dataset_value)
-    gpkg_filename = os.path.basename(gpkg_filepath)
-    print(f"gpkg filename:{gpkg_filename}")
+    # The cached figure is centred on the clicked cell; only the zoom follows the user
+    new_fig = dict(result['figure'])
+    new_fig['layout'] = dict(new_fig['layout'], mapbox=dict(new_fig['layout']['mapbox'], zoom=zoom))
+
+    related_count = result['count']
+    area_km2 = result['area_km2']
+    total_population = result['population']
     # CSV download logic
     csv_filename = f'{download_folder}/Helsinki_Travel_Time_Matrix_2023_travel_times_to_{clicked_id}.csv'
-    area_km2 = round(len(related_ids) * 62500 / 1000000, 2)
-    # Calculate total population in reachable area
-    total_population = calculate_population(related_ids)
     # Generate floating box content
     floating_box_content = html.Div([
-        f"Clicked Cell ID: {clicked_id}",
+        f"Clicked Cell ID: {clicked_id}" + (f" ({year})" if year != matrix_store.base_year else ""),
         html.Br(), html.Br(),
-        html.B(f"{len(related_ids)}"),
-        f" cells can be reached within {threshold} minutes using '{dataset_value}'. This is equivalent to an approximate area of ",
+        html.B(f"{related_count}"),
+        (f" cells can be reached within {threshold} minutes using '{dataset_value}'. " if direction == 'from' else
+         f" cells can reach the clicked cell within {threshold} minutes using '{dataset_value}'. "),
+        "This is equivalent to an approximate area of ",
         html.B(f"{area_km2} km²."),
         html.Br(), html.Br(),
         html.B(f"Population: {total_population}"),
-        " people live in the reachable area.",
+        " people live in the reachable area." if direction == 'from' else " people live in the catchment area.",
         html.Br(), html.Br(),
         html.A("Download CSV", href=f'/download/{os.path.basename(csv_filename)}', target="_blank"),
+    ])
+
+    selection = {'id': int(clicked_id), 'mode': dataset_value, 'direction': direction, 'year': year,
+                 'threshold': threshold, 'isochrones': bool(show_isochrones)}
+    return new_fig, floating_box_content, f"Threshold: {threshold} min", selection
+
+
+# Everything update_map computes for a (cell, mode, threshold, direction, year) selection: the
+# figure (at the default zoom), counts and population. Memoized, since popular cells are
+# requested repeatedly by different users. Download files are written by export_files.
+@result_cache.memoize('matrix')
+def matrix_result(clicked_id, dataset_value, threshold, direction, show_isochrones, year):
+    related_ids = query_db(dataset_value, threshold, clicked_id, direction, year)
+    isochrone_polygons = None
+    if show_isochrones:
+        with span('isochrones', page='matrix'):
+            isochrone_polygons = isochrones(clicked_id, dataset_value, isochrone_bands(threshold), direction,
+                                            year=year)
+    fig = create_map(selected_ids=related_ids, activated_id=clicked_id, center=cell_center(clicked_id),
+                     isochrone_polygons=isochrone_polygons)
+    return {
+        'figure': fig.to_dict(),
+        'count': len(related_ids),
+        'area_km2': round(len(related_ids) * 62500 / 1000000, 2),
+        'population': calculate_population(related_ids),
+    }
+
+
+# update_map for the k-nearest selection: the ranked cells with their travel times and the
+# running population total
+def nearest_update(clicked_id, dataset_value, k, direction, show_isochrones, year, zoom, threshold):
+    log_request('matrix_nearest', clicked_id, dataset_value, k, direction)
+    result = matrix_nearest_result(clicked_id, dataset_value, k, direction, show_isochrones, year)
+    new_fig = dict(result['figure'])
+    new_fig['layout'] = dict(new_fig['layout'], mapbox=dict(new_fig['layout']['mapbox'], zoom=zoom))
+
+    ranking = result['ranking']
+    floating_box_content = html.Div([
+        f"Clicked Cell ID: {clicked_id}" + (f" ({year})" if year != matrix_store.base_year else ""),
+        html.Br(), html.Br(),
+        (f"The {len(ranking)} nearest cells using '{dataset_value}' are " if direction == 'from' else
+         f"The {len(ranking)} cells nearest to the clicked cell using '{dataset_value}' are "),
+        html.B(f"within {ranking[-1]['Time (min)']:.0f} minutes." if ranking else "none."),
+        html.Br(), html.Br(),
+        html.B(f"Population: {result['population']}"),
+        " people live in these cells.",
         html.Br(), html.Br(),
-        html.A("Download GPKG", href=f'/download/{os.path.basename(gpkg_filename)}', target="_blank")
+        dash_table.DataTable(
+            data=ranking,
+            columns=[{'name': name, 'id': name} for name in ('Rank', 'Cell', 'Time (min)', 'Cumulative population')],
+            page_size=10,
+            style_table={'overflowX': 'auto', 'minWidth': '100%'},
+            style_cell={'textAlign': 'left', 'padding': '5px'},
+            style_header={'backgroundColor': 'rgb(230, 230, 230)', 'fontWeight': 'bold'}
+        ),
     ])
 
-    return new_fig, floating_box_content, f"Threshold: {threshold} min", error_msg
+    # Downloads and the animation use the time of the k-th cell as the threshold
+    selection = {'id': int(clicked_id), 'mode': dataset_value, 'direction': direction, 'year': year,
+                 'threshold': result['threshold'], 'isochrones': show_isochrones, 'k': k}
+    return new_fig, floating_box_content, f"Threshold: {threshold} min (not used for nearest cells)", selection
+
+
+# The k-nearest counterpart of matrix_result: figure, ranking records and population
+@result_cache.memoize('matrix_nearest')
+def matrix_nearest_result(clicked_id, dataset_value, k, direction, show_isochrones, year):
+    nearest, times = nearest_destinations(dataset_value, k, clicked_id, direction, year)
+    threshold = int(np.ceil(times[-1])) if len(times) else 0
+    related_ids = grid_index.ids[nearest].tolist()
+    isochrone_polygons = None
+    if show_isochrones and threshold > 0:
+        with span('isochrones', page='matrix'):
+            isochrone_polygons = isochrones(clicked_id, dataset_value, isochrone_bands(threshold), direction,
+                                            year=year)
+    fig = create_map(selected_ids=related_ids, activated_id=clicked_id, center=cell_center(clicked_id),
+                     isochrone_polygons=isochrone_polygons)
+    cumulative_population = np.cumsum(population[nearest])
+    ranking = [{'Rank': rank + 1, 'Cell': cell_id, 'Time (min)': float(time), 'Cumulative population': int(total)}
+               for rank, (cell_id, time, total) in enumerate(zip(related_ids, times, cumulative_population))]
+    return {
+        'figure': fig.to_dict(),
+        'ranking': ranking,
+        'threshold': threshold,
+        'population': int(cumulative_population[-1]) if len(ranking) else 0,
+    }
+
+
+# Address search, in a background job since the Nominatim fallback can take seconds. A found
+# address simulates a click on its cell, so update_map handles it like any other click.
+@app.callback(
+    [Output('scatterplot-map', 'clickData'),
+     Output('address-error', 'children')],
+    [Input('address-search-btn', 'n_clicks'),
+     Input('address-input', 'n_submit')],
+    State('address-input', 'value'),
+    background=True,
+    running=[(Output('address-search-btn', 'disabled'), True, False),
+             (Output('address-cancel-btn', 'disabled'), False, True),
+             (Output('address-status', 'children'), "Searching...", "")],
+    cancel=[Input('address-cancel-btn', 'n_clicks')],
+    prevent_initial_call=True
+)
+def search_address(n_clicks, n_submit, address):
+    if not address:
+        return dash.no_update, ""
+    try:
+        with span('geocode', page='matrix'):
+            location = geocoder.geocode(address)
+    except Exception as e:
+        return dash.no_update, f"Error: {str(e)}"
+    if not location:
+        if geocoder.gazetteer.ambiguous(address):
+            return dash.no_update, "Several streets match, pick one: " + ", ".join(geocoder.suggest(address, 5))
+        return dash.no_update, "Address not found. Try a different query."
+    lat, lon, _ = location
+    address_id = cell_at(lon, lat)
+    if address_id is None:
+        return dash.no_update, "Address does not fall within any grid cell."
+    return {'points': [{'hovertext': int(address_id)}]}, ""
+
+
+# Download files for the current selection, written in a background job with a progress bar:
+# the GeoPackage of the highlighted cells and, with isochrones on, the isochrone GeoPackage.
+# A newer selection cancels the job of the previous one.
+@app.callback(
+    Output('matrix-downloads', 'children'),
+    Input('matrix-selection', 'data'),
+    background=True,
+    running=[(Output('export-cancel-btn', 'disabled'), False, True),
+             (Output('export-progress', 'style'), {'width': '100%'}, {'display': 'none'})],
+    progress=[Output('export-progress', 'value'),
+              Output('export-progress', 'max')],
+    cancel=[Input('export-cancel-btn', 'n_clicks')],
+    prevent_initial_call=True
+)
+def export_files(set_progress, selection):
+    if not selection:
+        return []
+    clicked_id, dataset_value, threshold = selection['id'], selection['mode'], selection['threshold']
+    direction, year = selection['direction'], selection['year']
+    steps = 2 if selection['isochrones'] else 1
+    set_progress(('0', str(steps)))
+
+    if selection.get('k'):
+        nearest, _ = nearest_destinations(dataset_value, selection['k'], clicked_id, direction, year)
+        related_ids = grid_index.ids[nearest].tolist()
+        gpkg_filepath = create_gpkg(clicked_id, related_ids, dataset_value, f"nearest{selection['k']}", direction,
+                                    year)
+    else:
+        vector = matrix_store.store.vector(clicked_id, dataset_value, direction, year)
+        related_ids = grid_index.ids[vector <= threshold].tolist()
+        gpkg_filepath = create_gpkg(clicked_id, related_ids, dataset_value, threshold, direction, year)
+    print(f"gpkg filename:{gpkg_filepath}")
+    links = [html.A("Download GPKG", href=f'/download/{os.path.basename(gpkg_filepath)}', target="_blank")
+             if gpkg_filepath else "GPKG not available for this cell."]
+    set_progress(('1', str(steps)))
+
+    if selection['isochrones']:
+        # Like matrix_nearest_result: no isochrones without a threshold, and empty bands are left out
+        isochrone_polygons = []
+        if threshold > 0 and related_ids:
+            isochrone_polygons = [(band, polygon) for band, polygon in
+                                  isochrones(clicked_id, dataset_value, isochrone_bands(threshold), direction,
+                                             year=year)
+                                  if not polygon.is_empty]
+        isochrone_gpkg = create_isochrone_gpkg(clicked_id, isochrone_polygons, dataset_value, direction, year) \
+            if isochrone_polygons else None
+        if isochrone_gpkg:
+            links += [html.Br(), html.Br(),
+                      html.A("Download isochrones GPKG", href=f'/download/{os.path.basename(isochrone_gpkg)}',
+                             target="_blank")]
+        set_progress(('2', str(steps)))
+    return links
+
+
+# Autocomplete suggestions for the address input, answered from the local gazetteer
+@app.callback(
+    Output('address-suggestions', 'children'),
+    Input('address-input', 'value')
+)
+def update_address_suggestions(address):
+    if not address or len(address) < 3:
+        return []
+    return [html.Option(value=suggestion) for suggestion in geocoder.suggest(address)]
+
+
+# Distribution panel of the current selection; without modes chosen it follows the map's mode
+@app.callback(
+    Output('distribution-graph', 'figure'),
+    [Input('matrix-selection', 'data'),
+     Input('distribution-modes', 'value'),
+     Input('distribution-view', 'value')]
+)
+def update_distribution(selection, distribution_modes, view):
+    if not selection:
+        return distribution_figure(view=view)
+    distribution = travel_time_distribution(selection['id'], selection['direction'], selection['year'])
+    return distribution_figure(distribution, distribution_modes or [selection['mode']], view, selection['threshold'])
+
+
+# Threshold sweep for the animate button: the selected cell's travel times binned into
+# slider steps (the smallest threshold at which each cell becomes reachable), sorted by step,
+# with cumulative counts per step. The browser plays the growth from this single response.
+@timed('sweep', page='matrix')
+def threshold_sweep(clicked_id, column, direction='from', min_step=5, max_step=120, year=None):
+    vector = matrix_store.store.vector(clicked_id, column, direction, year)
+    reachable = np.flatnonzero(vector <= max_step)
+    steps = np.maximum(np.ceil(vector[reachable]), min_step).astype(int)
+    order = np.argsort(steps, kind='stable')
+    reachable, steps = reachable[order], steps[order]
+    thresholds = np.arange(min_step, max_step + 1)
+    return {
+        'id': int(clicked_id),
+        'ids': grid_index.ids[reachable].tolist(),
+        'lat': np.round(grid_index.centroid_lat[reachable], 5).tolist(),
+        'lon': np.round(grid_index.centroid_lon[reachable], 5).tolist(),
+        'steps': thresholds.tolist(),
+        'counts': np.searchsorted(steps, thresholds, side='right').tolist(),
+    }
+
+
+@app.callback(
+    [Output('sweep-store', 'data'),
+     Output('animate-interval', 'disabled'),
+     Output('animate-interval', 'n_intervals')],
+    Input('animate-btn', 'n_clicks'),
+    State('matrix-selection', 'data'),
+    prevent_initial_call=True
+)
+def start_animation(n_clicks, selection):
+    if not selection:
+        return None, True, 0
+    return threshold_sweep(selection['id'], selection['mode'], selection['direction'],
+                           year=selection.get('year')), False, 0
+
+
+# Plays the sweep in the browser: each tick shows the cells reachable within the next step
+app.clientside_callback(
+    """
+    function(n, sweep, figure) {
+        if (!sweep || !figure) {
+            return [window.dash_clientside.no_update, window.dash_clientside.no_update, true];
+        }
+        var k = Math.min(n || 0, sweep.steps.length - 1);
+        var count = sweep.counts[k];
+        var trace = {
+            type: 'scattermapbox', mode: 'markers', name: 'Animation', hoverinfo: 'none',
+            lat: sweep.lat.slice(0, count), lon: sweep.lon.slice(0, count),
+            customdata: sweep.ids.slice(0, count),
+            marker: {size: 22, color: 'red', opacity: 0.8}
+        };
+        var data = figure.data.filter(function(t) {
+            return t.name !== 'Animation' && t.name !== 'Highlighted Cells';
+        });
+        data.splice(1, 0, trace);
+        var newFigure = Object.assign({}, figure, {data: data});
+        var status = sweep.steps[k] + ' min: ' + count + ' cells';
+        return [newFigure, status, k >= sweep.steps.length - 1];
+    }
+    """,
+    [Output('scatterplot-map', 'figure', allow_duplicate=True),
+     Output('animate-status', 'children'),
+     Output('animate-interval', 'disabled', allow_duplicate=True)],
+    Input('animate-interval', 'n_intervals'),
+    [State('sweep-store', 'data'),
+     State('scatterplot-map', 'figure')],
+    prevent_initial_call=True
+)
@@ -2,8 +2,17 @@ import geopandas as gpd
 import pandas as pd
 import plotly.graph_objects as go
 import plotly.express as px  # For color palette
-from dash import dcc, html, Input, Output, State
+import numpy as np
+import dash
+from dash import dcc, html, Input, Output, State, dash_table
 from app import app
+import bitsets
+import grid_index
+import matrix_store
+from grid_index import cell_center, clicked_cell_id
+from result_cache import result_cache
+from access_log import log_request
+from metrics import timed
 import sqlite3
 from pathlib import Path
 
@@ -11,6 +20,7 @@ from pathlib import Path
 db_path = 'data/full_csvs.db'
 gridfile = 'data/Helsinki_Travel_Time_Matrix_2023_grid.gpkg'
 borders= 'assets/vector/borders.gpkg'
+population_csv = 'data/pop.csv'
 
 # Ensure the download folder exists
 download_folder = 'download_files_compare'
@@ -39,6 +49,13 @@ if borders_gdf.crs is None or borders_gdf.crs != 'EPSG:4326':
     print("[DEBUG] Reprojecting borders CRS to EPSG:4326...")
     borders_gdf = borders_gdf.to_crs(epsg=4326)
 
+# Population per grid position, for the population totals of the overlap statistics
+population_df = pd.read_csv(population_csv)
+population = np.zeros(len(grid_index.ids))
+_population_positions = grid_index.positions_of(population_df['id'])
+np.add.at(population, _population_positions[_population_positions >= 0],
+          population_df['ASUKKAITA'].to_numpy()[_population_positions >= 0])
+
 # Extended column descriptions for travel modes
 column_descriptions_compare = {
     'walk_avg': 'Walking (average speed)',
@@ -57,8 +74,13 @@ column_descriptions_compare = {
     'car_n': 'Car (night)',
 }
 
-# Query database for related cells
-def query_db_compare(column, threshold, clicked_id):
+# Query database for related cells; direction='to' gives the catchment of the clicked cell
+@timed('query', page='compare')
+def query_db_compare(column, threshold, clicked_id, direction='from', year=None):
+    if direction == 'to' or (year is not None and year != matrix_store.base_year) \
+            or matrix_store.store.chunks is not None:
+        vector = matrix_store.store.vector(clicked_id, column, direction, year)
+        return grid_index.ids[vector <= threshold].tolist()
     conn = sqlite3.connect(db_path)
     query = f"""
         SELECT to_id FROM FULL_CV 
@@ -68,8 +90,108 @@ def query_db_compare(column, threshold, clicked_id):
     conn.close()
     return result['to_id'].tolist()
 
+# Reachable cells of a mode as a packed bitset over grid positions (see bitsets.py)
+def reachable_bits(column, threshold, clicked_id, direction='from', year=None):
+    return bitsets.within(matrix_store.store.vector(clicked_id, column, direction, year), threshold)
+
+
+# Overlap statistics of the modes' reachable sets: cells (and people) reachable by every mode,
+# by any, by each mode alone, and by one mode but not another for the first few modes. All
+# from bitwise operations on the bitsets.
+max_pairwise_modes = 4
+
+
+@timed('overlap', page='compare')
+def mode_overlap(bits_by_mode):
+    modes = list(bits_by_mode)
+    rows = [('All selected modes', bitsets.intersection(bits_by_mode.values())),
+            ('Any selected mode', bitsets.union(bits_by_mode.values()))]
+    for mode in modes:
+        others = bitsets.union([bits_by_mode[m] for m in modes if m != mode])
+        rows.append((f"Only {mode}", bits_by_mode[mode] & ~others))
+    for mode_a in modes[:max_pairwise_modes]:
+        for mode_b in modes[:max_pairwise_modes]:
+            if mode_a != mode_b:
+                rows.append((f"{mode_a} but not {mode_b}", bits_by_mode[mode_a] & ~bits_by_mode[mode_b]))
+    return [{'Cells': label, 'Count': bitsets.count(bits), 'Population': int(bitsets.total(bits, population))}
+            for label, bits in rows]
+
+
+def overlap_table(records, threshold):
+    return html.Div([
+        html.B(f"Overlap of the selected modes within {threshold} minutes:"),
+        dash_table.DataTable(
+            data=records,
+            columns=[{'name': name, 'id': name} for name in ('Cells', 'Count', 'Population')],
+            style_table={'overflowX': 'auto', 'minWidth': '100%'},
+            style_cell={'textAlign': 'left', 'padding': '5px', 'whiteSpace': 'normal', 'height': 'auto'},
+            style_header={'backgroundColor': 'rgb(230, 230, 230)', 'fontWeight': 'bold'}
+        )
+    ])
+
+
+# Joint reachability and meeting points for several origins, as reductions over the stacked
+# origin rows: a cell is jointly reachable when the slowest origin reaches it within the
+# threshold, and candidate meeting cells are ranked by that worst-case (max) travel time.
+@timed('meeting_points', page='compare')
+def meeting_points(origin_ids, column, threshold, top_n=10, year=None):
+    rows = matrix_store.store.origin_rows(origin_ids, year)[:, matrix_store.column_index[column]]
+    worst = np.where(np.isnan(rows), np.inf, rows).max(axis=0)
+    joint_ids = grid_index.ids[worst <= threshold].tolist()
+
+    finite = np.flatnonzero(np.isfinite(worst))
+    best = finite[np.argpartition(worst[finite], min(top_n, len(finite)) - 1)[:top_n]] if len(finite) else finite
+    best = best[np.lexsort((np.nanmean(rows[:, best], axis=0), worst[best]))]
+    ranking = [
+        {'id': int(grid_index.ids[i]), 'max': float(worst[i]), 'mean': float(np.nanmean(rows[:, i]))}
+        for i in best
+    ]
+    return joint_ids, ranking
+
+
+# Per-cell comparison of two modes for one cell, computed in one pass over the two mode
+# vectors. metric='difference' gives minutes of mode_a minus mode_b, 'ratio' gives
+# mode_a / mode_b. Cells reachable by only one of the modes are returned separately.
+@timed('difference', page='compare')
+def mode_difference(clicked_id, mode_a, mode_b, metric='difference', direction='from', year=None):
+    row = matrix_store.store.destination_row(clicked_id, year) if direction == 'to' \
+        else matrix_store.store.origin_row(clicked_id, year)
+    a = row[matrix_store.column_index[mode_a]]
+    b = row[matrix_store.column_index[mode_b]]
+    both = ~np.isnan(a) & ~np.isnan(b)
+    if metric == 'ratio':
+        # The clicked cell itself has zero travel time in both modes
+        both &= b > 0
+        values = a[both] / b[both]
+    else:
+        values = a[both] - b[both]
+    return {
+        'ids': grid_index.ids[both],
+        'values': values,
+        'only_a': grid_index.ids[~np.isnan(a) & np.isnan(b)],
+        'only_b': grid_index.ids[np.isnan(a) & ~np.isnan(b)],
+    }
+
+
+# Year-over-year change of one mode for one cell, in the same form as mode_difference: minutes
+# of year_b minus year_a, read from the stored year deltas, and the cells reachable in only
+# one of the years
+@timed('year_difference', page='compare')
+def year_difference(clicked_id, mode, year_a, year_b, direction='from'):
+    change, missing_a, missing_b = matrix_store.store.year_change(clicked_id, mode, year_a, year_b, direction)
+    both = ~np.isnan(change)
+    return {
+        'ids': grid_index.ids[both],
+        'values': change[both],
+        'only_a': grid_index.ids[~missing_a & missing_b],
+        'only_b': grid_index.ids[missing_a & ~missing_b],
+    }
+
+
 # Create map with multiple travel modes
-def create_map_compare(selected_ids_dict={}, activated_id=None, zoom=9.5, center=None):
+@timed('figure', page='compare')
+def create_map_compare(selected_ids_dict={}, activated_id=None, zoom=9.5, center=None, origin_ids=None,
+                       meeting_ids=None, difference=None):
     fig = go.Figure()
 
     # Base grid
@@ -81,6 +203,7 @@ def create_map_compare(selected_ids_dict={}, activated_id=None, zoom=9.5, center
             marker=dict(size=13, color='blue', opacity=0.1),
             hoverinfo='text',
             hovertext=grid_gdf_compare['id'].astype(str),
+            customdata=grid_gdf_compare['id'],
             name='All Grid Cells'
         )
     )
@@ -89,21 +212,64 @@ def create_map_compare(selected_ids_dict={}, activated_id=None, zoom=9.5, center
     color_palette = px.colors.qualitative.Safe
     mode_colors = {mode: color_palette[i % len(color_palette)] for i, mode in enumerate(selected_ids_dict.keys())}
 
-    # Add highlighted cells for each travel mode
+    # Add highlighted cells for each travel mode, given as id lists or bitsets
     for mode, ids in selected_ids_dict.items():
-        selected_gdf = grid_gdf_compare[grid_gdf_compare['id'].isin(ids)]
+        positions = bitsets.positions(ids) if isinstance(ids, np.ndarray) and ids.dtype == np.uint8 \
+            else grid_index.positions_of(ids)
+        positions = positions[positions >= 0]
         fig.add_trace(
             go.Scattermapbox(
-                lat=selected_gdf.geometry.centroid.y,
-                lon=selected_gdf.geometry.centroid.x,
+                lat=grid_index.centroid_lat[positions],
+                lon=grid_index.centroid_lon[positions],
                 mode='markers',
                 marker=dict(size=12, color=mode_colors[mode], opacity=0.8),
                 hoverinfo='text',
-                hovertext=[f"{mode} - ID: {id}" for id in selected_gdf['id']],
+                hovertext=[f"{mode} - ID: {id}" for id in grid_index.ids[positions]],
+                customdata=grid_index.ids[positions],
                 name=mode
             )
         )
 
+    # Continuous per-cell difference/ratio between two modes
+    if difference:
+        positions = grid_index.positions_of(difference['ids'])
+        is_ratio = difference['metric'] == 'ratio'
+        fig.add_trace(
+            go.Scattermapbox(
+                lat=grid_index.centroid_lat[positions],
+                lon=grid_index.centroid_lon[positions],
+                mode='markers',
+                marker=dict(
+                    size=10,
+                    color=difference['values'],
+                    colorscale='RdBu_r',
+                    cmid=1 if is_ratio else 0,
+                    opacity=0.8,
+                    colorbar=dict(title='ratio' if is_ratio else 'min', x=1.0)
+                ),
+                hoverinfo='text',
+                hovertext=[f"ID: {id} - {value:.2f}" if is_ratio else f"ID: {id} - {value:+.0f} min"
+                           for id, value in zip(difference['ids'], difference['values'])],
+                customdata=grid_index.ids[positions],
+                name=difference['label']
+            )
+        )
+        for key, label in (('only_a', difference['mode_a']), ('only_b', difference['mode_b'])):
+            positions = grid_index.positions_of(difference[key])
+            if len(positions):
+                fig.add_trace(
+                    go.Scattermapbox(
+                        lat=grid_index.centroid_lat[positions],
+                        lon=grid_index.centroid_lon[positions],
+                        mode='markers',
+                        marker=dict(size=10, color='gray', opacity=0.6),
+                        hoverinfo='text',
+                        hovertext=f"Only reachable by {label}",
+                        customdata=grid_index.ids[positions],
+                        name=f"Only {label}"
+                    )
+                )
+
     # Highlight the activated cell
     if activated_id:
         activated_gdf = grid_gdf_compare[grid_gdf_compare['id'] == activated_id]
@@ -115,9 +281,40 @@ def create_map_compare(selected_ids_dict={}, activated_id=None, zoom=9.5, center
                 marker=dict(size=15, color='black', opacity=0.8),
                 hoverinfo='text',
                 hovertext=f"Activated Cell - ID: {activated_id}",
+                customdata=activated_gdf['id'],
                 name='Activated Cell'
             )
         )
+
+    # Highlight the origins and best meeting cells of a multi-origin analysis
+    if origin_ids:
+        origins_gdf = grid_gdf_compare[grid_gdf_compare['id'].isin(origin_ids)]
+        fig.add_trace(
+            go.Scattermapbox(
+                lat=origins_gdf.geometry.centroid.y,
+                lon=origins_gdf.geometry.centroid.x,
+                mode='markers',
+                marker=dict(size=15, color='black', opacity=0.8),
+                hoverinfo='text',
+                hovertext=[f"Origin - ID: {id}" for id in origins_gdf['id']],
+                customdata=origins_gdf['id'],
+                name='Origins'
+            )
+        )
+    if meeting_ids:
+        meeting_gdf = grid_gdf_compare[grid_gdf_compare['id'].isin(meeting_ids)]
+        fig.add_trace(
+            go.Scattermapbox(
+                lat=meeting_gdf.geometry.centroid.y,
+                lon=meeting_gdf.geometry.centroid.x,
+                mode='markers',
+                marker=dict(size=18, color='gold', opacity=0.9),
+                hoverinfo='text',
+                hovertext=[f"Meeting point - ID: {id}" for id in meeting_gdf['id']],
+                customdata=meeting_gdf['id'],
+                name='Best meeting points'
+            )
+        )
     # Add city borders as a new trace
     for _, row in borders_gdf.iterrows():
         geometry = row.geometry
@@ -175,6 +372,22 @@ compare_layout = html.Div([
     html.Div(id='compare-box', children=[
         html.H4("Compare Travel Modes"),
         html.P("Select travel modes to map multiple modes simultaneously."),
+        dcc.RadioItems(
+            id='direction-compare',
+            options=[{'label': ' Reachable from the cell', 'value': 'from'},
+                     {'label': ' Catchment (who can reach the cell)', 'value': 'to'}],
+            value='from',
+            labelStyle={'display': 'block'}
+        ),
+        html.Br(),
+        html.Div("Year"),
+        dcc.Dropdown(
+            id='year-compare',
+            options=[{'label': str(year), 'value': year} for year in matrix_store.store.years()],
+            value=matrix_store.base_year,
+            clearable=False
+        ),
+        html.Br(),
         dcc.Checklist(
             id='travel-modes-compare',
             options=[{'label': desc, 'value': col} for col, desc in column_descriptions_compare.items()],
@@ -192,6 +405,67 @@ compare_layout = html.Div([
             marks={i: str(i) for i in range(5, 65, 10)},
         ),
         html.Div(id='slider-value-compare', style={'marginTop': '10px', 'fontSize': '16px'}),
+
+        # Multi-origin meeting point analysis
+        html.Hr(),
+        html.H5("Meeting Point"),
+        dcc.Checklist(
+            id='meeting-mode',
+            options=[{'label': ' Select several origins', 'value': 'on'}],
+            value=[]
+        ),
+        html.Button('Clear origins', id='meeting-clear', n_clicks=0),
+        html.Div(id='meeting-result', style={'marginTop': '10px'}),
+        dcc.Store(id='meeting-origins', data=[]),
+
+        # Per-cell difference between two modes, or between two years of mode A, for the
+        # clicked cell
+        html.Hr(),
+        html.H5("Mode Difference"),
+        dcc.Checklist(
+            id='difference-mode',
+            options=[{'label': ' Show difference between two modes', 'value': 'on'}],
+            value=[]
+        ),
+        dcc.RadioItems(
+            id='difference-kind',
+            options=[{'label': ' Mode A vs mode B', 'value': 'modes'},
+                     {'label': ' Year-over-year change of mode A', 'value': 'years'}],
+            value='modes',
+            labelStyle={'display': 'block'}
+        ),
+        dcc.Dropdown(
+            id='difference-mode-a',
+            options=[{'label': desc, 'value': col} for col, desc in column_descriptions_compare.items()],
+            value='pt_r_avg',
+            clearable=False
+        ),
+        dcc.Dropdown(
+            id='difference-mode-b',
+            options=[{'label': desc, 'value': col} for col, desc in column_descriptions_compare.items()],
+            value='car_r',
+            clearable=False
+        ),
+        dcc.RadioItems(
+            id='difference-metric',
+            options=[{'label': ' Difference (A - B, minutes)', 'value': 'difference'},
+                     {'label': ' Ratio (A / B)', 'value': 'ratio'}],
+            value='difference',
+            labelStyle={'display': 'block'}
+        ),
+        html.Div("Years (change = second minus first):"),
+        dcc.Dropdown(
+            id='difference-year-a',
+            options=[{'label': str(year), 'value': year} for year in matrix_store.store.years()],
+            value=matrix_store.store.years()[0],
+            clearable=False
+        ),
+        dcc.Dropdown(
+            id='difference-year-b',
+            options=[{'label': str(year), 'value': year} for year in matrix_store.store.years()],
+            value=matrix_store.store.years()[-1],
+            clearable=False
+        ),
     ], style={
         'width': '300px',
         'backgroundColor': 'rgba(255, 255, 255, 0.9)',
@@ -231,34 +505,118 @@ compare_layout = html.Div([
 
 # Callback for map update
 @app.callback(
-    Output('map-compare', 'figure'),
+    [Output('map-compare', 'figure'),
+     Output('meeting-origins', 'data'),
+     Output('meeting-result', 'children')],
     [Input('travel-modes-compare', 'value'),
      Input('threshold-slider-compare', 'value'),
-     Input('map-compare', 'clickData')]
+     Input('map-compare', 'clickData'),
+     Input('direction-compare', 'value'),
+     Input('meeting-mode', 'value'),
+     Input('meeting-clear', 'n_clicks'),
+     Input('difference-mode', 'value'),
+     Input('difference-mode-a', 'value'),
+     Input('difference-mode-b', 'value'),
+     Input('difference-metric', 'value'),
+     Input('year-compare', 'value'),
+     Input('difference-kind', 'value'),
+     Input('difference-year-a', 'value'),
+     Input('difference-year-b', 'value')],
+    [State('meeting-origins', 'data')]
 )
-def update_map_compare(selected_modes, threshold, click_data):
+def update_map_compare(selected_modes, threshold, click_data, direction, meeting_mode, n_clear, difference_mode,
+                       mode_a, mode_b, metric, year, difference_kind, year_a, year_b, origin_ids):
+    year = int(year or matrix_store.base_year)
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    origin_ids = [] if 'meeting-clear.n_clicks' in triggered else list(origin_ids or [])
+
     if not selected_modes:
-        return create_map_compare()
+        return create_map_compare(), origin_ids, ""
 
     # Handle clicked cell
-    activated_id = None
-    if click_data:
-        try:
-            activated_id = int(click_data['points'][0]['hovertext'])
-        except (KeyError, ValueError):
-            pass
-
-    # Query database for each mode
-    selected_ids_dict = {
-        mode: query_db_compare(mode, threshold, activated_id) if activated_id else []
-        for mode in selected_modes
-    }
+    activated_id = clicked_cell_id(click_data)
+
+    # Multi-origin mode: clicks toggle origins, and each mode shows the cells all origins reach
+    if meeting_mode:
+        if 'map-compare.clickData' in triggered and activated_id:
+            if activated_id in origin_ids:
+                origin_ids.remove(activated_id)
+            else:
+                origin_ids.append(activated_id)
+        if not origin_ids:
+            return create_map_compare(), origin_ids, "Click on grid cells to add origins."
+
+    if activated_id and not meeting_mode:
+        log_request('compare', activated_id, '|'.join(selected_modes), threshold, direction)
+    difference_params = None
+    if difference_mode and activated_id:
+        difference_params = ('years', mode_a, int(year_a), int(year_b)) if difference_kind == 'years' \
+            else ('modes', mode_a, mode_b, metric)
+    figure, result = compare_result(
+        tuple(selected_modes), threshold, activated_id, direction,
+        tuple(origin_ids) if meeting_mode else (),
+        difference_params, year
+    )
+    return figure, origin_ids, result
+
+
+# Figure and panel content for a compare page selection. Memoized, keyed by everything that
+# affects the result.
+@result_cache.memoize('compare')
+def compare_result(selected_modes, threshold, activated_id, direction, origin_ids, difference_params, year):
+    if origin_ids:
+        joint_ids_dict = {}
+        for mode in selected_modes:
+            joint_ids, ranking = meeting_points(origin_ids, mode, threshold, year=year)
+            joint_ids_dict[mode] = joint_ids
+            if mode == selected_modes[0]:
+                best_ranking = ranking
+
+        result = html.Div([
+            html.Div(f"{len(origin_ids)} origins. Cells reachable from all of them within {threshold} minutes: "
+                     + ", ".join(f"{mode}: {len(ids)}" for mode, ids in joint_ids_dict.items())),
+            html.Br(),
+            html.B(f"Best meeting cells ({selected_modes[0]}, worst-case minutes):"),
+            html.Ol([html.Li(f"{r['id']}: max {r['max']:.0f}, mean {r['mean']:.1f}") for r in best_ranking]),
+        ])
+        fig = create_map_compare(selected_ids_dict=joint_ids_dict, origin_ids=list(origin_ids),
+                                 meeting_ids=[r['id'] for r in best_ranking],
+                                 center=cell_center(origin_ids[-1]))
+        return fig.to_dict(), result
+
+    # Difference view: one continuous layer instead of the per-mode overlays
+    if difference_params and difference_params[0] == 'years':
+        _, mode, year_a, year_b = difference_params
+        difference = year_difference(activated_id, mode, year_a, year_b, direction)
+        difference.update(metric='difference', mode_a=str(year_a), mode_b=str(year_b),
+                          label=f"{mode} {year_b} - {year_a}")
+        if len(difference['values']):
+            summary = (f"{mode} {year_a} to {year_b}: median change "
+                       f"{np.median(difference['values']):+.1f} min over {len(difference['values'])} cells.")
+        else:
+            summary = "No cells reachable in both years."
+        fig = create_map_compare(activated_id=activated_id, center=cell_center(activated_id), difference=difference)
+        return fig.to_dict(), summary
+    if difference_params:
+        _, mode_a, mode_b, metric = difference_params
+        difference = mode_difference(activated_id, mode_a, mode_b, metric, direction, year)
+        difference.update(metric=metric, mode_a=mode_a, mode_b=mode_b,
+                          label=f"{mode_a} / {mode_b}" if metric == 'ratio' else f"{mode_a} - {mode_b}")
+        if len(difference['values']):
+            summary = (f"{mode_a} vs {mode_b}: median {metric} "
+                       f"{np.median(difference['values']):.2f} over {len(difference['values'])} cells.")
+        else:
+            summary = "No cells reachable by both modes."
+        fig = create_map_compare(activated_id=activated_id, center=cell_center(activated_id), difference=difference)
+        return fig.to_dict(), summary
+
+    # Reachable sets of each mode as bitsets; the origin row is read once for all modes
+    if not activated_id:
+        return create_map_compare(selected_ids_dict={mode: [] for mode in selected_modes}).to_dict(), ""
+    bits_by_mode = {mode: reachable_bits(mode, threshold, activated_id, direction, year) for mode in selected_modes}
+    result = overlap_table(mode_overlap(bits_by_mode), threshold) if len(selected_modes) > 1 else ""
 
     # Create updated map
-    center = {"lat": center_lat_compare, "lon": center_lon_compare}
-    if activated_id:
-        center = {
-            "lat": grid_gdf_compare.loc[grid_gdf_compare['id'] == activated_id].geometry.centroid.y.values[0],
-            "lon": grid_gdf_compare.loc[grid_gdf_compare['id'] == activated_id].geometry.centroid.x.values[0],
-        }
-    return create_map_compare(selected_ids_dict=selected_ids_dict, activated_id=activated_id, center=center)
+    center = cell_center(activated_id) or {"lat": center_lat_compare, "lon": center_lon_compare}
+    return create_map_compare(selected_ids_dict=bits_by_mode, activated_id=activated_id, center=center).to_dict(), \
+        result
@@ -0,0 +1,118 @@
+import plotly.graph_objects as go
+from dash import dcc, html, Input, Output
+from app import app
+import zonal_od
+from pages.compare import column_descriptions_compare
+
+# Heatmap of the precomputed zonal OD matrix (see zonal_od.py): one travel time statistic
+# of one mode between every pair of zones. Nothing is read from the matrix here, only the
+# small cached file per level.
+level_labels = {
+    'municipality': 'Municipalities',
+    'areas': 'Statistical areas' if zonal_od.zones_file else 'Areas (2 km blocks)',
+}
+statistic_labels = {
+    'p50': 'Median',
+    'mean': 'Mean',
+    'p10': '10th percentile',
+    'p25': '25th percentile',
+    'p75': '75th percentile',
+    'p90': '90th percentile',
+    'count': 'Reachable cell pairs',
+}
+
+
+def create_heatmap(level='municipality', mode='pt_r_avg', statistic='p50'):
+    names, values = zonal_od.matrix(level, mode, statistic)
+    fig = go.Figure()
+    if names is None:
+        fig.update_layout(title=f"No zonal matrix for {level_labels[level].lower()} yet, "
+                                f"run: python zonal_od.py build --level {level}")
+        return fig
+    unit = '' if statistic == 'count' else ' min'
+    fig.add_trace(go.Heatmap(
+        z=values,
+        x=names,
+        y=names,
+        colorscale='Viridis_r' if statistic != 'count' else 'Viridis',
+        colorbar=dict(title=statistic_labels[statistic] + unit),
+        hovertemplate=f"From %{{y}}<br>To %{{x}}<br>{statistic_labels[statistic]}: %{{z:.0f}}{unit}<extra></extra>"
+    ))
+    fig.update_layout(
+        title=f"{statistic_labels[statistic]} travel time, {column_descriptions_compare[mode]}"
+        if statistic != 'count' else f"Reachable cell pairs, {column_descriptions_compare[mode]}",
+        xaxis=dict(title='Destination', showticklabels=len(names) <= 60),
+        yaxis=dict(title='Origin', autorange='reversed', showticklabels=len(names) <= 60),
+        margin={"r": 0, "t": 40, "l": 0, "b": 0}
+    )
+    return fig
+
+
+zones_layout = html.Div([
+    # Left panel with controls
+    html.Div(id='zones-box', children=[
+        html.H4("Zonal OD Matrix"),
+        html.P("Travel times between zones over all their grid cells."),
+        html.Div("Zones"),
+        dcc.RadioItems(
+            id='zones-level',
+            options=[{'label': f" {label}", 'value': level} for level, label in level_labels.items()],
+            value='municipality',
+            labelStyle={'display': 'block'}
+        ),
+        html.Br(),
+        html.Div("Travel mode"),
+        dcc.Dropdown(
+            id='zones-mode',
+            options=[{'label': desc, 'value': col} for col, desc in column_descriptions_compare.items()],
+            value='pt_r_avg',
+            clearable=False
+        ),
+        html.Br(),
+        html.Div("Statistic"),
+        dcc.RadioItems(
+            id='zones-statistic',
+            options=[{'label': f" {label}", 'value': statistic} for statistic, label in statistic_labels.items()],
+            value='p50',
+            labelStyle={'display': 'block'}
+        ),
+    ], style={
+        'width': '300px',
+        'backgroundColor': 'rgba(255, 255, 255, 0.9)',
+        'border': '1px solid black',
+        'padding': '10px',
+        'boxShadow': '2px 2px 5px rgba(0, 0, 0, 0.4)',
+        'overflowY': 'auto',
+        'height': '100vh',
+        'display': 'inline-block',
+        'verticalAlign': 'top'
+    }),
+
+    # Right panel with the heatmap
+    html.Div([
+        dcc.Graph(
+            id='zones-heatmap',
+            figure=create_heatmap(),
+            style={'height': '100%', 'width': '100%'}
+        )
+    ], style={
+        'display': 'inline-block',
+        'width': 'calc(100% - 300px)',
+        'height': '100vh',
+        'position': 'relative',
+    })
+], style={
+    'display': 'flex',
+    'flexDirection': 'row',
+    'height': '100vh',
+})
+
+
+@app.callback(
+    Output('zones-heatmap', 'figure'),
+    [Input('zones-level', 'value'),
+     Input('zones-mode', 'value'),
+     Input('zones-statistic', 'value')]
+)
+def update_heatmap(level, mode, statistic):
+    return create_heatmap(level, mode, statistic)
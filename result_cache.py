@@ -0,0 +1,195 @@
+import functools
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Memoization of computed callback results (query results, population, figures) keyed by
+# page and arguments, e.g. ('matrix', origin, mode, threshold). Two backends:
+#   memory - per-process LRU
+#   disk   - a SQLite file with LRU eviction, shared by all worker processes on the host
+# Selected with TTM_RESULT_CACHE=memory|disk and capped with TTM_RESULT_CACHE_SIZE entries and
+# TTM_RESULT_CACHE_MB megabytes (per worker for memory, in total for disk). The results hold
+# whole figures, up to a few MB each, so both backends keep them pickled and evict by size.
+# Keys include a data version, the modification times of the matrix files, so results
+# computed before ingest.py or add_year rebuilt the matrix are not served afterwards (the old
+# entries age out of the LRU).
+cache_backend = os.environ.get('TTM_RESULT_CACHE', 'memory')
+cache_size = int(os.environ.get('TTM_RESULT_CACHE_SIZE', 64))
+cache_bytes = int(float(os.environ.get('TTM_RESULT_CACHE_MB', 64)) * 1024 * 1024)
+cache_path = os.environ.get('TTM_RESULT_CACHE_PATH', 'data/result_cache.db')
+data_files = ['data/full_csvs.db', os.environ.get('TTM_MATRIX_CHUNKS', 'data/matrix_chunks.db')]
+# Seconds between checks of the data files' modification times
+version_check_interval = 30
+# The disk backend records a hit's access time only when the stored one is older than this,
+# so most hits are reads only
+touch_interval = 60
+
+_missing = object()
+
+
+# Per-process LRU of pickled values, so their size is known and hits get their own copy
+class MemoryBackend:
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                return _missing
+            self._entries.move_to_end(key)
+        return pickle.loads(data)
+
+    def set(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = data
+            self._bytes += len(data)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._bytes -= len(self._entries.popitem(last=False)[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def size_bytes(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskBackend:
+    def __init__(self, path, max_entries, max_bytes):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, last_access REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._conn()
+        row = conn.execute("SELECT value, last_access FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return _missing
+        now = time.time()
+        if now - row[1] > touch_interval:
+            conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+            conn.commit()
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (key, data, time.time()))
+        # Evict the least recently used entries above the caps
+        conn.execute(
+            "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_access DESC "
+            "LIMIT -1 OFFSET ?)", (self.max_entries,)
+        )
+        conn.execute(
+            "DELETE FROM results WHERE key IN (SELECT key FROM (SELECT key, SUM(length(value)) "
+            "OVER (ORDER BY last_access DESC, key) AS total FROM results) WHERE total > ?)", (self.max_bytes,)
+        )
+        conn.commit()
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM results")
+        conn.commit()
+
+    def size_bytes(self):
+        return self._conn().execute("SELECT COALESCE(SUM(length(value)), 0) FROM results").fetchone()[0]
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+
+class ResultCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_checked = 0
+
+    # Modification times of the data files, re-read at most every version_check_interval
+    def data_version(self):
+        now = time.time()
+        if now - self._version_checked > version_check_interval:
+            self._version = tuple(os.stat(path).st_mtime_ns if os.path.exists(path) else None
+                                  for path in data_files)
+            self._version_checked = now
+        return self._version
+
+    def _count(self, page, outcome):
+        with self._lock:
+            page_stats = self._stats.setdefault(page, {'hits': 0, 'misses': 0})
+            page_stats[outcome] += 1
+
+    def get(self, page, key):
+        value = self.backend.get(repr((self.data_version(), page) + tuple(key)))
+        self._count(page, 'misses' if value is _missing else 'hits')
+        return None if value is _missing else value
+
+    def set(self, page, key, value):
+        self.backend.set(repr((self.data_version(), page) + tuple(key)), value)
+
+    # Decorator memoizing a function's result under (page, args). None results are not cached.
+    def memoize(self, page):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args):
+                value = self.get(page, args)
+                if value is None:
+                    value = func(*args)
+                    if value is not None:
+                        self.set(page, args, value)
+                return value
+            wrapper.uncached = func
+            return wrapper
+        return decorator
+
+    # Hit/miss counts and hit rate per page
+    def stats(self):
+        with self._lock:
+            pages = {page: dict(s) for page, s in self._stats.items()}
+        for page_stats in pages.values():
+            total = page_stats['hits'] + page_stats['misses']
+            page_stats['hit_rate'] = round(page_stats['hits'] / total, 3) if total else None
+        return {'backend': type(self.backend).__name__, 'entries': len(self.backend),
+                'bytes': self.backend.size_bytes(), 'pages': pages}
+
+
+if cache_backend == 'disk':
+    result_cache = ResultCache(DiskBackend(cache_path, cache_size, cache_bytes))
+else:
+    result_cache = ResultCache(MemoryBackend(cache_size, cache_bytes))
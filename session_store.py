@@ -0,0 +1,60 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Server-side per-session state for the pages, keyed by a session id that the browser keeps
+# in a dcc.Store. Entries expire after ttl seconds without access. Everything kept here must
+# be recomputable (caches, history), so a request that lands on another worker process only
+# loses speed, not correctness; the state needed to answer a callback lives in the client
+# store.
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+class SessionStore:
+    def __init__(self, ttl=3600, max_sessions=10000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # session id -> (last access, {key: value})
+        self._lock = threading.Lock()
+
+    def _session(self, session_id):
+        now = time.time()
+        entry = self._sessions.get(session_id)
+        if entry is None or now - entry[0] > self.ttl:
+            entry = (now, {})
+        else:
+            entry = (now, entry[1])
+        self._sessions[session_id] = entry
+        self._sessions.move_to_end(session_id)
+        self._expire(now)
+        return entry[1]
+
+    # Drop expired sessions (oldest first) and keep at most max_sessions
+    def _expire(self, now):
+        while self._sessions:
+            session_id, (last_access, _) = next(iter(self._sessions.items()))
+            if now - last_access <= self.ttl and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[session_id]
+
+    def get(self, session_id, key, default=None):
+        if not session_id:
+            return default
+        with self._lock:
+            return self._session(session_id).get(key, default)
+
+    def set(self, session_id, key, value):
+        if not session_id:
+            return
+        with self._lock:
+            self._session(session_id)[key] = value
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+sessions = SessionStore()
@@ -0,0 +1,195 @@
+import argparse
+import os
+import sqlite3
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely import box
+
+# Synthetic stand-in for the Helsinki Travel Time Matrix, so performance can be measured
+# without the real data. Writes the files the pages load from data/: the grid GeoPackage,
+# pop.csv, addresses.csv, full_csvs.db (FULL_CV) and the per-destination CSVs used for
+# GeoPackage downloads.
+#
+# Travel times follow the shape of the real matrix: they grow with network distance
+# (euclidean distance times a circuity factor), with fixed access/egress/parking overheads,
+# per-mode speeds, slower night public transport and some unreachable night PT pairs (-1).
+# Times are whole minutes and walk_d whole metres, like the published CSVs. The noise term is
+# a hash of the cell pair, so FULL_CV and the per-destination CSVs agree with each other.
+#
+# The default output folder is data_synthetic, so the real data/ is never touched by accident;
+# an existing matrix in the output folder is only replaced with --force.
+#
+#   python synthetic_data.py --origins 500
+#   python synthetic_data.py --origins all                 # full size, ~170M rows
+#   python synthetic_data.py --out data --force            # scratch checkout only: replaces data/
+source_grid = 'download_files/Helsinki_Travel_Time_Matrix_2023_grid.gpkg'
+cell_size = 250
+# Helsinki city centre in EPSG:3067, population density peaks here
+city_centre = (385500, 6672000)
+
+modes = ['walk_avg', 'walk_slo', 'bike_avg', 'bike_fst', 'bike_slo',
+         'pt_r_avg', 'pt_r_slo', 'pt_m_avg', 'pt_m_slo', 'pt_n_avg', 'pt_n_slo',
+         'car_r', 'car_m', 'car_n']
+columns = ['walk_d'] + modes
+
+
+# Grid of `cells` cells: the most central cells of the real grid when it is available,
+# otherwise a square lattice of 250 m cells
+def make_grid(cells=None, source=source_grid):
+    if source and os.path.exists(source):
+        grid = gpd.read_file(source)[['id', 'geometry']].to_crs('EPSG:3067')
+        if cells and cells < len(grid):
+            centroids = grid.geometry.centroid
+            distance = np.hypot(centroids.x - city_centre[0], centroids.y - city_centre[1])
+            grid = grid.iloc[np.argsort(distance.to_numpy())[:cells]].reset_index(drop=True)
+        return grid
+
+    side = int(np.ceil(np.sqrt(cells or 13231)))
+    rows, cols = np.divmod(np.arange(side * side), side)
+    x0 = city_centre[0] - side * cell_size / 2
+    y0 = city_centre[1] - side * cell_size / 2
+    return gpd.GeoDataFrame(
+        {'id': 5700000 + rows * 1000 + cols},
+        geometry=box(x0 + cols * cell_size, y0 + rows * cell_size,
+                     x0 + (cols + 1) * cell_size, y0 + (rows + 1) * cell_size),
+        crs='EPSG:3067'
+    )
+
+
+# Residents per cell: dense near the centre, a third of the cells empty
+def make_population(grid, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = grid.geometry.centroid
+    distance = np.hypot(centroids.x - city_centre[0], centroids.y - city_centre[1]).to_numpy()
+    population = rng.poisson(600 * np.exp(-distance / 7000))
+    population[rng.random(len(grid)) < 0.35] = 0
+    return pd.DataFrame({'id': grid['id'], 'ASUKKAITA': population})
+
+
+# Address gazetteer for the geocoder (and the address searches of loadtest.py): ten numbered
+# addresses on each of `streets` made-up streets, placed at random cell centroids
+def make_addresses(grid, streets=200, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = grid.geometry.centroid.to_crs('EPSG:4326')
+    positions = rng.choice(len(grid), min(streets * 10, len(grid)), replace=False)
+    return pd.DataFrame({
+        'street': [f"Testikatu {i % streets + 1}" for i in range(len(positions))],
+        'number': [i // streets + 1 for i in range(len(positions))],
+        'lat': centroids.y.to_numpy()[positions].round(6),
+        'lon': centroids.x.to_numpy()[positions].round(6),
+        'city': 'Helsinki',
+    })
+
+
+# Travel times between one cell (at `position`) and every cell, as {column: int array}. The
+# model is symmetric, so it serves as both an origin row and a destination column.
+def travel_times(xs, ys, position):
+    positions = np.arange(len(xs), dtype=np.int64)
+    distance = np.hypot(xs - xs[position], ys - ys[position])
+    low = np.minimum(positions, position)
+    high = np.maximum(positions, position)
+    noise = ((low * 73856093) ^ (high * 19349663)) % 1000 / 1000.0
+
+    walk_d = distance * 1.25 + 60 * noise
+    bike_d = distance * 1.3
+    pt_base = 6 + 8 * noise + distance / (22000 / 60)
+    car_base = 5 + 3 * noise
+    times = {
+        'walk_d': walk_d,
+        'walk_avg': walk_d / (4.8 * 1000 / 60),
+        'walk_slo': walk_d / (3.6 * 1000 / 60),
+        'bike_avg': 2 + bike_d / (12 * 1000 / 60),
+        'bike_fst': 2 + bike_d / (19 * 1000 / 60),
+        'bike_slo': 2 + bike_d / (9 * 1000 / 60),
+        'pt_r_avg': pt_base,
+        'pt_r_slo': pt_base * 1.12,
+        'pt_m_avg': pt_base * 1.05,
+        'pt_m_slo': pt_base * 1.17,
+        'pt_n_avg': pt_base * 1.4 + 10,
+        'pt_n_slo': pt_base * 1.55 + 10,
+        'car_r': car_base + distance * 1.35 / (28 * 1000 / 60),
+        'car_m': car_base + distance * 1.35 / (35 * 1000 / 60),
+        'car_n': car_base + distance * 1.35 / (45 * 1000 / 60),
+    }
+    times = {column: np.rint(values).astype(np.int64) for column, values in times.items()}
+    for column in times:
+        times[column][position] = 0
+    # No night service between some distant pairs
+    unreachable = (noise < 0.03) & (distance > 15000)
+    times['pt_n_avg'][unreachable] = -1
+    times['pt_n_slo'][unreachable] = -1
+    return times
+
+
+def generate(out='data_synthetic', cells=None, origins=500, csvs=20, seed=0, source=source_grid, force=False):
+    start_time = time.time()
+    out = Path(out)
+    existing = [out / name for name in ('full_csvs.db', 'Helsinki_Travel_Time_Matrix_2023_grid.gpkg')]
+    if not force and any(path.exists() for path in existing):
+        print(f"[ERROR] {out} already holds a matrix or grid, use --force to overwrite it")
+        return None
+    csv_folder = out / 'Helsinki_Travel_Time_Matrix_2023'
+    csv_folder.mkdir(parents=True, exist_ok=True)
+
+    grid = make_grid(cells, source)
+    grid.to_file(out / 'Helsinki_Travel_Time_Matrix_2023_grid.gpkg', driver='GPKG')
+    make_population(grid, seed).to_csv(out / 'pop.csv', index=False)
+    make_addresses(grid, seed=seed).to_csv(out / 'addresses.csv', index=False)
+    print(f"[DEBUG] Wrote grid, population and addresses for {len(grid)} cells")
+
+    ids = grid['id'].to_numpy()
+    centroids = grid.geometry.centroid
+    xs, ys = centroids.x.to_numpy(), centroids.y.to_numpy()
+    rng = np.random.default_rng(seed)
+    if origins is None or origins >= len(grid):
+        origin_positions = np.arange(len(grid))
+    else:
+        origin_positions = np.sort(rng.choice(len(grid), origins, replace=False))
+
+    db_file = out / 'full_csvs.db'
+    if db_file.exists():
+        db_file.unlink()
+    conn = sqlite3.connect(db_file)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute(f"CREATE TABLE FULL_CV (from_id INTEGER, to_id INTEGER, {', '.join(c + ' REAL' for c in columns)})")
+    insert = f"INSERT INTO FULL_CV VALUES ({', '.join('?' * (len(columns) + 2))})"
+    for n, position in enumerate(origin_positions, 1):
+        times = travel_times(xs, ys, position)
+        rows = np.column_stack([np.full(len(ids), ids[position]), ids] + [times[c] for c in columns])
+        conn.executemany(insert, rows.tolist())
+        if n % 100 == 0:
+            conn.commit()
+            print(f"[DEBUG] Wrote {n}/{len(origin_positions)} origins")
+    conn.commit()
+    conn.execute("CREATE INDEX idx_from on FULL_CV(from_id, to_id)")
+    conn.commit()
+    conn.close()
+    print(f"[DEBUG] Wrote {len(origin_positions) * len(ids)} matrix rows")
+
+    # Per-destination CSVs for the first origins, which the benchmarks click on
+    for position in origin_positions[:csvs]:
+        times = travel_times(xs, ys, position)
+        frame = pd.DataFrame({'from_id': ids, 'to_id': ids[position], **{c: times[c] for c in columns}})
+        frame.to_csv(csv_folder / f'Helsinki_Travel_Time_Matrix_2023_travel_times_to_{ids[position]}.csv', index=False)
+
+    print(f"[DEBUG] Generated synthetic data in {out}: {time.time() - start_time:.2f} seconds")
+    return ids[origin_positions]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic travel time matrix dataset.')
+    parser.add_argument('--out', default='data_synthetic', help='output folder (default: data_synthetic)')
+    parser.add_argument('--cells', type=int, default=None, help='number of grid cells (default: full grid)')
+    parser.add_argument('--origins', default='500', help="number of origins in FULL_CV, or 'all'")
+    parser.add_argument('--csvs', type=int, default=20, help='number of per-destination CSVs to write')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--source-grid', default=source_grid,
+                        help='grid to take cell geometries from; a square lattice is used if missing')
+    parser.add_argument('--force', action='store_true', help='overwrite an existing matrix in the output folder')
+    args = parser.parse_args()
+    generate(args.out, args.cells, None if args.origins == 'all' else int(args.origins),
+             args.csvs, args.seed, args.source_grid, args.force)
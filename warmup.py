@@ -0,0 +1,39 @@
+import os
+import sys
+import time
+from access_log import top_entries
+import matrix_store
+
+# Cache warm-up: replays the top-N entries of the access log so the first users after a deploy
+# hit warm origin-row and result caches. main.py runs it in a background thread once the
+# server starts; 'python warmup.py [N]' warms the shared disk result cache and the OS page
+# cache from a separate process.
+warmup_top_n = int(os.environ.get('TTM_WARMUP_TOP_N', 50))
+
+
+def warm_up(top_n=warmup_top_n):
+    # Imported here so the page modules (and their callbacks) are loaded by the caller first
+    from pages import Matrix, compare
+
+    start_time = time.time()
+    entries = top_entries(top_n)
+    warmed = 0
+    for (page, origin, mode, threshold, direction), _ in entries:
+        try:
+            if page == 'matrix':
+                Matrix.matrix_result(origin, mode, threshold, direction, False, matrix_store.base_year)
+            elif page == 'compare':
+                compare.compare_result(tuple(mode.split('|')), threshold, origin, direction, (), None,
+                                       matrix_store.base_year)
+            else:
+                matrix_store.store.vector(origin, mode, direction)
+            warmed += 1
+        except Exception as e:
+            print(f"[ERROR] Warm-up failed for {page} {origin} {mode} {threshold}: {e}")
+    elapsed = time.time() - start_time
+    print(f"[DEBUG] Warmed {warmed} of {len(entries)} access log entries in {elapsed:.2f} seconds")
+    return {'entries': len(entries), 'warmed': warmed, 'seconds': round(elapsed, 2)}
+
+
+if __name__ == '__main__':
+    warm_up(int(sys.argv[1]) if len(sys.argv) > 1 else warmup_top_n)
@@ -0,0 +1,140 @@
+import argparse
+import os
+import time
+import numpy as np
+import geopandas as gpd
+import grid_index
+import matrix_store
+
+# Zonal OD matrix: travel time statistics of every mode between zones, for the heatmap page
+# (pages/zones.py). Cells are assigned to the zone nearest to their centroid (the zone that
+# contains it, for cells on land). Two levels:
+#
+#   municipality  the municipalities in assets/vector/borders.gpkg
+#   areas         finer statistical areas from TTM_ZONES_FILE (name column TTM_ZONES_NAME),
+#                 or blocks of block_cells x block_cells grid cells (2 km) without one
+#
+# build() reads the matrix once, one origin zone at a time, and accumulates per destination
+# zone and mode a histogram of whole minutes with np.bincount, plus exact sums for the mean.
+# The travel times are whole minutes, so percentiles from the histogram are exact up to
+# max_minutes. The result is a small compressed .npz per level that the page loads at once.
+#
+#   python zonal_od.py build --level all
+borders = 'assets/vector/borders.gpkg'
+zones_file = os.environ.get('TTM_ZONES_FILE')
+zones_name_column = os.environ.get('TTM_ZONES_NAME', 'nimi')
+block_cells = 8
+cache_folder = 'data'
+levels = ['municipality', 'areas']
+percentiles = [10, 25, 50, 75, 90]
+max_minutes = 300
+
+_loaded = {}
+
+
+def cache_path(level):
+    return os.path.join(cache_folder, f"zonal_od_{level}.npz")
+
+
+# Zone names and the zone index of every grid position
+def zone_assignment(level):
+    if level == 'municipality' or zones_file:
+        path, name_column = (borders, 'NAMEFIN') if level == 'municipality' else (zones_file, zones_name_column)
+        zones = gpd.read_file(path)[[name_column, 'geometry']].reset_index(drop=True)
+        centroids = gpd.GeoDataFrame(
+            geometry=gpd.points_from_xy(grid_index.centroid_lon, grid_index.centroid_lat), crs='EPSG:4326'
+        ).to_crs(zones.crs)
+        joined = gpd.sjoin_nearest(centroids, zones, how='left')
+        # A point at the same distance from two zones is joined twice; keep the first
+        joined = joined[~joined.index.duplicated()]
+        return zones[name_column].astype(str).tolist(), joined['index_right'].to_numpy(dtype=np.int64)
+    blocks = np.column_stack([grid_index.cell_rows // block_cells, grid_index.cell_cols // block_cells])
+    block_ids, zone_of = np.unique(blocks, axis=0, return_inverse=True)
+    return [f"Block {row}-{col}" for row, col in block_ids], zone_of.ravel()
+
+
+# Nearest-rank percentiles from (..., max_minutes + 1) minute histograms, NaN without values
+def _histogram_percentiles(histograms, counts):
+    cumulative = histograms.cumsum(axis=-1)
+    result = []
+    for p in percentiles:
+        target = np.maximum(np.ceil(counts * p / 100), 1)
+        value = (cumulative >= target[..., None]).argmax(axis=-1).astype(np.float32)
+        value[counts == 0] = np.nan
+        result.append(value)
+    return np.stack(result, axis=-1)
+
+
+def build(level='municipality', path=matrix_store.db_path, batch=256):
+    start_time = time.time()
+    names, zone_of = zone_assignment(level)
+    n_zones, n_modes, bins = len(names), len(matrix_store.modes), max_minutes + 1
+    counts = np.zeros((n_zones, n_zones, n_modes), dtype=np.int64)
+    sums = np.zeros((n_zones, n_zones, n_modes))
+    stats = np.full((n_zones, n_zones, n_modes, len(percentiles)), np.nan, dtype=np.float32)
+    store = matrix_store.MatrixStore(path, cache_size=batch)
+
+    for origin_zone in range(n_zones):
+        origins = grid_index.ids[zone_of == origin_zone]
+        histograms = np.zeros((n_modes, n_zones * bins), dtype=np.int64)
+        for start in range(0, len(origins), batch):
+            rows = store.origin_rows(origins[start:start + batch])[:, 1:, :]
+            store.clear()
+            destination_zones = np.broadcast_to(zone_of, rows[:, 0, :].shape)
+            for m in range(n_modes):
+                values = rows[:, m, :]
+                reachable = ~np.isnan(values)
+                zones = destination_zones[reachable]
+                minutes = np.minimum(np.rint(values[reachable]), max_minutes).astype(np.int64)
+                histograms[m] += np.bincount(zones * bins + minutes, minlength=n_zones * bins)
+                sums[origin_zone, :, m] += np.bincount(zones, weights=values[reachable], minlength=n_zones)
+        histograms = histograms.reshape(n_modes, n_zones, bins).transpose(1, 0, 2)
+        counts[origin_zone] = histograms.sum(axis=-1)
+        stats[origin_zone] = _histogram_percentiles(histograms, counts[origin_zone])
+        print(f"[DEBUG] Zone {origin_zone + 1}/{n_zones} ({names[origin_zone]}): {len(origins)} origins")
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (sums / counts).astype(np.float32)
+    os.makedirs(cache_folder, exist_ok=True)
+    np.savez_compressed(cache_path(level), names=np.array(names), modes=np.array(matrix_store.modes),
+                        percentiles=np.array(percentiles), counts=counts, mean=mean, percentile_values=stats)
+    _loaded.pop(level, None)
+    print(f"[DEBUG] Built {cache_path(level)} ({n_zones} zones): {time.time() - start_time:.2f} seconds")
+
+
+# The cached zonal matrix of a level as a dict of arrays, None if it has not been built
+def load(level):
+    if level not in _loaded:
+        if not os.path.exists(cache_path(level)):
+            return None
+        with np.load(cache_path(level)) as data:
+            _loaded[level] = {key: data[key] for key in data.files}
+    return _loaded[level]
+
+
+# (zone names, origin x destination matrix) of one mode and statistic: 'mean', 'count' or
+# 'p10', 'p50', ... (see percentiles)
+def matrix(level, mode, statistic='p50'):
+    data = load(level)
+    if data is None:
+        return None, None
+    m = list(data['modes']).index(mode)
+    if statistic == 'mean':
+        values = data['mean'][:, :, m]
+    elif statistic == 'count':
+        values = data['counts'][:, :, m]
+    else:
+        values = data['percentile_values'][:, :, m, list(data['percentiles']).index(int(statistic[1:]))]
+    return data['names'].tolist(), values
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the zonal OD matrix for the heatmap page.')
+    parser.add_argument('command', choices=['build'])
+    parser.add_argument('--level', default='all', choices=levels + ['all'])
+    parser.add_argument('--db', default=matrix_store.db_path)
+    parser.add_argument('--batch', type=int, default=256, help='origins read per query')
+    args = parser.parse_args()
+
+    for level in levels if args.level == 'all' else [args.level]:
+        build(level, args.db, args.batch)